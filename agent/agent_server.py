@@ -2,6 +2,14 @@ import socket
 import requests
 import time
 import subprocess
+import threading
+import functools
+import gzip
+import hashlib
+import math
+import random
+import sqlite3
+import urllib.parse
 import os
 import logging
 from flask import Flask, json, request
@@ -37,20 +45,306 @@ runner_configs = {
     }
 }
 
-class Agent(object):
+def normalize_url(url):
+    '''
+    same as normalize_url in the master (master_server/ingest.py)
+    '''
+    parts = urllib.parse.urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+
+    if ((scheme == 'http' and netloc.endswith(':80')) or
+            (scheme == 'https' and netloc.endswith(':443'))):
+        netloc = netloc.rsplit(':', 1)[0]
+
+    query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(parts.query,
+                                                                 keep_blank_values=True)))
+
+    return urllib.parse.urlunsplit((scheme, netloc, parts.path or '/', query, ''))
+
+
+class BloomFilter(object):
+    '''
+    Set of strings that can have false positives but never false negatives,
+    sized for capacity items with a false positive rate of error_rate.
+    '''
+
+    def __init__(self, capacity=1000000, error_rate=0.001):
+        self.num_bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(int(round(self.num_bits / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.sha256(item.encode('utf-8')).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:16], 'little') | 1
+
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, item):
+        return all(self.bits[position // 8] & (1 << (position % 8))
+                   for position in self._positions(item))
+
+
+class CircuitOpenError(requests.ConnectionError):
+    pass
+
+
+class RetryPolicy(object):
+    '''
+    Retries requests to the master that fail to connect (or get a 502, 503 or
+    504) with exponential backoff and full jitter, so agents don't retry in
+    lockstep when the master restarts. Gives up after max_tries or once
+    deadline_seconds have passed.
+
+    It's also a circuit breaker shared by all requests from the agent: after
+    failure_threshold failures in a row the circuit opens and requests fail
+    straight away (or wait, if their deadline allows) for reset_seconds,
+    then the next request is let through to test the master.
+    '''
+    retry_statuses = (502, 503, 504)
+
+    def __init__(self, max_tries=10, base_delay=0.5, max_delay=30.0, deadline_seconds=120.0,
+                 failure_threshold=5, reset_seconds=30.0):
+        self.max_tries = max_tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline_seconds = deadline_seconds
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+
+        self.lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.open_until = 0
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+            self.open_until = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.failure_threshold:
+                self.open_until = time.monotonic() + self.reset_seconds
+
+    def wait_for_circuit(self, deadline):
+        with self.lock:
+            open_until = self.open_until
+
+        if open_until <= time.monotonic():
+            return
 
-    def __init__(self, master_base_url, agent_url=None, runner_num=1, auth_token=None, autoregister=True, runner_write_path=None):
-        self.task = None
+        # spread out the requests waiting on the circuit
+        wait_until = open_until + random.uniform(0, self.base_delay)
+        if wait_until > deadline:
+            raise CircuitOpenError('master unavailable, not sending requests until ' +
+                                   'the circuit resets')
+
+        time.sleep(max(wait_until - time.monotonic(), 0))
+
+    def call(self, send_request, deadline_seconds=None):
+        if deadline_seconds is None:
+            deadline_seconds = self.deadline_seconds
+        deadline = time.monotonic() + deadline_seconds
+
+        attempt = 0
+        while True:
+            self.wait_for_circuit(deadline)
+
+            error = None
+            try:
+                response = send_request()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+                response = None
+
+            if error is None and response.status_code not in self.retry_statuses:
+                self.record_success()
+                return response
+
+            self.record_failure()
+            attempt += 1
+            delay = self.backoff(attempt)
+
+            if attempt >= self.max_tries or time.monotonic() + delay > deadline:
+                if error is not None:
+                    raise error
+                return response
+
+            logging.warning('unable to contact master, retrying in ' + str(round(delay, 1)) + 's')
+            time.sleep(delay)
+
+
+class ResultSpool(object):
+    '''
+    Task results and screenshots waiting to be sent to the master, in the
+    order they were saved. They're kept in a sqlite database in WAL mode, a
+    save is only acknowledged to the runner once it's on disk, so they
+    survive the master being down and the agent restarting. The agents
+    uploader thread sends them on and removes them.
+    '''
+
+    def __init__(self, path=':memory:'):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+
+        if path != ':memory:':
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=FULL')
+
+        self.db.execute('CREATE TABLE IF NOT EXISTS spool (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                        'slot INTEGER, kind TEXT, req_url TEXT, body BLOB, file_name TEXT)')
+
+    def put(self, slot_num, req_url, task):
+        self._insert(slot_num, 'result', req_url, json.dumps(task).encode('utf-8'))
+
+    def put_screenshot(self, slot_num, req_url, task_id, screenshot, file_name):
+        self._insert(slot_num, 'screenshot', req_url, screenshot,
+                     json.dumps({'task': task_id, 'file_name': file_name}))
+
+    def _insert(self, slot_num, kind, req_url, body, file_name=None):
+        with self.lock:
+            self.db.execute('INSERT INTO spool (slot, kind, req_url, body, file_name) '
+                            'VALUES (?, ?, ?, ?, ?)', (slot_num, kind, req_url, body, file_name))
+
+    def peek(self, num_entries=1):
+        '''
+        the oldest num_entries entries, without removing them
+        '''
+        with self.lock:
+            rows = self.db.execute('SELECT id, slot, kind, req_url, body, file_name FROM spool '
+                                   'ORDER BY id LIMIT ?', (num_entries,)).fetchall()
+
+        entries = []
+        for entry_id, slot_num, kind, req_url, body, file_name in rows:
+            entry = {'id': entry_id, 'slot': slot_num, 'kind': kind, 'req_url': req_url}
+            if kind == 'result':
+                entry['task'] = json.loads(body.decode('utf-8'))
+            else:
+                entry.update(json.loads(file_name))
+                entry['screenshot'] = bytes(body)
+            entries.append(entry)
+
+        return entries
+
+    def remove(self, entries):
+        with self.lock:
+            self.db.execute('DELETE FROM spool WHERE id IN (' + ','.join('?' * len(entries)) + ')',
+                            [entry['id'] for entry in entries])
+
+    def pending(self, slot_num=None):
+        with self.lock:
+            if slot_num is None:
+                return self.db.execute('SELECT COUNT(*) FROM spool').fetchone()[0]
+
+            return self.db.execute('SELECT COUNT(*) FROM spool WHERE slot = ?',
+                                   (slot_num,)).fetchone()[0]
+
+
+class Slot(object):
+    '''
+    A runner slot on the agent. Each slot has its own runner process and
+    works through its own tasks, runners know their slot from the
+    PYMADA_SLOT environment variable.
+    '''
+
+    def __init__(self, slot_num):
+        self.slot_num = slot_num
         self.runner = None
+        self.task = None
+        self.leased_tasks = []
+
+        # ids of every task in the current (or last) lease, sent with state
+        # reports so the master knows which lease the report is about
+        self.lease_task_ids = []
+
+        # set while the master is being told the slot is idle, the slot
+        # isn't ready for a new task from anywhere else until then
+        self.reporting = False
+
+
+class Agent(object):
+
+    def __init__(self, master_base_url, agent_url=None, runner_num=1, auth_token=None, autoregister=True,
+                 runner_write_path=None, persistent_runner=False, runner_max_tasks=100,
+                 runner_max_memory_mb=None, num_slots=1, dedup_urls=False,
+                 dedup_capacity=1000000, add_url_batch_size=100, add_url_flush_seconds=1.0,
+                 http_pool_size=10, compress_requests=False, retry_policy=None,
+                 spool_path=':memory:', job_num=None):
+        self.slots = [Slot(i) for i in range(num_slots)]
         self.registered_num = None
         self.dep_install_process = None
         self.master_url = master_base_url
         self.runner_num = runner_num
+        # an agent bound to a job only runs the job's tasks, with its runner
+        self.job_num = job_num
         self.auth_token = auth_token
 
+        # every request to the master goes through one session so connections
+        # are kept alive and reused, the pool needs a connection for each
+        # thread that talks to the master at once (runner slots, url flusher)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=http_pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        if auth_token is not None:
+            self.session.headers['pymada_token_auth'] = auth_token
+
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+        self.retry_policy = retry_policy
+
+        # gzip json request bodies of at least compress_min_bytes
+        self.compress_requests = compress_requests
+        self.compress_min_bytes = 1024
+
+        # a persistent runner is kept running between tasks and loops on
+        # get_task, it is restarted after runner_max_tasks tasks or once it
+        # uses more than runner_max_memory_mb
+        self.persistent_runner = persistent_runner
+        self.runner_max_tasks = runner_max_tasks
+        self.runner_max_memory_mb = runner_max_memory_mb
+
+        # with dedup_urls, urls this agent already added are dropped without
+        # going to the master and the master skips urls it already has
+        self.url_filter = None
+        if dedup_urls:
+            self.url_filter = BloomFilter(capacity=dedup_capacity)
+
+        # urls added by runners, sent to the master in batches by url_flusher
+        self.url_buffer = []
+        self.url_buffer_lock = threading.Lock()
+        self.url_flush_lock = threading.Lock()
+        self.url_flush_event = threading.Event()
+        self.url_flusher = None
+        self.add_url_batch_size = add_url_batch_size
+        self.add_url_flush_seconds = add_url_flush_seconds
+
+        # results and screenshots are saved to the spool before the runner
+        # carries on, and sent to the master by result_uploader
+        self.result_spool = ResultSpool(spool_path)
+        self.result_upload_lock = threading.Lock()
+        self.result_upload_event = threading.Event()
+        self.result_uploader = None
+
         if autoregister:
             self.register_on_master(self_url=agent_url)
-            self.get_runner(runner_num=runner_num, write_path=runner_write_path)
+            self.get_runner(write_path=runner_write_path)
+
+        # results left in the spool when the agent last stopped. slots report
+        # RUNNING until their results are sent, so they have to be sent now
+        if self.result_spool.pending() > 0:
+            self.start_result_uploader()
+            self.result_upload_event.set()
 
     def register_on_master(self, self_url=None, req_url=None):
         if req_url is None:
@@ -59,13 +353,18 @@ class Agent(object):
         register_response = self._request_master(req_url, 'POST', json_data={
             'hostname': socket.gethostname(),
             'agent_url': self_url,
-            'runner_num': self.runner_num
+            'runner_num': self.runner_num,
+            'capacity': len(self.slots),
+            'job': self.job_num
         })
 
         parsed_response = register_response.json()
         logging.info('register response: ' + str(parsed_response))
         self.registered_num = parsed_response['id']
 
+        if parsed_response.get('runner_num') is not None:
+            self.runner_num = parsed_response['runner_num']
+
     def get_runner(self, runner_num=None, req_url=None, write_path=None):
         if runner_num is None:
             runner_num = self.runner_num
@@ -101,8 +400,12 @@ class Agent(object):
         with open(write_path, 'w') as runner_file:
             runner_file.write(runner_info['contents'])
 
-        self.runner = Runner(write_path, runner_info['file_type'],
-                             runner_info['custom_executable'])
+        for slot in self.slots:
+            slot.runner = Runner(write_path, runner_info['file_type'],
+                                 runner_info['custom_executable'],
+                                 on_exit=functools.partial(self.runner_exited, slot.slot_num),
+                                 persistent=self.persistent_runner,
+                                 env={'PYMADA_SLOT': str(slot.slot_num)})
         self.runner_num = runner_info['id']
 
         return {}
@@ -121,86 +424,412 @@ class Agent(object):
         
         self.dep_install_process = subprocess.Popen(dep_config['command'], shell=True, cwd=write_folder)
 
-    def get_task(self):
-        return self.task
+    def get_task(self, slot=0):
+        slot = self.slots[slot]
+
+        # runners that loop over tasks get the next leased task once they
+        # have saved the result for the current one
+        if slot.task is None and len(slot.leased_tasks) > 0:
+            slot.task = slot.leased_tasks.pop(0)
+
+        return slot.task
 
-    def save_task_results(self, results, req_url=None):
-        if self.task is None:
+    def save_task_results(self, results, req_url=None, slot=0):
+        '''
+        Puts the result in the result spool and returns straight away, the
+        result uploader thread sends it to the master.
+        '''
+        slot = self.slots[slot]
+
+        if slot.task is None:
             return {'error': 'no current task'}
         
         logging.debug('saving: ' + str(results))
 
         if type(results) is str:
-            self.task['task_result'] = results
+            slot.task['task_result'] = results
         else:
-            self.task['task_result'] = json.dumps(results)
+            slot.task['task_result'] = json.dumps(results)
 
         if req_url is None:
-            req_url = '/urls/' + str(self.task['id']) + '/'
+            req_url = '/urls/' + str(slot.task['id']) + '/'
 
-        r = self._request_master(req_url, 'PUT', json_data=self.task)
+        self.result_spool.put(slot.slot_num, req_url, slot.task)
+        slot.task = None
 
-        if not r.ok:
-            logging.warning('error with saving task result: ' + str(r.json()))
+        if slot.runner is not None and slot.runner.persistent:
+            slot.runner.tasks_run += 1
 
-        self.task = None
+        self.start_result_uploader()
+        self.result_upload_event.set()
+
+        return {}
+
+    def start_result_uploader(self):
+        if self.result_uploader is None:
+            self.result_uploader = threading.Thread(target=self._upload_results_loop,
+                                                    daemon=True)
+            self.result_uploader.start()
+
+    def _upload_results_loop(self):
+        while True:
+            self.result_upload_event.wait(5)
+            self.result_upload_event.clear()
+
+            try:
+                if not self.upload_results():
+                    time.sleep(self.retry_policy.backoff(3))
+            except Exception:
+                logging.exception('error with uploading results')
+
+    def upload_results(self, batch_size=100):
+        '''
+        Sends the spooled results and screenshots to the master in order,
+        results that are next to each other in one /urls/results/ request.
+        Ones the master rejects are logged and dropped. Returns False if the
+        master couldn't be reached and entries are left in the spool.
+        '''
+        with self.result_upload_lock:
+            while True:
+                entries = self.result_spool.peek(batch_size)
+                if len(entries) == 0:
+                    return True
+
+                # urls found during a task are added before it's marked complete
+                if not self.flush_urls():
+                    return False
+
+                for upload in self.group_spool_entries(entries):
+                    try:
+                        r = self.send_spool_entries(upload)
+                    except (requests.ConnectionError, requests.Timeout):
+                        return False
+
+                    if r.status_code >= 500:
+                        return False
+
+                    if not r.ok:
+                        logging.warning('error with saving ' + upload[0]['kind'] + ': ' + str(r.text))
+
+                    self.result_spool.remove(upload)
+                    for slot_num in set(e['slot'] for e in upload if e['kind'] == 'result'):
+                        if slot_num < len(self.slots):
+                            self.result_saved(self.slots[slot_num])
+
+    def group_spool_entries(self, entries):
+        '''
+        splits the entries into lists to send in one request each, runs of
+        results for the default /urls/<id>/ url go together
+        '''
+        uploads = []
+        for entry in entries:
+            batchable = (entry['kind'] == 'result' and
+                         entry['req_url'] == '/urls/' + str(entry['task']['id']) + '/')
+
+            if batchable and len(uploads) > 0 and uploads[-1][-1].get('batchable'):
+                uploads[-1].append(entry)
+            else:
+                uploads.append([entry])
+
+            entry['batchable'] = batchable
+
+        return uploads
+
+    def send_spool_entries(self, entries):
+        entry = entries[0]
+
+        if entry['kind'] == 'screenshot':
+            return self._request_master(entry['req_url'], 'POST', deadline_seconds=10,
+                                        files={'screenshot': (entry['file_name'],
+                                                              entry['screenshot']),
+                                               'task': ('', str(entry['task']))})
+
+        if entry['batchable']:
+            results = []
+            for e in entries:
+                result = {'id': e['task']['id'], 'task_result': e['task'].get('task_result')}
+
+                # the master tells copies of the same task apart by their slot
+                if e['task'].get('assigned_agent') is not None:
+                    result['assigned_agent'] = e['task']['assigned_agent']
+                    result['assigned_slot'] = e['task'].get('assigned_slot', 0)
+
+                results.append(result)
+
+            return self._request_master('/urls/results/', 'POST', json_data={'results': results},
+                                        deadline_seconds=10)
+
+        return self._request_master(entry['req_url'], 'PUT', json_data=entry['task'],
+                                    deadline_seconds=10)
+
+    def result_saved(self, slot):
+        # a persistent runner doesn't exit between tasks, once all its results
+        # are with the master it's ready for the next lease
+        if (slot.runner is not None and slot.runner.persistent and slot.task is None
+                and len(slot.leased_tasks) == 0
+                and self.result_spool.pending(slot.slot_num) == 0):
+            self.persistent_runner_idle(slot)
+
+    def persistent_runner_idle(self, slot):
+        '''
+        A persistent runner doesn't exit when it runs out of tasks, so the
+        master is told the slot is idle as soon as the last result is saved.
+        '''
+        if slot.runner.needs_recycle(self.runner_max_tasks, self.runner_max_memory_mb):
+            logging.info('restarting persistent runner after ' +
+                         str(slot.runner.tasks_run) + ' tasks')
+            slot.runner.stop()
+
+        self.report_idle(slot)
     
     def start_runner(self, task_data):
-        if self.runner is not None:
-            self.task = task_data
-            return self.runner.run()
+        '''
+        task_data is either a single task or a batch of tasks leased to a
+        slot in the format {'slot': int, 'tasks': [...]}. The tasks in a
+        batch are run one after the other without going back to the master.
+        '''
+        slot = self.slots[task_data.get('slot', 0)]
+
+        if slot.runner is not None:
+            if 'tasks' in task_data:
+                tasks = list(task_data['tasks'])
+            else:
+                tasks = [task_data]
+
+            if len(tasks) == 0:
+                return {'error': 'no tasks given'}
+
+            # the master sends a lease again if it thinks the slot never got
+            # it, which it may have if the slot was checked as it started
+            if ([t['id'] for t in tasks] == slot.lease_task_ids and not slot.reporting
+                    and self.check_slot(slot) == Runner.states.RUNNING):
+                return {}
+
+            slot.task = tasks[0]
+            slot.leased_tasks = tasks[1:]
+            slot.lease_task_ids = [t['id'] for t in tasks]
+            return slot.runner.run()
         
         return {'error': 'no runner available'}
+
+    def runner_exited(self, slot_num, exit_code):
+        slot = self.slots[slot_num]
+
+        if len(slot.leased_tasks) > 0:
+            slot.task = slot.leased_tasks.pop(0)
+            slot.runner.run()
+            return
+
+        # the master fails tasks without a result once the slot is idle, if
+        # results can't be sent now the slot reports RUNNING until they are
+        # and the master picks up that it's idle when it next checks
+        self.upload_results()
+        if self.result_spool.pending(slot.slot_num) > 0:
+            return
+
+        self.report_idle(slot, exit_code)
+
+    def report_idle(self, slot, exit_code=None):
+        if self.registered_num is None:
+            return
+
+        slot.reporting = True
+        try:
+            next_tasks = self.report_state(Runner.states.IDLE, slot=slot.slot_num,
+                                           exit_code=exit_code,
+                                           task_ids=slot.lease_task_ids)
+
+            if next_tasks is not None and len(next_tasks) > 0:
+                self.start_runner({'slot': slot.slot_num, 'tasks': next_tasks})
+        finally:
+            slot.reporting = False
+
+    def report_state(self, state, slot=0, exit_code=None, task_ids=None, req_url=None):
+        '''
+        Push a runner slot state change to the master. Returns the list of
+        tasks the master assigned to the slot in response, or None if the
+        request failed. Failures are only logged, the master falls back to
+        polling /check_runner.
+        '''
+        if req_url is None:
+            req_url = '/agents/' + str(self.registered_num) + '/state/'
+
+        try:
+            r = self._request_master(req_url, 'POST', json_data={
+                'agent_state': state,
+                'slot': slot,
+                'exit_code': exit_code,
+                'task_ids': task_ids
+            })
+        except (requests.ConnectionError, requests.Timeout):
+            logging.warning('unable to report state to master')
+            return None
+
+        if not r.ok:
+            logging.warning('error with reporting state: ' + str(r.text))
+            return None
+
+        return r.json()['tasks']
     
-    def kill_runner(self):
-        if self.runner is not None:
-            self.runner.kill()
-            return {}
+    def kill_runner(self, slot=None, task_id=None):
+        '''
+        kills the runner in the given slot, or in every slot if slot is None.
+        With task_id, only a runner still on that task is killed (the master
+        kills copies of a task that lost to another copy this way).
+        '''
+        if slot is None:
+            slots = self.slots
+        else:
+            slots = [self.slots[slot]]
 
-        return {'error': 'no runner available'}
+        if slots[0].runner is None:
+            return {'error': 'no runner available'}
+
+        for runner_slot in slots:
+            if task_id is not None and (runner_slot.task is None or
+                                        runner_slot.task.get('id') != task_id):
+                continue
+
+            runner_slot.runner.kill()
+
+        return {}
     
-    def check_runner(self):
-        if self.runner is None:
-            self.get_runner()
+    def check_runner(self, slots=None):
+        '''
+        overall status of the agent, IDLE if any slot is free to take tasks.
+        slots is the output of check_slots if it was already called.
+        '''
+        if slots is None:
+            slots = self.check_slots()
+
+        slot_statuses = [s['status'] for s in slots]
+
+        if 'NO_RUNNER' in slot_statuses:
             return 'NO_RUNNER'
 
+        if Runner.states.IDLE in slot_statuses:
+            return Runner.states.IDLE
+
+        return Runner.states.RUNNING
+
+    def check_slots(self):
+        if self.slots[0].runner is None:
+            self.get_runner()
+            return [{'slot': s.slot_num, 'status': 'NO_RUNNER'} for s in self.slots]
+
         if self.dep_install_process is not None:
             if self.dep_install_process.poll() is not None:
                 self.dep_install_process = None
             else:
-                return 'NO_RUNNER'
+                return [{'slot': s.slot_num, 'status': 'NO_RUNNER'} for s in self.slots]
 
-        runner_status = self.runner.get_status()
+        return [{'slot': s.slot_num, 'status': self.check_slot(s),
+                 'task_ids': s.lease_task_ids} for s in self.slots]
+
+    def check_slot(self, slot):
+        if slot.reporting or self.result_spool.pending(slot.slot_num) > 0:
+            return Runner.states.RUNNING
+
+        runner_status = slot.runner.get_status()
+
+        # a persistent runner waiting on get_task is idle
+        if (slot.runner.persistent and runner_status == Runner.states.RUNNING
+                and slot.task is None and len(slot.leased_tasks) == 0
+                and not slot.runner.handling_exit):
+            return Runner.states.IDLE
 
         return runner_status
 
 
-    def add_url(self, url, json_metadata=None, req_url=None):
-        if req_url is None:
-            req_url = '/urls/'
+    def add_url(self, url, json_metadata=None):
+        '''
+        Buffers the url to be sent to the master with the next batch, so
+        runners don't wait on the master. The buffer is flushed when it has
+        add_url_batch_size urls, every add_url_flush_seconds and before a
+        task result is saved.
+        '''
+        if self.url_filter is not None:
+            normalized_url = normalize_url(url)
+            if normalized_url in self.url_filter:
+                return {'duplicate': True}
+
+            self.url_filter.add(normalized_url)
 
         new_url_task = {
             "url": url
         }
 
         if json_metadata is not None:
-
-            print('json_metadata', type(json_metadata), json_metadata)
             if type(json_metadata) == dict:
                 new_url_task['json_metadata'] = json.dumps(json_metadata)
             else:
                 new_url_task['json_metadata'] = json_metadata
         
-        print('new url data', new_url_task)
-
-        r = self._request_master(req_url, 'POST', json_data=[new_url_task])
-
-        if not r.ok:
-            err_msg = r.json()
-            logging.warning('error with adding url: ' + str(err_msg))
-            return err_msg
-        else:
-            return r.json()
+        logging.debug('new url data ' + str(new_url_task))
+
+        with self.url_buffer_lock:
+            self.url_buffer.append(new_url_task)
+            num_buffered = len(self.url_buffer)
+
+        self.start_url_flusher()
+        if num_buffered >= self.add_url_batch_size:
+            self.url_flush_event.set()
+
+        return {'buffered': num_buffered}
+
+    def start_url_flusher(self):
+        if self.url_flusher is None:
+            self.url_flusher = threading.Thread(target=self._flush_urls_loop, daemon=True)
+            self.url_flusher.start()
+
+    def _flush_urls_loop(self):
+        while True:
+            self.url_flush_event.wait(self.add_url_flush_seconds)
+            self.url_flush_event.clear()
+
+            try:
+                self.flush_urls()
+            except Exception:
+                logging.exception('error with flushing urls')
+
+    def flush_urls(self, req_url=None):
+        '''
+        Sends the buffered urls to the master in batches. If the master can't
+        be reached the batch goes back in the buffer for the next flush,
+        batches the master rejects are dropped. Returns False if urls are
+        left in the buffer.
+        '''
+        if req_url is None:
+            req_url = '/urls/'
+            if self.url_filter is not None:
+                req_url += '?dedup=1'
+
+        with self.url_flush_lock:
+            while True:
+                with self.url_buffer_lock:
+                    batch = self.url_buffer[:self.add_url_batch_size]
+                    del self.url_buffer[:len(batch)]
+
+                if len(batch) == 0:
+                    return True
+
+                try:
+                    r = self._request_master(req_url, 'POST', json_data=batch,
+                                             deadline_seconds=10)
+                except (requests.ConnectionError, requests.Timeout):
+                    r = None
+
+                if r is not None and r.ok:
+                    continue
+
+                if r is not None and r.status_code < 500:
+                    logging.warning('error with adding urls: ' + str(r.text))
+                    continue
+
+                logging.warning('unable to add urls, will retry')
+                with self.url_buffer_lock:
+                    self.url_buffer[0:0] = batch
+                return False
     
     def log_error(self, error_msg, req_url=None):
         if req_url is None:
@@ -221,49 +850,66 @@ class Agent(object):
         else:
             return r.json()
     
-    def save_screenshot(self, screenshot, filename, req_url=None):
+    def save_screenshot(self, screenshot, filename, req_url=None, slot=0):
         if req_url is None:
             req_url = '/screenshots/'
-        
-        r = self._request_master(req_url, 'POST',
-                                 files={'screenshot': (filename, screenshot),
-                                        'task': ('', self.task['id'])})
 
-        if not r.ok:
-            err_msg = r.json()
-            return err_msg
-        else:
-            return r.json()
+        task = self.slots[slot].task
+        if task is None:
+            return {'error': 'no current task'}
 
-    def _send_request(self, req_url, method, json_data=None, headers={}, 
-                      files={}, _num_tries=0):
-        try:
-            response = requests.request(method, req_url, json=json_data, 
-            headers=headers, files=files, timeout=60)
-            return response
-        except (requests.ConnectionError, requests.Timeout) as e:
-            if _num_tries < 10:
-                logging.warning('unable to contact, retrying ' + req_url)
-                time.sleep(3)
-                return self._send_request(req_url, method, json_data=json_data, 
-                    files=files, headers=headers, _num_tries=_num_tries+1)
-            else:
-                raise e
+        self.result_spool.put_screenshot(slot, req_url, task['id'], screenshot, filename)
+        self.start_result_uploader()
+        self.result_upload_event.set()
+
+        return {}
+
+    def _send_request(self, req_url, method, json_data=None, headers={}, files={},
+                      deadline_seconds=None):
+        request_args = {'json': json_data}
+
+        if self.compress_requests and json_data is not None and len(files) == 0:
+            body = json.dumps(json_data).encode('utf-8')
+            if len(body) >= self.compress_min_bytes:
+                request_args = {'data': gzip.compress(body, compresslevel=5)}
+                headers = dict(headers, **{'Content-Type': 'application/json',
+                                           'Content-Encoding': 'gzip'})
+
+        def send_request():
+            return self.session.request(method, req_url, headers=headers, files=files,
+                                        timeout=60, **request_args)
+
+        return self.retry_policy.call(send_request, deadline_seconds)
         
-    def _request_master(self, url, method, json_data=None, files={}, master_url=None):
+    def _request_master(self, url, method, json_data=None, files={}, master_url=None,
+                        deadline_seconds=None):
         if master_url is not None:
             req_url = master_url + url
         else:
             req_url = self.master_url + url
 
-        headers = {}
+        return self._send_request(req_url, method, json_data, files=files,
+                                  deadline_seconds=deadline_seconds)
+
+    def connection_stats(self):
+        '''
+        number of requests sent to the master and the number of new
+        connections that were opened for them
+        '''
+        num_requests = 0
+        num_connections = 0
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for pool_key in pools.keys():
+                num_requests += pools[pool_key].num_requests
+                num_connections += pools[pool_key].num_connections
 
-        if self.auth_token is not None:
-            headers = {
-                'pymada_token_auth': self.auth_token
-            }
+        reused = 0.0
+        if num_requests > 0:
+            reused = max(num_requests - num_connections, 0) / num_requests
 
-        return self._send_request(req_url, method, json_data, headers=headers, files=files)
+        return {'requests': num_requests, 'connections': num_connections,
+                'reused_ratio': reused}
 
 
 class Runner(object):
@@ -272,7 +918,8 @@ class Runner(object):
         RUNNING = 'RUNNING'
         IDLE = 'IDLE'
 
-    def __init__(self, file_path, file_type, custom_executable=None):
+    def __init__(self, file_path, file_type, custom_executable=None, on_exit=None,
+                 persistent=False, env=None):
         if custom_executable is not None:
             self.executable = custom_executable
         else:
@@ -281,18 +928,61 @@ class Runner(object):
         self.file = file_path
         self.last_run_code = None
 
+        # on_exit is called with the exit code from a separate thread as soon
+        # as the runner process exits
+        self.on_exit = on_exit
+        self.handling_exit = False
+        self.stopped_process = None
+
+        self.persistent = persistent
+        self.tasks_run = 0
+
+        # extra environment variables for the runner process
+        self.env = env
+
     def run(self):
         if self.process is None:
             self.get_status()
             command = [self.executable, self.file]
             cwd = os.path.dirname(os.path.realpath(__file__))
-            self.process = subprocess.Popen(command, cwd=cwd)
+            process_env = None
+            if self.env is not None:
+                process_env = dict(os.environ, **self.env)
+
+            self.process = subprocess.Popen(command, cwd=cwd, env=process_env)
+            self.tasks_run = 0
             logging.debug('running ' + str(command))
 
+            if self.on_exit is not None:
+                watcher = threading.Thread(target=self._wait_for_exit,
+                                           args=(self.process,), daemon=True)
+                watcher.start()
+
             return {}
 
+    def _wait_for_exit(self, process):
+        exit_code = process.wait()
+
+        # stop() handles its own exit
+        if process is self.stopped_process:
+            return
+
+        self.handling_exit = True
+        if self.process is process:
+            self.process = None
+        self.last_run_code = exit_code
+
+        try:
+            self.on_exit(exit_code)
+        except Exception:
+            logging.exception('error handling runner exit')
+        finally:
+            self.handling_exit = False
+
     def get_status(self):
         if self.process is None:
+            if self.handling_exit:
+                return self.states.RUNNING
             return self.states.IDLE
 
         poll_result = self.process.poll()
@@ -301,6 +991,11 @@ class Runner(object):
         if poll_result is None:
             return self.states.RUNNING
 
+        # the exit watcher thread clears the process once on_exit is handled,
+        # until then the runner is not ready for a new task
+        if self.on_exit is not None:
+            return self.states.RUNNING
+
         if poll_result is not None:
             self.process = None
             self.last_run_code = poll_result
@@ -310,6 +1005,61 @@ class Runner(object):
         if self.process is not None:
             self.process.kill()
 
+    def stop(self):
+        '''
+        Kill the runner process without calling on_exit, used to restart a
+        persistent runner between tasks.
+        '''
+        if self.process is None:
+            return
+
+        self.stopped_process = self.process
+        self.process.kill()
+        self.last_run_code = self.process.wait()
+        self.process = None
+
+    def needs_recycle(self, max_tasks=None, max_memory_mb=None):
+        if max_tasks is not None and self.tasks_run >= max_tasks:
+            return True
+
+        if max_memory_mb is not None and self.memory_usage_mb() > max_memory_mb:
+            return True
+
+        return False
+
+    def memory_usage_mb(self):
+        '''
+        Resident memory of the runner process and all of its children (eg the
+        browser), read from /proc. Returns 0 where /proc isn't available.
+        '''
+        if self.process is None or not os.path.exists('/proc'):
+            return 0
+
+        children = {}
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            try:
+                with open('/proc/' + pid + '/stat') as stat_file:
+                    # the process name can contain spaces, fields after it are fixed
+                    ppid = int(stat_file.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(pid))
+
+        total_pages = 0
+        to_check = [self.process.pid]
+        while len(to_check) > 0:
+            pid = to_check.pop()
+            to_check += children.get(pid, [])
+            try:
+                with open('/proc/' + str(pid) + '/statm') as statm_file:
+                    total_pages += int(statm_file.read().split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+
+        return total_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
 def gen_flask_app():
 
     logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%Y/%m/%d %I:%M:%S %p',
@@ -333,31 +1083,119 @@ def gen_flask_app():
         except ValueError:
             pass
 
+    job_num = None
+    if 'PYMADA_JOB' in os.environ:
+        try:
+            job_num = int(os.environ['PYMADA_JOB'])
+        except ValueError:
+            pass
+
     auth_token = None
     if 'PYMADA_TOKEN_AUTH' in os.environ:
         auth_token = os.environ['PYMADA_TOKEN_AUTH']
 
-    if 'MASTER_URL' in os.environ:
-        agent = Agent(os.environ['MASTER_URL'], agent_url=agent_url, runner_num=runner_num, auth_token=auth_token)
-    else:
-        agent = Agent('http://localhost:8000', agent_url=agent_url, runner_num=runner_num, auth_token=auth_token)
+    persistent_runner = os.getenv('PYMADA_PERSISTENT_RUNNER', '').lower() in ('1', 'true', 'yes')
+
+    runner_max_tasks = 100
+    if 'PYMADA_RUNNER_MAX_TASKS' in os.environ:
+        try:
+            runner_max_tasks = int(os.environ['PYMADA_RUNNER_MAX_TASKS'])
+        except ValueError:
+            pass
+
+    runner_max_memory_mb = None
+    if 'PYMADA_RUNNER_MAX_MEMORY_MB' in os.environ:
+        try:
+            runner_max_memory_mb = float(os.environ['PYMADA_RUNNER_MAX_MEMORY_MB'])
+        except ValueError:
+            pass
+
+    num_slots = 1
+    if 'PYMADA_RUNNER_SLOTS' in os.environ:
+        try:
+            num_slots = max(int(os.environ['PYMADA_RUNNER_SLOTS']), 1)
+        except ValueError:
+            pass
+
+    dedup_urls = os.getenv('PYMADA_DEDUP_URLS', '').lower() in ('1', 'true', 'yes')
+
+    dedup_capacity = 1000000
+    if 'PYMADA_DEDUP_CAPACITY' in os.environ:
+        try:
+            dedup_capacity = int(os.environ['PYMADA_DEDUP_CAPACITY'])
+        except ValueError:
+            pass
+
+    add_url_batch_size = 100
+    if 'PYMADA_ADD_URL_BATCH_SIZE' in os.environ:
+        try:
+            add_url_batch_size = max(int(os.environ['PYMADA_ADD_URL_BATCH_SIZE']), 1)
+        except ValueError:
+            pass
+
+    add_url_flush_seconds = 1.0
+    if 'PYMADA_ADD_URL_FLUSH_SECONDS' in os.environ:
+        try:
+            add_url_flush_seconds = float(os.environ['PYMADA_ADD_URL_FLUSH_SECONDS'])
+        except ValueError:
+            pass
+
+    http_pool_size = num_slots * 2 + 2
+    if 'PYMADA_HTTP_POOL_SIZE' in os.environ:
+        try:
+            http_pool_size = int(os.environ['PYMADA_HTTP_POOL_SIZE'])
+        except ValueError:
+            pass
+
+    compress_requests = os.getenv('PYMADA_COMPRESS_REQUESTS', '').lower() in ('1', 'true', 'yes')
+
+    # the default is in the container's own filesystem, which kubernetes
+    # replaces when the container restarts. The agent pods mount an emptyDir
+    # volume for the spool instead (see kube.py), which lasts as long as the pod
+    spool_path = os.getenv('PYMADA_SPOOL_PATH', '/tmp/pymada_spool.sqlite3')
+
+    master_url = os.getenv('MASTER_URL', 'http://localhost:8000')
+    agent = Agent(master_url, agent_url=agent_url, runner_num=runner_num, auth_token=auth_token,
+                  persistent_runner=persistent_runner, runner_max_tasks=runner_max_tasks,
+                  runner_max_memory_mb=runner_max_memory_mb, num_slots=num_slots,
+                  dedup_urls=dedup_urls, dedup_capacity=dedup_capacity,
+                  add_url_batch_size=add_url_batch_size,
+                  add_url_flush_seconds=add_url_flush_seconds,
+                  http_pool_size=http_pool_size, compress_requests=compress_requests,
+                  spool_path=spool_path, job_num=job_num)
+
+    def request_slot():
+        '''
+        runners send their slot as a query parameter, runners from before
+        slots existed don't send one and are always in slot 0
+        '''
+        try:
+            slot = int(request.args.get('slot', 0))
+        except ValueError:
+            return 0
+
+        if slot < 0 or slot >= len(agent.slots):
+            return 0
+
+        return slot
 
     
     @flask_app.route('/get_task', methods=['POST'])
     def get_task():
-        return json.jsonify(agent.get_task())
+        return json.jsonify(agent.get_task(request_slot()))
     
     @flask_app.route('/save_results', methods=['POST'])
     def save_results():
         json_data = request.get_json()
-        response = agent.save_task_results(json_data)
+        response = agent.save_task_results(json_data, slot=request_slot())
 
         return json.jsonify(response)
     
     @flask_app.route('/save_screenshot', methods=['POST'])
     def save_screenshot():
         screenshot = request.files['screenshot']
-        response = agent.save_screenshot(screenshot.read(), screenshot.filename)
+        response = agent.save_screenshot(screenshot.read(), screenshot.filename,
+                                         slot=request_slot())
         return json.jsonify(response)
 
     @flask_app.route('/assign_runner', methods=['POST'])
@@ -375,7 +1213,8 @@ def gen_flask_app():
 
     @flask_app.route('/kill_run', methods=['POST'])
     def kill_runner():
-        kill_response = agent.kill_runner()
+        kill_data = request.get_json(silent=True) or {}
+        kill_response = agent.kill_runner(kill_data.get('slot'), kill_data.get('task_id'))
 
         if 'error' in kill_response:
             return json.jsonify(kill_response), 500
@@ -384,18 +1223,23 @@ def gen_flask_app():
 
     @flask_app.route('/check_runner', methods=['POST'])
     def check_runner():
-        status = agent.check_runner()
+        slots = agent.check_slots()
+        status = agent.check_runner(slots)
         if 'error' in status:
             return json.jsonify(status), 500
         else:
-            return json.jsonify({'status': status})
+            return json.jsonify({'status': status, 'slots': slots})
 
     @flask_app.route('/add_url', methods=['POST'])
     def add_url():
         url_data = request.get_json()
         logging.debug('new url to add' + str(url_data))
-        return json.jsonify(agent.add_url(url_data['url'], url_data['json_metadata']))
+        return json.jsonify(agent.add_url(url_data['url'], url_data.get('json_metadata')))
     
+    @flask_app.route('/connection_stats', methods=['GET'])
+    def connection_stats():
+        return json.jsonify(agent.connection_stats())
+
     @flask_app.route('/log_error', methods=['POST'])
     def log_error():
         err_info = request.get_json()
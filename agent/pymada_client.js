@@ -7,10 +7,18 @@ if ('AGENT_PORT' in process.env){
     exports.host = "http://localhost:5001";
 }
 
+// runner slot on the agent, set by the agent when it starts the runner
+exports.slot = process.env['PYMADA_SLOT'] || '0';
+
 exports.getTask = async function(){
-    const reqUrl = exports.host + '/get_task';
+    const reqUrl = exports.host + '/get_task?slot=' + exports.slot;
     let task_data = await rp({uri: reqUrl, method: 'POST', json: true});
 
+    // null when there are no more tasks leased to the agent
+    if (task_data === null){
+        return null;
+    }
+
     if (typeof(task_data['json_metadata']) == 'string'){
         try{
             task_data['json_metadata'] = JSON.parse(task_data['json_metadata']);
@@ -24,8 +32,20 @@ exports.getTask = async function(){
     return task_data;
 }
 
+// blocks until the agent has a task, for persistent runners that stay
+// running between tasks
+exports.waitForTask = async function(pollInterval=500){
+    while (true){
+        const task = await exports.getTask();
+        if (task !== null){
+            return task;
+        }
+        await new Promise(resolve => setTimeout(resolve, pollInterval));
+    }
+}
+
 exports.saveResult = async function(result){
-    const reqUrl = exports.host + '/save_results';
+    const reqUrl = exports.host + '/save_results?slot=' + exports.slot;
     const response = await rp({
         uri: reqUrl,
         method: 'POST',
@@ -39,7 +59,7 @@ exports.saveResult = async function(result){
 }
 
 exports.addUrl = async function(url, jsonMetadata=null){
-    const reqUrl = exports.host + '/add_url';
+    const reqUrl = exports.host + '/add_url?slot=' + exports.slot;
     const response = await rp({
         uri: reqUrl,
         method: 'POST',
@@ -53,7 +73,7 @@ exports.addUrl = async function(url, jsonMetadata=null){
 }
 
 exports.logError = async function(errorMsg){
-    const reqUrl = exports.host + '/log_error';
+    const reqUrl = exports.host + '/log_error?slot=' + exports.slot;
     const response = await rp({
         uri: reqUrl,
         method: 'POST',
@@ -67,7 +87,7 @@ exports.logError = async function(errorMsg){
 }
 
 exports.saveScreenshot = async function(screenshotPath){
-    const reqUrl = exports.host + '/save_screenshot';
+    const reqUrl = exports.host + '/save_screenshot?slot=' + exports.slot;
     const response = await rp({
         uri: reqUrl,
         method: 'POST',
@@ -1,9 +1,14 @@
 import requests
 import os
+import time
 
 class Client(object):
 
     def __init__(self, host_url=None):
+        # runner slot on the agent, set by the agent when it starts the runner
+        self.params = {'slot': os.getenv('PYMADA_SLOT', '0')}
+        self.session = requests.Session()
+
         if host_url is not None:
             self.host = host_url
             return
@@ -14,26 +19,47 @@ class Client(object):
         self.host = 'http://localhost:5001'
 
     def get_task(self):
+        '''
+        returns the current task, or the next task leased to the agent once
+        the result for the current one has been saved. None if there are
+        no more tasks.
+        '''
         req_url = self.host + '/get_task'
-        r = requests.post(req_url)
+        r = self.session.post(req_url, params=self.params)
         return r.json()
     
+    def wait_for_task(self, poll_interval=0.5):
+        '''
+        blocks until the agent has a task, for persistent runners that stay
+        running between tasks:
+
+            while True:
+                task = client.wait_for_task()
+                ...
+                client.save_result(result)
+        '''
+        while True:
+            task = self.get_task()
+            if task is not None:
+                return task
+            time.sleep(poll_interval)
+
     def save_result(self, result):
         req_url = self.host + '/save_results'
-        r = requests.post(req_url, json=result)
+        r = self.session.post(req_url, params=self.params, json=result)
         return r.json()
 
     def add_url(self, url, json_metadata=None):
         req_url = self.host + '/add_url'
-        r = requests.post(req_url, json={'url': url, 'json_metadata': json_metadata})
+        r = self.session.post(req_url, params=self.params, json={'url': url, 'json_metadata': json_metadata})
         return r.json()
 
     def log_error(self, err_msg):
         req_url = self.host + '/log_error'
-        r = requests.post(req_url, json={'message': err_msg})
+        r = self.session.post(req_url, params=self.params, json={'message': err_msg})
         return r.json()
     
     def save_screenshot(self, screenshot_path):
         req_url = self.host + '/save_screenshot'
-        r = requests.post(req_url, files={'screenshot': open(screenshot_path, 'rb')})
+        r = self.session.post(req_url, params=self.params, files={'screenshot': open(screenshot_path, 'rb')})
         return r.json()
\ No newline at end of file
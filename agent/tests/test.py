@@ -3,6 +3,11 @@ from unittest.mock import Mock, patch
 import agent_server
 import os
 import time
+import gzip
+import json
+import threading
+import http.server
+import tempfile
 
 class AgentTest(unittest.TestCase):
 
@@ -16,7 +21,7 @@ class AgentTest(unittest.TestCase):
         self.agent = agent_server.Agent(
             'http://127.0.0.1:8000', autoregister=False)
     
-    @patch('agent_server.requests.request')
+    @patch('agent_server.requests.Session.request')
     def test_get_runner(self, mock_post):
         mock_post.return_value.json.return_value = {
             'id': 1,
@@ -30,10 +35,337 @@ class AgentTest(unittest.TestCase):
         self.agent.get_runner(write_path=self.runner_path)
         assert os.path.exists(self.runner_path)
 
-        assert self.agent.runner is not None
+        assert self.agent.slots[0].runner is not None
 
         assert self.agent.check_runner() == 'IDLE'
 
+    @patch('agent_server.requests.Session.request')
+    def test_register_job(self, mock_request):
+        mock_request.return_value.json.return_value = {'id': 3, 'runner_num': 7, 'job': 2}
+
+        agent = agent_server.Agent('http://127.0.0.1:8000', autoregister=False, job_num=2)
+        agent.register_on_master(self_url='http://agent')
+
+        assert mock_request.call_args[1]['json']['job'] == 2
+        assert agent.registered_num == 3
+
+        # the agent runs the job's runner
+        mock_request.return_value.json.return_value = {
+            'id': 7, 'contents': 'print("job")', 'file_name': 'test_run_script.py',
+            'file_type': 'python_agent', 'custom_executable': None, 'dependency_file': None}
+        agent.get_runner(write_path=self.runner_path)
+        assert mock_request.call_args[0][1] == 'http://127.0.0.1:8000/runner/7/'
+
+    @patch('agent_server.requests.Session.request')
+    def test_runner_exited_starts_next_task(self, mock_request):
+        mock_request.return_value.ok = True
+        mock_request.return_value.json.return_value = {
+            'agent_state': 'ASSIGNED',
+            'slot': 0,
+            'tasks': [{'id': 2, 'url': 'http://test2'}]
+        }
+
+        slot = self.agent.slots[0]
+        self.agent.registered_num = 1
+        slot.runner = Mock()
+        slot.lease_task_ids = [1]
+
+        self.agent.runner_exited(0, 0)
+
+        sent = mock_request.call_args[1]['json']
+        assert sent == {'agent_state': 'IDLE', 'slot': 0, 'exit_code': 0, 'task_ids': [1]}
+        assert slot.task['id'] == 2
+        assert slot.lease_task_ids == [2]
+        assert not slot.reporting
+        slot.runner.run.assert_called_once()
+
+    def test_leased_tasks(self):
+        slot = self.agent.slots[0]
+        slot.runner = Mock()
+        self.agent.start_runner({'tasks': [{'id': 1}, {'id': 2}, {'id': 3}]})
+
+        assert self.agent.get_task()['id'] == 1
+        slot.runner.run.assert_called_once()
+
+        # runner that loops over tasks
+        slot.task = None
+        assert self.agent.get_task()['id'] == 2
+
+        # runner exits, the next process gets the next task in the lease
+        self.agent.runner_exited(0, 0)
+        assert self.agent.get_task()['id'] == 3
+        assert slot.leased_tasks == []
+        assert slot.runner.run.call_count == 2
+
+    def test_slots(self):
+        agent = agent_server.Agent('http://127.0.0.1:8000', autoregister=False, num_slots=2)
+        for slot in agent.slots:
+            slot.runner = Mock()
+            slot.runner.persistent = False
+            slot.runner.get_status.return_value = 'IDLE'
+
+        agent.start_runner({'slot': 1, 'tasks': [{'id': 5}]})
+        agent.slots[1].runner.get_status.return_value = 'RUNNING'
+
+        assert agent.get_task(0) is None
+        assert agent.get_task(1)['id'] == 5
+        agent.slots[0].runner.run.assert_not_called()
+
+        # the same lease sent again while the slot runs it is ignored
+        agent.get_task(1)['task_result'] = 'partial'
+        agent.start_runner({'slot': 1, 'tasks': [{'id': 5}]})
+        assert agent.get_task(1) == {'id': 5, 'task_result': 'partial'}
+        agent.slots[1].runner.run.assert_called_once()
+
+        slots = agent.check_slots()
+        assert [s['status'] for s in slots] == ['IDLE', 'RUNNING']
+        assert slots[1]['task_ids'] == [5]
+        assert agent.check_runner(slots) == 'IDLE'
+
+        agent.slots[0].runner.get_status.return_value = 'RUNNING'
+        assert agent.check_runner() == 'RUNNING'
+
+        # a kill for a task the slot isn't running any more is ignored
+        agent.kill_runner(1, task_id=4)
+        agent.slots[1].runner.kill.assert_not_called()
+
+        agent.kill_runner(1)
+        agent.slots[1].runner.kill.assert_called_once()
+        agent.slots[0].runner.kill.assert_not_called()
+
+    @patch('agent_server.requests.Session.request')
+    def test_add_url_dedup(self, mock_request):
+        mock_request.return_value.ok = True
+
+        agent = agent_server.Agent('http://127.0.0.1:8000', autoregister=False, dedup_urls=True,
+                                   dedup_capacity=1000, add_url_flush_seconds=60)
+        agent.url_flusher = Mock()
+        agent.add_url('http://example.com/a?y=1&x=2')
+
+        # same url after normalising, dropped without going in the buffer
+        assert agent.add_url('HTTP://example.com:80/a?x=2&y=1#part') == {'duplicate': True}
+        agent.add_url('http://example.com/b')
+
+        agent.flush_urls()
+        assert mock_request.call_count == 1
+        assert mock_request.call_args[0][1].endswith('/urls/?dedup=1')
+        assert len(mock_request.call_args[1]['json']) == 2
+
+    @patch('agent_server.requests.Session.request')
+    def test_add_url_batches(self, mock_request):
+        mock_request.return_value.ok = True
+        mock_request.return_value.status_code = 201
+
+        agent = agent_server.Agent('http://127.0.0.1:8000', autoregister=False,
+                                   add_url_batch_size=3, add_url_flush_seconds=60,
+                                   retry_policy=agent_server.RetryPolicy(max_tries=2))
+
+        # flushed here instead of in the background
+        agent.url_flusher = Mock()
+
+        for i in range(7):
+            assert agent.add_url('http://' + str(i), {'n': i}) == {'buffered': i + 1}
+        assert agent.url_flush_event.is_set()
+
+        # master down, urls are kept for the next flush
+        mock_request.side_effect = agent_server.requests.ConnectionError
+        with patch('agent_server.time.sleep'):
+            assert not agent.flush_urls()
+        assert len(agent.url_buffer) == 7
+
+        mock_request.side_effect = None
+        mock_request.reset_mock()
+        assert agent.flush_urls()
+        assert [len(c[1]['json']) for c in mock_request.call_args_list] == [3, 3, 1]
+        assert mock_request.call_args_list[0][1]['json'][0] == {
+            'url': 'http://0', 'json_metadata': '{"n": 0}'}
+        assert agent.url_buffer == []
+
+    @patch('agent_server.requests.Session.request')
+    def test_compress_requests(self, mock_request):
+        agent = agent_server.Agent('http://127.0.0.1:8000', autoregister=False,
+                                   compress_requests=True)
+
+        agent._request_master('/urls/', 'POST', json_data=[{'url': 'http://small'}])
+        assert mock_request.call_args[1]['json'] == [{'url': 'http://small'}]
+
+        large_data = [{'url': 'http://' + str(i)} for i in range(100)]
+        agent._request_master('/urls/', 'POST', json_data=large_data)
+        assert mock_request.call_args[1]['headers']['Content-Encoding'] == 'gzip'
+        assert json.loads(gzip.decompress(mock_request.call_args[1]['data'])) == large_data
+
+    def test_connection_reuse(self):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'{}')
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        agent = agent_server.Agent('http://127.0.0.1:' + str(server.server_address[1]),
+                                   autoregister=False)
+        for _ in range(5):
+            assert agent._request_master('/stats/', 'GET').ok
+
+        server.shutdown()
+        server.server_close()
+
+        assert agent.connection_stats() == {'requests': 5, 'connections': 1,
+                                            'reused_ratio': 0.8}
+
+    @patch('agent_server.time.sleep')
+    @patch('agent_server.requests.Session.request')
+    def test_result_spool(self, mock_request, mock_sleep):
+        agent = agent_server.Agent('http://127.0.0.1:8000', autoregister=False,
+                                   retry_policy=agent_server.RetryPolicy(max_tries=2))
+        agent.result_uploader = Mock()
+        slot = agent.slots[0]
+        slot.runner = Mock()
+        slot.runner.persistent = False
+        slot.runner.get_status.return_value = 'IDLE'
+
+        agent.start_runner({'tasks': [{'id': 1}, {'id': 2}]})
+        agent.save_task_results('result 1')
+        agent.get_task()
+        agent.save_task_results('result 2')
+
+        # master down, the results stay in the spool and the slot isn't idle
+        mock_request.side_effect = agent_server.requests.ConnectionError
+        assert not agent.upload_results()
+        assert agent.result_spool.pending(0) == 2
+        assert agent.check_slot(slot) == 'RUNNING'
+
+        agent.registered_num = 1
+        agent.runner_exited(0, 0)
+        assert agent.result_spool.pending(0) == 2
+
+        mock_request.side_effect = None
+        mock_request.return_value.status_code = 200
+        assert agent.upload_results()
+
+        # both results go in one request
+        args, kwargs = mock_request.call_args
+        assert args == ('POST', 'http://127.0.0.1:8000/urls/results/')
+        assert kwargs['json'] == {'results': [{'id': 1, 'task_result': 'result 1'},
+                                              {'id': 2, 'task_result': 'result 2'}]}
+        assert agent.result_spool.pending() == 0
+        assert agent.check_slot(slot) == 'IDLE'
+
+    @patch('agent_server.requests.Session.request')
+    def test_result_spool_on_disk(self, mock_request):
+        spool_path = os.path.join(tempfile.mkdtemp(), 'spool.sqlite3')
+
+        agent = agent_server.Agent('http://127.0.0.1:8000', autoregister=False,
+                                   spool_path=spool_path)
+        agent.result_uploader = Mock()
+        agent.slots[0].runner = Mock()
+        agent.slots[0].runner.persistent = False
+        agent.start_runner({'tasks': [{'id': 1}]})
+        agent.save_screenshot(b'png data', 'shot.png')
+        agent.save_task_results('result 1')
+        assert mock_request.call_count == 0
+
+        # a restarted agent sends what was spooled before it stopped without
+        # waiting for a new result
+        mock_request.return_value.status_code = 200
+        restarted = agent_server.Agent('http://127.0.0.1:8000', autoregister=False,
+                                       spool_path=spool_path)
+        restarted.slots[0].runner = Mock()
+        restarted.slots[0].runner.persistent = False
+        restarted.slots[0].runner.get_status.return_value = 'IDLE'
+        assert restarted.result_uploader is not None
+
+        for _ in range(100):
+            if restarted.result_spool.pending() == 0:
+                break
+            time.sleep(0.02)
+
+        screenshot_call, result_call = mock_request.call_args_list
+        assert screenshot_call[0][0] == 'POST'
+        assert screenshot_call[1]['files']['screenshot'] == ('shot.png', b'png data')
+        assert screenshot_call[1]['files']['task'] == ('', '1')
+        assert result_call[0][0] == 'POST'
+        assert result_call[1]['json']['results'] == [{'id': 1, 'task_result': 'result 1'}]
+        assert restarted.result_spool.pending() == 0
+        assert restarted.check_slots()[0]['status'] == 'IDLE'
+
+    @patch('agent_server.time.sleep')
+    def test_retry_policy(self, mock_sleep):
+        policy = agent_server.RetryPolicy(max_tries=4, base_delay=1, failure_threshold=6,
+                                          reset_seconds=60)
+        send_request = Mock(side_effect=agent_server.requests.ConnectionError)
+
+        with self.assertRaises(agent_server.requests.ConnectionError):
+            policy.call(send_request)
+        assert send_request.call_count == 4
+
+        # backoff is jittered and grows with each attempt
+        delays = [c[0][0] for c in mock_sleep.call_args_list]
+        assert all(0 <= d <= 2 ** (i + 1) for i, d in enumerate(delays))
+
+        # the circuit opens after failure_threshold failures in a row, then
+        # requests that can't wait for it to reset fail without being sent
+        with self.assertRaises(agent_server.CircuitOpenError):
+            policy.call(send_request, deadline_seconds=30)
+        assert send_request.call_count == 6
+
+        with self.assertRaises(agent_server.CircuitOpenError):
+            policy.call(send_request, deadline_seconds=1)
+        assert send_request.call_count == 6
+
+        policy.open_until = 0
+        send_request.side_effect = None
+        send_request.return_value.status_code = 200
+        assert policy.call(send_request).status_code == 200
+        assert policy.consecutive_failures == 0
+
+    def test_bloom_filter(self):
+        bloom = agent_server.BloomFilter(capacity=1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add('http://' + str(i))
+
+        assert all('http://' + str(i) in bloom for i in range(1000))
+        false_positives = sum(['http://other' + str(i) in bloom for i in range(10000)])
+        assert false_positives < 300
+
+    def test_persistent_runner_idle_between_tasks(self):
+        run_script = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                  'fake_runner_long.py')
+        slot = self.agent.slots[0]
+        slot.runner = agent_server.Runner(run_script, file_type='python_agent',
+                                          on_exit=lambda code: self.agent.runner_exited(0, code),
+                                          persistent=True)
+
+        self.agent.start_runner({'id': 1, 'url': 'http://test'})
+        assert self.agent.check_runner() == 'RUNNING'
+
+        self.agent.result_uploader = Mock()
+        self.agent.save_task_results({'some': 'result'})
+
+        # result not sent yet
+        assert self.agent.check_runner() == 'RUNNING'
+
+        with patch('agent_server.requests.Session.request') as mock_request:
+            mock_request.return_value.status_code = 200
+            assert self.agent.upload_results()
+
+        # process is still alive but waiting for the next task
+        assert slot.runner.get_status() == 'RUNNING'
+        assert self.agent.check_runner() == 'IDLE'
+        assert slot.runner.tasks_run == 1
+
+        slot.runner.stop()
+        assert slot.runner.process is None
+        assert self.agent.check_runner() == 'IDLE'
+
     '''
     def test_check_runner(self):
         assert self.agent.check_runner() == 'NO_RUNNER'
@@ -96,4 +428,36 @@ class RunnerTest(unittest.TestCase):
             seconds += 0.2
             if seconds > 2:
                 self.fail('fake runner took more than 2 seconds')
-    
\ No newline at end of file
+
+    def test_needs_recycle(self):
+        run_script = os.path.join(self.base_dir, 'fake_runner_long.py')
+        runner = agent_server.Runner(run_script, file_type='python_agent', persistent=True)
+        runner.run()
+
+        assert not runner.needs_recycle(max_tasks=2)
+        runner.tasks_run = 2
+        assert runner.needs_recycle(max_tasks=2)
+
+        if os.path.exists('/proc'):
+            assert runner.memory_usage_mb() > 0
+            assert runner.needs_recycle(max_memory_mb=0.001)
+
+        runner.stop()
+        assert runner.get_status() == self.states.IDLE
+
+    def test_on_exit(self):
+        run_script = os.path.join(self.base_dir, 'fake_runner.py')
+        exit_codes = []
+        runner = agent_server.Runner(run_script, file_type='python_agent',
+                                     on_exit=exit_codes.append)
+        runner.run()
+
+        seconds = 0.0
+        while runner.get_status() == self.states.RUNNING:
+            time.sleep(0.1)
+            seconds += 0.1
+            if seconds > 2:
+                self.fail('fake runner took more than 2 seconds')
+
+        assert exit_codes == [0]
+        assert runner.last_run_code == 0
@@ -3,12 +3,18 @@ from master_server import views
 
 urlpatterns = [
     path('urls/', views.UrlList.as_view()),
+    path('urls/bulk/', views.UrlBulk.as_view()),
+    path('urls/results/', views.UrlResults.as_view()),
     path('urls/<int:pk>/', views.UrlSingle.as_view()),
     path('url_tasks_length/', views.UrlListLength.as_view()),
     path('register_agent/', views.RegisterAgent.as_view()),
     path('agents/', views.ListAgents.as_view()),
+    path('agents/<int:pk>/state/', views.AgentStateReport.as_view()),
     path('register_runner/', views.RegisterRunner.as_view()),
     path('runner/<int:pk>/', views.RunnerSingle.as_view()),
+    path('jobs/', views.Jobs.as_view()),
+    path('jobs/<int:pk>/', views.JobSingle.as_view()),
+    path('jobs/<int:pk>/stats/', views.JobStats.as_view()),
     path('log_error/', views.ErrorLogs.as_view()),
     path('stats/', views.GetStats.as_view()),
     path('screenshots/', views.Screenshots.as_view()),
@@ -0,0 +1,214 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "api_server.settings")
+import django
+django.setup()
+from django.db import connection
+from master_server.models import UrlTask, Agent, TaskResult, DEFAULT_JOB_ID
+from master_server.serializers import UrlTaskSerializer
+from master_server import ingest, compression
+
+'''
+Benchmarks for the master server task queue. Each benchmark runs against a
+fresh test database (in memory for sqlite) so db.sqlite3 is never touched.
+
+usage: python benchmark.py claim --tasks 20000 --agents 100
+       python benchmark.py queue --tasks 1000000 --complete 0.9
+       python benchmark.py ingest --tasks 100000
+       python benchmark.py compression --tasks 2000
+'''
+
+def create_tasks(num_tasks, batch_size=10000, num_complete=0):
+    for start in range(0, num_tasks, batch_size):
+        end = min(start + batch_size, num_tasks)
+        UrlTask.objects.bulk_create(
+            [UrlTask(url='http://bench/' + str(i),
+                     task_state='COMPLETE' if i < num_complete else 'QUEUED')
+             for i in range(start, end)],
+            batch_size=batch_size)
+
+
+def create_agents(num_agents):
+    Agent.objects.bulk_create([Agent(hostname='bench', agent_url='http://bench:' + str(i),
+                                     last_contact_attempt=0)
+                               for i in range(num_agents)])
+    return list(Agent.objects.values_list('id', flat=True))
+
+
+def benchmark_claim(num_tasks, num_agents):
+    create_tasks(num_tasks)
+    agent_ids = create_agents(num_agents)
+
+    claimed = 0
+    claim_time = 0.0
+    for i in range(num_tasks):
+        agent_id = agent_ids[i % len(agent_ids)]
+
+        start = time.perf_counter()
+        tasks = UrlTask.objects.claim(agent_id)
+        claim_time += time.perf_counter() - start
+
+        if len(tasks) == 0:
+            break
+        claimed += 1
+
+        # free the agent again as if it had saved its result
+        UrlTask.objects.filter(pk=tasks[0].pk).update(task_state='COMPLETE')
+
+    print('claimed {} tasks in {:.2f}s ({:.0f} claims/sec)'.format(
+        claimed, claim_time, claimed / claim_time))
+
+
+def benchmark_queue(num_tasks, complete_fraction, num_pops):
+    '''
+    latency of popping the next task off the queue (the query claim runs)
+    with num_tasks rows in the table, complete_fraction of them already done
+    '''
+    start = time.perf_counter()
+    create_tasks(num_tasks, num_complete=int(num_tasks * complete_fraction))
+    print('created {} tasks in {:.1f}s'.format(num_tasks, time.perf_counter() - start))
+
+    print(UrlTask.objects.queued(DEFAULT_JOB_ID)[:1].explain())
+
+    latencies = []
+    for i in range(num_pops):
+        start = time.perf_counter()
+        task = UrlTask.objects.queued(DEFAULT_JOB_ID).first()
+        latencies.append(time.perf_counter() - start)
+
+        # take it off the queue so the next pop finds a different task
+        UrlTask.objects.filter(pk=task.pk).update(task_state='COMPLETE')
+
+    latencies.sort()
+    print('queue pop latency over {} pops: p50 {:.3f}ms, p99 {:.3f}ms, max {:.3f}ms'.format(
+        num_pops, latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.99)] * 1000, latencies[-1] * 1000))
+
+
+def benchmark_ingest(num_tasks):
+    '''
+    adding urls through the serializer (POST /urls/) compared to the bulk
+    ingest (POST /urls/bulk/)
+    '''
+    url_data = [{'url': 'http://bench/' + str(i), 'json_metadata': '{"i": ' + str(i) + '}'}
+                for i in range(num_tasks)]
+
+    start = time.perf_counter()
+    for i in range(0, num_tasks, 100):
+        serializer = UrlTaskSerializer(data=url_data[i:i + 100], many=True)
+        serializer.is_valid()
+        serializer.save()
+    serializer_time = time.perf_counter() - start
+
+    body_lines = [(json.dumps(u) + '\n').encode() for u in url_data]
+
+    start = time.perf_counter()
+    ingest.ingest(ingest.parse_ndjson(iter(body_lines)))
+    ingest_time = time.perf_counter() - start
+
+    print('serializer: {:.2f}s ({:.0f} urls/sec)'.format(serializer_time, num_tasks / serializer_time))
+    print('bulk ingest: {:.2f}s ({:.0f} urls/sec)'.format(ingest_time, num_tasks / ingest_time))
+
+
+def example_results(num_results):
+    '''
+    results like scrapers return: pages of html and lists of json records
+    '''
+    words = ['price', 'product', 'shipping', 'review', 'stock', 'colour', 'size',
+             'delivery', 'basket', 'account', 'search', 'offer']
+    results = []
+    for i in range(num_results):
+        if i % 2 == 0:
+            items = ''.join('<li class="item"><a href="/p/{}">{}</a><span>{:.2f}</span></li>'.format(
+                random.randint(1, 10 ** 6), ' '.join(random.choices(words, k=6)),
+                random.random() * 100) for _ in range(200))
+            results.append('<html><head><title>page {}</title></head><body><ul>{}</ul>'
+                           '</body></html>'.format(i, items))
+        else:
+            results.append(json.dumps([{'id': random.randint(1, 10 ** 6),
+                                        'name': ' '.join(random.choices(words, k=4)),
+                                        'price': round(random.random() * 100, 2),
+                                        'in_stock': random.random() > 0.5}
+                                       for _ in range(300)]))
+    return results
+
+
+def benchmark_compression(num_tasks):
+    '''
+    stored size and save/read throughput of task results with each codec
+    '''
+    results = example_results(num_tasks)
+    raw_size = sum(len(r.encode('utf-8')) for r in results)
+    create_tasks(num_tasks)
+    task_ids = list(UrlTask.objects.order_by('pk').values_list('pk', flat=True))
+
+    codecs = ['', 'gzip'] + (['zstd'] if compression.zstandard is not None else [])
+    print('{} results, {:.1f}MB uncompressed'.format(num_tasks, raw_size / 10 ** 6))
+
+    for codec in codecs:
+        os.environ['PYMADA_RESULT_COMPRESSION'] = codec
+
+        start = time.perf_counter()
+        for i in range(0, num_tasks, 100):
+            TaskResult.objects.save_results(dict(zip(task_ids[i:i + 100], results[i:i + 100])))
+        save_time = time.perf_counter() - start
+
+        stored_size = sum(len(r or '') + len(c or b'') for r, c in
+                          TaskResult.objects.values_list('result', 'compressed_result'))
+
+        start = time.perf_counter()
+        for task in UrlTask.objects.select_related('result').iterator():
+            task.task_result
+        read_time = time.perf_counter() - start
+
+        print('{:5} stored {:7.1f}MB ({:4.1f}x), save {:6.1f}MB/s, read {:6.1f}MB/s'.format(
+            codec or 'none', stored_size / 10 ** 6, raw_size / stored_size,
+            raw_size / save_time / 10 ** 6, raw_size / read_time / 10 ** 6))
+
+
+def run():
+    parser = argparse.ArgumentParser(description='pymada master benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    claim_parser = subparsers.add_parser('claim', help='task claiming throughput')
+    claim_parser.add_argument('--tasks', type=int, default=20000)
+    claim_parser.add_argument('--agents', type=int, default=100)
+
+    queue_parser = subparsers.add_parser('queue', help='queue pop latency')
+    queue_parser.add_argument('--tasks', type=int, default=1000000)
+    queue_parser.add_argument('--complete', type=float, default=0.5,
+                              help='fraction of the tasks that are already complete')
+    queue_parser.add_argument('--pops', type=int, default=1000)
+
+    ingest_parser = subparsers.add_parser('ingest', help='adding urls')
+    ingest_parser.add_argument('--tasks', type=int, default=100000)
+
+    compression_parser = subparsers.add_parser('compression', help='task result compression')
+    compression_parser.add_argument('--tasks', type=int, default=2000)
+
+    args = parser.parse_args()
+    if args.benchmark is None:
+        parser.print_help()
+        sys.exit(1)
+
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        if args.benchmark == 'claim':
+            benchmark_claim(args.tasks, args.agents)
+        elif args.benchmark == 'queue':
+            benchmark_queue(args.tasks, args.complete, args.pops)
+        elif args.benchmark == 'ingest':
+            benchmark_ingest(args.tasks)
+        elif args.benchmark == 'compression':
+            benchmark_compression(args.tasks)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    run()
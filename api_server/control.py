@@ -1,61 +1,170 @@
 import os
 import time
+import heapq
 import subprocess
 import logging
 import asyncio
-import requests
 import aiohttp
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "api_server.settings")
 import django
 django.setup()
-from master_server.models import UrlTask, Agent
-from master_server.serializers import UrlTaskSerializer
+from master_server.models import UrlTask, Agent, AgentSlot, TaskCounter, SpeculativeRun
+from master_server import task_queue
 from django.contrib.auth.models import User
 from asgiref.sync import sync_to_async
 loop = asyncio.get_event_loop()
 
 class Control:
 
-    def __init__(self, max_task_duration_seconds=60*5, max_task_retries=3):
+    def __init__(self, max_task_duration_seconds=60*5, max_task_retries=3,
+                 idle_check_interval=2, running_check_interval=30,
+                 max_concurrent_checks=50):
         self.max_duration_seconds = max_task_duration_seconds
         self.max_task_retries = max_task_retries
+        self.idle_check_interval = idle_check_interval
+        self.running_check_interval = running_check_interval
+        self.max_concurrent_checks = max_concurrent_checks
         self.aiosession = None
-        self.assign_locked = False
 
-        self.agents_being_checked = []
+        self.agents_being_checked = set()
+
+        # heap of (check time, agent id) entries. only the entry matching
+        # self.next_check[agent_id] is live, any other entry for the same
+        # agent is stale and gets skipped when it is popped
+        self.check_heap = []
+        self.next_check = {}
+        self.checks_in_progress = set()
+        self.pending_rechecks = set()
+        self.wakeup = None
+        self.check_semaphore = None
 
     @sync_to_async
     def check_for_new_agents(self):
-        agents = Agent.objects.filter()
-        for agent in agents:
-            if agent.id not in self.agents_being_checked:
-                self.agents_being_checked.append(agent.id)
-                loop.create_task(self.check_agent(agent.id))
+        return list(Agent.objects.values_list('id', flat=True))
+
+    async def add_new_agents(self):
+        for agent_id in await self.check_for_new_agents():
+            if agent_id not in self.agents_being_checked:
+                self.agents_being_checked.add(agent_id)
+                self.schedule_check(agent_id)
+
+    def schedule_check(self, agent_id, delay=0):
+        '''
+        Schedule a check of the agent in delay seconds. If a check is
+        already scheduled sooner than that, the sooner check is kept.
+        '''
+        check_time = time.time() + delay
+
+        current_check_time = self.next_check.get(agent_id)
+        if current_check_time is not None and current_check_time <= check_time:
+            return
 
-        return agents
+        self.next_check[agent_id] = check_time
+        heapq.heappush(self.check_heap, (check_time, agent_id))
+
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def remove_agent(self, agent_id):
+        '''
+        stops checking an agent that has been deleted. Its entries left in
+        the heap are skipped, as they're not in next_check.
+        '''
+        logging.info('agent ' + str(agent_id) + ' was deleted, no longer checking it')
+
+        self.agents_being_checked.discard(agent_id)
+        self.pending_rechecks.discard(agent_id)
+        self.next_check.pop(agent_id, None)
+
+    def pop_due_checks(self, now=None):
+        if now is None:
+            now = time.time()
+
+        due = []
+        while len(self.check_heap) > 0 and self.check_heap[0][0] <= now:
+            check_time, agent_id = heapq.heappop(self.check_heap)
+
+            if self.next_check.get(agent_id) != check_time:
+                continue
+
+            del self.next_check[agent_id]
+
+            if agent_id in self.checks_in_progress:
+                self.pending_rechecks.add(agent_id)
+                continue
+
+            due.append(agent_id)
+
+        return due
+
+    def next_check_interval(self, agent_state, task_time_left=None):
+        if agent_state == 'LOST':
+            return self.running_check_interval
+
+        if agent_state != 'RUNNING':
+            return self.idle_check_interval
+
+        if task_time_left is None:
+            return self.running_check_interval
+
+        # check again right when the task hits its duration limit
+        return max(min(self.running_check_interval, task_time_left), 0.1)
+
+    async def supervise(self):
+        self.wakeup = asyncio.Event()
+        self.check_semaphore = asyncio.Semaphore(self.max_concurrent_checks)
 
-    async def check_agent(self, agent_id):
         while True:
-            loop.create_task(self.check_status(agent_id))
-            loop.create_task(self.check_task_duration(agent_id))
+            for agent_id in self.pop_due_checks():
+                self.checks_in_progress.add(agent_id)
+                loop.create_task(self.check_agent(agent_id))
+
+            timeout = None
+            if len(self.check_heap) > 0:
+                timeout = max(self.check_heap[0][0] - time.time(), 0)
 
-            await asyncio.sleep(2)
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def check_agent(self, agent_id):
+        next_interval = self.idle_check_interval
+        try:
+            async with self.check_semaphore:
+                agent_state = await self.check_status(agent_id)
+                task_time_left = await self.check_task_duration(agent_id)
+                next_interval = self.next_check_interval(agent_state, task_time_left)
+        except Agent.DoesNotExist:
+            next_interval = None
+        except Exception:
+            logging.exception('error checking agent ' + str(agent_id))
+        finally:
+            self.checks_in_progress.discard(agent_id)
+
+            if next_interval is None:
+                self.remove_agent(agent_id)
+            else:
+                if agent_id in self.pending_rechecks:
+                    self.pending_rechecks.discard(agent_id)
+                    next_interval = 0
+
+                self.schedule_check(agent_id, next_interval)
     
     async def run(self):
+        loop.create_task(self.supervise())
+
         while True:
-            await self.check_for_new_agents()
+            await self.add_new_agents()
+            await self.kill_lost_copies()
             await asyncio.sleep(3)
 
-    async def assign_task(self, agent_id):
-        while self.assign_locked == True:
-            await asyncio.sleep(0.05)
-
-        self.assign_locked = True
-        task_data = await find_assign_task(agent_id)
-        self.assign_locked = False
+    async def assign_task(self, agent_id, slot=0):
+        task_data = await find_assign_task(agent_id, slot)
 
         if task_data is None:
-            return
+            return False
 
         response, code = await self._send_request(
             agent_id, '/start_run',
@@ -63,79 +172,121 @@ class Control:
 
         if code != 200 or code is None:
             logging.error('error from assigning task ' + str(response))
-            await remove_assigned_task(agent_id)
-            await update_agent_state(agent_id, 'LOST')
-            return
+            await remove_assigned_task(agent_id, slot)
+            return False
 
-        logging.info('agent ' + str(agent_id) + ' assigned task ' + str(task_data['id']))
+        logging.info('agent ' + str(agent_id) + ' slot ' + str(slot) + ' assigned tasks ' +
+            ', '.join([str(t['id']) for t in task_data['tasks']]))
+        return True
 
     
     async def check_status(self, agent_id):
         logging.debug('checking status of ' + str(agent_id))
 
-        response, code = await self._send_request(agent_id, '/check_runner')
+        agent_url, agent_state = await get_agent_url_state(agent_id)
+        response, code = await self._send_request(agent_id, '/check_runner',
+                                                  agent_url=agent_url)
 
-        if code == 200:
-            accepted_states = ('IDLE', 'RUNNING', 'NO_RUNNER')
-            response_status = str(response['status'])
-            logging.debug('agent ' + str(agent_id) + ' reported state: ' + response_status)
-
-            agent_state = await get_agent_state(agent_id)
-            if agent_state != response_status and response_status in accepted_states:
-                logging.info('agent ' + str(agent_id) + ' old state ' +
-                    str(agent_state) + ' new state ' + response_status)
+        if code != 200:
+            logging.warning('changing status of ' + str(agent_id) + ' to LOST')
+            await update_agent_contact(agent_id, 'LOST')
+            return 'LOST'
 
-                await update_agent_state(agent_id, response_status)
+        accepted_states = ('IDLE', 'RUNNING', 'NO_RUNNER')
+        response_status = str(response['status'])
+        logging.debug('agent ' + str(agent_id) + ' reported state: ' + response_status)
 
-                if response_status == 'IDLE':
-                    await self.check_for_failed_task(agent_id)
-                    await self.assign_task(agent_id)
+        if agent_state != response_status and response_status in accepted_states:
+            logging.info('agent ' + str(agent_id) + ' old state ' +
+                str(agent_state) + ' new state ' + response_status)
 
+            await update_agent_contact(agent_id, response_status)
+            agent_state = response_status
         else:
-            logging.warning('changing status of ' + str(agent_id) + ' to LOST')
-            await update_agent_state(agent_id, 'LOST')
-            
-        await update_agent_last_contact(agent_id)
-    
-    async def check_task_duration(self, agent_id):
+            await update_agent_contact(agent_id)
 
-        assigned_task_id = await get_agent_assigned_task(agent_id)
-        if assigned_task_id is None:
-            return
+        # agents with a single runner slot may only report the overall status
+        slots = response.get('slots', [{'slot': 0, 'status': response_status}])
 
-        task_start_time = await get_task_start_time(assigned_task_id)
-        if time.time() - task_start_time > self.max_duration_seconds:
-            logging.info('task ' + str(assigned_task_id) + ' (agent: ' 
-                + str(agent_id) + ') taking too long')
-            await self.terminate_task(agent_id)
+        assigned = False
+        slot_states = {}
+        for slot in slots:
+            slot_states[slot['slot']] = slot['status']
+            if slot['status'] != 'IDLE':
+                continue
 
-    async def check_for_failed_task(self, agent_id):
-        assigned_task_id = await get_agent_assigned_task(agent_id)
-        if assigned_task_id is None:
-            return
+            await self.check_for_failed_task(agent_id, slot['slot'], slot.get('task_ids'))
+            if await self.assign_task(agent_id, slot['slot']):
+                slot_states[slot['slot']] = 'RUNNING'
+                assigned = True
 
-        if await get_task_state(assigned_task_id) != 'ASSIGNED':
-            return
+        await report_slot_states(agent_id, slot_states)
 
-        logging.info('task {} was assigned to agent {} but no results were returned'.format(
-            assigned_task_id, agent_id))
-        
-        await fail_task(agent_id, assigned_task_id, self.max_task_retries)
+        if assigned:
+            agent_url, agent_state = await get_agent_url_state(agent_id)
 
-    async def terminate_task(self, agent_id):
-        response, _ = await self._send_request(
-            agent_id, '/kill_run')
+        return agent_state
+    
+    async def check_task_duration(self, agent_id):
+        '''
+        Terminates runner slots on the agent whose task has gone over the
+        duration limit. Returns the seconds left before the next task hits
+        the limit or None if there are no running tasks.
+        '''
+        time_left = None
+        for slot, start_time in await get_agent_task_start_times(agent_id):
+            slot_time_left = start_time + self.max_duration_seconds - time.time()
+
+            if slot_time_left < 0:
+                logging.info('task assigned to agent ' + str(agent_id) + ' slot ' +
+                             str(slot) + ' taking too long')
+                await self.terminate_task(agent_id, slot)
+                continue
+
+            if time_left is None or slot_time_left < time_left:
+                time_left = slot_time_left
+
+        return time_left
+
+    async def kill_lost_copies(self):
+        '''
+        Kills the runner slots still running a copy of a task that another
+        copy already saved the result for (see task_queue.find_speculative_task).
+        '''
+        for agent_id, slot, task_id in await lost_speculative_runs():
+            logging.info('killing the copy of task ' + str(task_id) + ' on agent ' +
+                         str(agent_id) + ' slot ' + str(slot))
+            await self.terminate_task(agent_id, slot, task_id)
+
+    async def check_for_failed_task(self, agent_id, slot=None, task_ids=None):
+        await fail_unreturned_task(agent_id, self.max_task_retries, slot, task_ids)
+
+    async def terminate_task(self, agent_id, slot=0, task_id=None):
+        '''
+        kills the runner in the slot, with task_id only if it's still running
+        that task
+        '''
+        kill_data = {'slot': slot}
+        if task_id is not None:
+            kill_data['task_id'] = task_id
+
+        response, _ = await self._send_request(agent_id, '/kill_run', json_data=kill_data)
 
         if type(response) is dict:
             if 'error' in response:
                 logging.error(response['error'])
 
-    async def _send_request(self, agent_id: int, url_path: str, json_data: dict = None):
+    async def _send_request(self, agent_id: int, url_path: str, json_data: dict = None,
+                            agent_url: str = None):
 
         if self.aiosession is None:
-            self.aiosession = aiohttp.ClientSession()
+            self.aiosession = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=30))
+
+        if agent_url is None:
+            agent_url = await get_agent_url(agent_id)
 
-        req_url = await get_agent_url(agent_id) + url_path
+        req_url = agent_url + url_path
 
         try:
             async with self.aiosession.post(req_url, json=json_data) as res:
@@ -144,118 +295,55 @@ class Control:
                     return (json_response, res.status)
                 else:
                     return (None, res.status)
-        except aiohttp.ServerConnectionError:
+        except (aiohttp.ClientError, asyncio.TimeoutError):
             logging.warning('unable to contact ' + req_url)
             return (None, None)
 
 
-@sync_to_async
-def find_assign_task(agent_id):
-    try:
-        task = UrlTask.objects.filter(
-            task_state='QUEUED').order_by('fail_num')[0]
-    except IndexError:
-        return
-    
-    logging.info('assigning ' + str(task.id) + ' to agent '
-        + str(agent_id))
-    
-    task_data = UrlTaskSerializer(task).data
+find_assign_task = sync_to_async(task_queue.find_assign_task)
+fail_task = sync_to_async(task_queue.fail_task)
+fail_unreturned_task = sync_to_async(task_queue.fail_unreturned_task)
+lost_speculative_runs = sync_to_async(task_queue.lost_speculative_runs)
+report_slot_states = sync_to_async(AgentSlot.objects.report)
 
-    agent = Agent.objects.get(pk=agent_id)
+@sync_to_async
+def remove_assigned_task(agent_id, slot=None):
+    num_removed = UrlTask.objects.leased(agent_id, slot).update(task_state='QUEUED',
+                                                                assigned_agent=None, start_time=0)
+    TaskCounter.objects.move('ASSIGNED', 'QUEUED', num_removed)
+    Agent.objects.filter(pk=agent_id).update(assigned_task=None, agent_state='LOST')
 
-    task.assigned_agent = agent
-    task.task_state = 'ASSIGNED'
-    task.start_time = time.time()
-    task.save()
+    speculative_runs = SpeculativeRun.objects.filter(agent=agent_id)
+    if slot is not None:
+        speculative_runs = speculative_runs.filter(slot=slot)
+    speculative_runs.update(running=False)
 
-    agent.agent_state = 'ASSIGNED'
-    agent.assigned_task = task
-    agent.save()
 
-    return task_data
-    
 @sync_to_async
-def remove_assigned_task(agent_id):
-    agent = Agent.objects.get(pk=agent_id)
-
-    if agent.assigned_task is None:
-        return
-    
-    task = agent.assigned_task
-    task.assigned_agent = None
-    task.task_state = 'QUEUED'
-    task.save()
-
-    agent.assigned_task = None
-    agent.agent_state = 'LOST'
-    agent.start_time = 0
-    agent.save()
+def update_agent_contact(agent_id, new_state=None):
+    updates = {'last_contact_attempt': time.time()}
+    if new_state is not None:
+        updates['agent_state'] = new_state
 
+    Agent.objects.filter(pk=agent_id).update(**updates)
 
 @sync_to_async
-def update_agent_state(agent_id, new_state):
-    agent = Agent.objects.get(pk=agent_id)
-    agent.agent_state = new_state
-    agent.save()
+def get_agent_url_state(agent_id):
+    return Agent.objects.values_list('agent_url', 'agent_state').get(pk=agent_id)
 
 @sync_to_async
-def update_agent_last_contact(agent_id):
-
-    agent = Agent.objects.get(pk=agent_id)
-    agent.last_contact_attempt = time.time()
-    agent.save()
+def get_agent_task_start_times(agent_id):
+    # copies of tasks running on the agent have the same duration limit
+    return list(UrlTask.objects.leased(agent_id).filter(start_time__gt=0).values_list(
+        'assigned_slot', 'start_time')) + list(SpeculativeRun.objects.filter(
+            agent=agent_id, running=True, task__task_state='ASSIGNED').values_list(
+                'slot', 'start_time'))
 
 @sync_to_async
 def get_agent_url(agent_id):
     agent = Agent.objects.get(pk=agent_id)
     return agent.agent_url
 
-@sync_to_async
-def get_agent_state(agent_id):
-    agent = Agent.objects.get(pk=agent_id)
-    return agent.agent_state
-
-@sync_to_async
-def get_agent_assigned_task(agent_id):
-    agent = Agent.objects.get(pk=agent_id)
-
-    if agent.assigned_task == None:
-        return None
-    
-    assigned_task_id = agent.assigned_task.id
-
-    return assigned_task_id
-
-@sync_to_async
-def get_task_start_time(task_id):
-    task = UrlTask.objects.get(pk=task_id)
-    return task.start_time
-
-@sync_to_async
-def get_task_state(task_id):
-    task = UrlTask.objects.get(pk=task_id)
-    return task.task_state
-
-@sync_to_async
-def fail_task(agent_id, task_id, max_task_retries):
-    agent = Agent.objects.get(pk=agent_id)
-    assigned_task = UrlTask.objects.get(pk=task_id)
-
-    assigned_task.fail_num += 1
-    assigned_task.start_time = 0
-
-    if assigned_task.fail_num >= max_task_retries:
-        assigned_task.task_state = 'COMPLETE'
-    else:
-        assigned_task.task_state = 'QUEUED'
-
-    assigned_task.assigned_agent = None
-    agent.assigned_task = None
-    assigned_task.save()
-    agent.save()
-
-
 def run():
     logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%Y/%m/%d %I:%M:%S %p',
         level=os.getenv('LOG_LEVEL', 'INFO'))
@@ -265,10 +353,7 @@ def run():
     except TypeError:
         max_duration = 60*5
 
-    try:
-        max_retries = int(os.getenv('PYMADA_MAX_TASK_RETRIES'))
-    except TypeError:
-        max_retries = 3
+    max_retries = task_queue.get_max_task_retries()
 
     controller = Control(max_task_duration_seconds=max_duration,
                          max_task_retries=max_retries)
@@ -276,6 +361,9 @@ def run():
     # create a default user for use for the token auth
     if len(User.objects.filter(username='pymadauser')) == 0:
         User.objects.create_user('pymadauser',None,None)
+
+    if TaskCounter.objects.enabled():
+        TaskCounter.objects.rebuild()
     
     command = ["uvicorn", "--host", "0.0.0.0", "--port", "8000", "api_server.asgi:application"]
     file_dir = os.path.dirname(os.path.realpath(__file__))
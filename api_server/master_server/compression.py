@@ -0,0 +1,72 @@
+import os
+import gzip
+import logging
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+'''
+Compression of stored task results. Set PYMADA_RESULT_COMPRESSION to gzip or
+zstd (needs the zstandard package) to compress results from
+min_compress_size bytes up. Each TaskResult records the codec it was stored
+with, so the setting can be changed at any time.
+'''
+
+min_compress_size = 1024
+
+
+def get_result_codec():
+    codec = os.getenv('PYMADA_RESULT_COMPRESSION', '').lower()
+
+    if codec == 'zstd' and zstandard is None:
+        logging.warning('zstandard is not installed, compressing results with gzip')
+        return 'gzip'
+
+    if codec not in ('gzip', 'zstd'):
+        return ''
+
+    return codec
+
+
+def compress(data, codec):
+    if codec == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(data)
+
+    raise ValueError('unknown codec ' + codec)
+
+
+def decompress(data, codec):
+    if codec == 'gzip':
+        return gzip.decompress(data)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstandard needs to be installed to read zstd compressed results')
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    raise ValueError('unknown codec ' + codec)
+
+
+def encode_result(task_result, codec=None):
+    '''
+    returns (result, compressed_result, codec) to store for task_result, the
+    result is left as text if it's small or compression is off
+    '''
+    if codec is None:
+        codec = get_result_codec()
+
+    data = task_result.encode('utf-8')
+    if codec == '' or len(data) < min_compress_size:
+        return task_result, None, ''
+
+    return None, compress(data, codec), codec
+
+
+def decode_result(result, compressed_result, codec):
+    if not codec:
+        return result
+
+    return decompress(bytes(compressed_result), codec).decode('utf-8')
@@ -0,0 +1,211 @@
+import csv
+import json
+import hashlib
+import urllib.parse
+from django.db import transaction, IntegrityError
+from master_server.models import (UrlTask, TaskCounter, TaskResult, Job, HostBucket,
+                                  DEFAULT_JOB_ID, url_host)
+
+'''
+Adding urls in bulk and without duplicates.
+
+The /urls/bulk/ request bodies are parsed a line at a time and the tasks are
+written with bulk_create in batches, so memory use stays the same however
+many urls are sent.
+'''
+
+max_reported_errors = 20
+
+
+def normalize_url(url):
+    '''
+    normalised form of a url for finding duplicates: lowercase scheme and
+    host, no default port or fragment and the query parameters sorted
+    '''
+    parts = urllib.parse.urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+
+    if ((scheme == 'http' and netloc.endswith(':80')) or
+            (scheme == 'https' and netloc.endswith(':443'))):
+        netloc = netloc.rsplit(':', 1)[0]
+
+    query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(parts.query,
+                                                                 keep_blank_values=True)))
+
+    return urllib.parse.urlunsplit((scheme, netloc, parts.path or '/', query, ''))
+
+
+def url_hash(url):
+    return hashlib.sha256(normalize_url(url).encode('utf-8')).hexdigest()
+
+
+def create_deduplicated(validated_rows):
+    '''
+    creates a task for each row (validated UrlTaskSerializer data) whose url
+    isn't already queued or done, comparing normalised urls. Only urls added
+    with dedup on are compared. Returns the created tasks.
+    '''
+    url_tasks_by_hash = {}
+    for row in validated_rows:
+        row_hash = url_hash(row['url'])
+        if row_hash not in url_tasks_by_hash:
+            url_tasks_by_hash[row_hash] = UrlTask(url_hash=row_hash, host=url_host(row['url']),
+                                                  **row)
+
+    existing_hashes = set(UrlTask.objects.filter(url_hash__in=list(url_tasks_by_hash)).values_list(
+        'url_hash', flat=True))
+    new_url_tasks = [t for h, t in url_tasks_by_hash.items() if h not in existing_hashes]
+
+    try:
+        with transaction.atomic():
+            UrlTask.objects.bulk_create(new_url_tasks, batch_size=500)
+    except IntegrityError:
+        # another request added some of the urls since the check above. The
+        # rows are added one at a time to find out which, so only the tasks
+        # this request created are returned (and counted).
+        inserted_tasks = []
+        for url_task in new_url_tasks:
+            url_task.pk = None
+            try:
+                with transaction.atomic():
+                    UrlTask.objects.bulk_create([url_task])
+                inserted_tasks.append(url_task)
+            except IntegrityError:
+                continue
+        new_url_tasks = inserted_tasks
+
+    created_tasks = list(UrlTask.objects.filter(
+        url_hash__in=[t.url_hash for t in new_url_tasks]).order_by('id'))
+
+    task_results = {}
+    for task in created_tasks:
+        url_task = url_tasks_by_hash[task.url_hash]
+        if getattr(url_task, '_task_result_changed', False):
+            task_results[task.pk] = url_task.task_result
+
+    if len(task_results) > 0:
+        TaskResult.objects.save_results(task_results)
+
+    return created_tasks
+
+
+def parse_ndjson(lines):
+    '''
+    lines is an iterator over the lines (bytes) of the request body. yields
+    (line_num, row) for each line of {"url": ..., "json_metadata": ...}
+    objects, row is None if the line couldn't be parsed
+    '''
+    for line_num, line in enumerate(lines, 1):
+        line = line.strip()
+        if len(line) == 0:
+            continue
+
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield line_num, None
+            continue
+
+        if type(row) is not dict:
+            row = None
+
+        yield line_num, row
+
+
+def parse_csv(lines):
+    '''
+    yields (line_num, row) for each row of a csv with a header row containing
+    "url" and optionally "json_metadata", "job" and "priority", row is None if
+    it isn't valid utf-8
+    '''
+    # bytes that aren't utf-8 are kept as surrogates, so a bad row is skipped
+    # like any other invalid row instead of failing the rows after it
+    reader = csv.DictReader(line.decode('utf-8', 'surrogateescape') for line in lines)
+    for row in reader:
+        try:
+            for value in row.values():
+                if type(value) is str:
+                    value.encode('utf-8')
+        except UnicodeEncodeError:
+            row = None
+
+        yield reader.line_num, row
+
+
+def to_int(value, default):
+    if value is None or value == '':
+        return default
+
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_url_task(row, job_ids):
+    '''
+    the task for a row, or None if it isn't valid. job_ids is the set of
+    existing job ids.
+    '''
+    if row is None:
+        return None
+
+    url = row.get('url')
+    if type(url) is not str or len(url.strip()) == 0:
+        return None
+
+    json_metadata = row.get('json_metadata')
+    if type(json_metadata) in (dict, list):
+        json_metadata = json.dumps(json_metadata)
+    elif json_metadata == '':
+        json_metadata = None
+
+    job_id = to_int(row.get('job'), DEFAULT_JOB_ID)
+    priority = to_int(row.get('priority'), 0)
+    if job_id not in job_ids or priority is None:
+        return None
+
+    url = url.strip()
+    return UrlTask(url=url, json_metadata=json_metadata, job_id=job_id, priority=priority,
+                   host=url_host(url))
+
+
+def create_url_tasks(url_tasks):
+    with transaction.atomic():
+        UrlTask.objects.bulk_create(url_tasks, batch_size=len(url_tasks))
+        TaskCounter.objects.add(urls=len(url_tasks), QUEUED=len(url_tasks))
+        HostBucket.objects.register(t.host for t in url_tasks)
+
+
+def ingest(rows, batch_size=5000):
+    '''
+    creates a queued task for each row from parse_ndjson or parse_csv.
+    Returns the number of tasks created and the number of rows that were
+    skipped as invalid, with the line numbers of the first of them.
+    '''
+    num_created = 0
+    error_lines = []
+    num_errors = 0
+    url_tasks = []
+    job_ids = set(Job.objects.values_list('pk', flat=True))
+
+    for line_num, row in rows:
+        url_task = to_url_task(row, job_ids)
+        if url_task is None:
+            num_errors += 1
+            if len(error_lines) < max_reported_errors:
+                error_lines.append(line_num)
+            continue
+
+        url_tasks.append(url_task)
+        if len(url_tasks) >= batch_size:
+            create_url_tasks(url_tasks)
+            num_created += len(url_tasks)
+            url_tasks = []
+
+    if len(url_tasks) > 0:
+        create_url_tasks(url_tasks)
+        num_created += len(url_tasks)
+
+    return {'created': num_created, 'errors': num_errors, 'error_lines': error_lines}
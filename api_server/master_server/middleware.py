@@ -0,0 +1,51 @@
+import io
+import zlib
+from django.http import JsonResponse
+from master_server.compression import zstandard
+
+decompress_errors = (zlib.error,) if zstandard is None else (zlib.error, zstandard.ZstdError)
+
+
+class GzipRequestMiddleware(object):
+    '''
+    Decompresses request bodies sent with "Content-Encoding: gzip" (or zstd
+    if the zstandard package is installed), agents compress their requests
+    when PYMADA_COMPRESS_REQUESTS is set.
+    '''
+    max_body_size = 100 * 1024 * 1024
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        content_encoding = request.META.get('HTTP_CONTENT_ENCODING', '').lower()
+
+        if content_encoding == 'gzip' or (content_encoding == 'zstd' and zstandard is not None):
+            try:
+                body = self.decompress(request.read(), content_encoding)
+            except decompress_errors:
+                return JsonResponse({'error': 'invalid ' + content_encoding + ' request body'},
+                                    status=400)
+
+            if len(body) > self.max_body_size:
+                return JsonResponse({'error': 'request body too large'}, status=413)
+
+            request._body = body
+            request._stream = io.BytesIO(body)
+            request.META['CONTENT_LENGTH'] = str(len(body))
+            del request.META['HTTP_CONTENT_ENCODING']
+
+        return self.get_response(request)
+
+    def decompress(self, body, content_encoding):
+        '''
+        decompresses up to one byte more than max_body_size, so a body that
+        expands to more than that can be turned away without decompressing
+        all of it
+        '''
+        if content_encoding == 'zstd':
+            return zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body)).read(
+                self.max_body_size + 1)
+
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return decompressor.decompress(body, self.max_body_size + 1)
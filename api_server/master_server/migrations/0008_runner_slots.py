@@ -0,0 +1,23 @@
+# Generated by Django 3.2 on 2026-10-17 14:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('master_server', '0007_agent_assigned_task'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='agent',
+            name='capacity',
+            field=models.IntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='urltask',
+            name='assigned_slot',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2 on 2026-10-17 15:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('master_server', '0008_runner_slots'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='urltask',
+            index=models.Index(fields=['task_state', 'fail_num', 'id'], name='urltask_queue_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='urltask',
+            index=models.Index(fields=['assigned_agent', 'task_state'], name='urltask_agent_state_idx'),
+        ),
+    ]
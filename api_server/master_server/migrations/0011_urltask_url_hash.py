@@ -0,0 +1,18 @@
+# Generated by Django 3.2 on 2026-10-17 15:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('master_server', '0010_task_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='urltask',
+            name='url_hash',
+            field=models.CharField(max_length=64, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 3.2 on 2026-10-17 15:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def move_task_results(apps, schema_editor):
+    UrlTask = apps.get_model('master_server', 'UrlTask')
+    TaskResult = apps.get_model('master_server', 'TaskResult')
+
+    last_id = 0
+    while True:
+        task_results = list(UrlTask.objects.filter(pk__gt=last_id).exclude(
+            task_result=None).order_by('pk').values_list('pk', 'task_result')[:1000])
+        if len(task_results) == 0:
+            break
+
+        TaskResult.objects.bulk_create([TaskResult(task_id=task_id, result=task_result)
+                                        for task_id, task_result in task_results])
+        for task_id, task_result in task_results:
+            UrlTask.objects.filter(pk=task_id).update(
+                result_size=len(task_result.encode('utf-8')))
+
+        last_id = task_results[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('master_server', '0011_urltask_url_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaskResult',
+            fields=[
+                ('task', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='result', serialize=False, to='master_server.urltask')),
+                ('result', models.TextField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='urltask',
+            name='result_size',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(move_task_results, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='urltask',
+            name='task_result',
+        ),
+    ]
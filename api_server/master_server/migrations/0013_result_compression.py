@@ -0,0 +1,28 @@
+# Generated by Django 3.2 on 2026-10-17 15:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('master_server', '0012_task_results'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='taskresult',
+            name='codec',
+            field=models.CharField(default='', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='taskresult',
+            name='compressed_result',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='taskresult',
+            name='result',
+            field=models.TextField(null=True),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 3.2 on 2026-10-17 15:22
+
+from django.core.management.color import no_style
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_default_job(apps, schema_editor):
+    Job = apps.get_model('master_server', 'Job')
+    Job.objects.create(pk=1, name='default')
+
+    # the id was set by hand, so the id sequence (on postgres) needs moving on
+    with schema_editor.connection.cursor() as cursor:
+        for sql in schema_editor.connection.ops.sequence_reset_sql(no_style(), [Job]):
+            cursor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('master_server', '0013_result_compression'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200, unique=True)),
+                ('weight', models.FloatField(default=1)),
+                ('virtual_time', models.FloatField(default=0)),
+                ('virtual_start', models.FloatField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_default_job, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='urltask',
+            name='job',
+            field=models.ForeignKey(default=1, on_delete=django.db.models.deletion.CASCADE, to='master_server.job'),
+        ),
+        migrations.AddField(
+            model_name='urltask',
+            name='priority',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RemoveIndex(
+            model_name='urltask',
+            name='urltask_queue_idx',
+        ),
+        migrations.AddIndex(
+            model_name='urltask',
+            index=models.Index(fields=['task_state', 'job', '-priority', 'fail_num', 'id'], name='urltask_job_queue_idx'),
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 3.2 on 2026-10-17 15:25
+
+import urllib.parse
+from django.db import migrations, models
+
+
+def set_task_hosts(apps, schema_editor):
+    # only tasks still to run are limited, complete ones are left without a host
+    UrlTask = apps.get_model('master_server', 'UrlTask')
+
+    last_id = 0
+    while True:
+        url_tasks = list(UrlTask.objects.filter(pk__gt=last_id, task_state__in=[
+            'QUEUED', 'ASSIGNED']).order_by('pk').values_list('pk', 'url')[:1000])
+        if len(url_tasks) == 0:
+            break
+
+        for task_id, url in url_tasks:
+            try:
+                host = (urllib.parse.urlsplit(url).hostname or '')[:255]
+            except ValueError:
+                host = ''
+            UrlTask.objects.filter(pk=task_id).update(host=host)
+
+        last_id = url_tasks[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('master_server', '0014_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HostBucket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('host', models.CharField(max_length=255, unique=True)),
+                ('tokens', models.FloatField()),
+                ('updated', models.FloatField()),
+                ('ready_at', models.FloatField(default=0)),
+                ('checked_at', models.FloatField(db_index=True, default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='urltask',
+            name='host',
+            field=models.CharField(default='', max_length=255),
+        ),
+        migrations.RunPython(set_task_hosts, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='urltask',
+            index=models.Index(fields=['task_state', 'job', 'host', '-priority', 'fail_num', 'id'], name='urltask_host_queue_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 3.2 on 2026-10-17 15:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('master_server', '0015_host_limits'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='urltask',
+            name='urltask_job_queue_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='urltask',
+            name='urltask_host_queue_idx',
+        ),
+        migrations.AddField(
+            model_name='urltask',
+            name='not_before',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='urltask',
+            name='task_state',
+            field=models.CharField(choices=[('QUEUED', 'QUEUED'), ('ASSIGNED', 'ASSIGNED'), ('COMPLETE', 'COMPLETE'), ('DEAD', 'DEAD')], default='QUEUED', max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='urltask',
+            index=models.Index(fields=['task_state', 'job', '-priority', 'not_before', 'fail_num', 'id'], name='urltask_ready_queue_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='urltask',
+            index=models.Index(fields=['task_state', 'job', 'host', '-priority', 'not_before', 'fail_num', 'id'], name='urltask_host_ready_queue_idx'),
+        ),
+    ]
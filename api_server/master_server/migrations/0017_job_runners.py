@@ -0,0 +1,29 @@
+# Generated by Django 3.2 on 2026-10-17 15:28
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('master_server', '0016_retry_delay'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='agent',
+            name='job',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='master_server.job'),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='runner',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='master_server.runner'),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='settings',
+            field=models.TextField(null=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2 on 2026-10-17 15:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('master_server', '0017_job_runners'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpeculativeRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slot', models.IntegerField(default=0)),
+                ('start_time', models.FloatField(default=0)),
+                ('running', models.BooleanField(default=True)),
+                ('agent', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='master_server.agent')),
+                ('task', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='speculative_run', to='master_server.urltask')),
+            ],
+        ),
+    ]
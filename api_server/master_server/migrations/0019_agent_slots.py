@@ -0,0 +1,26 @@
+# Generated by Django 3.2 on 2026-10-17 15:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('master_server', '0018_speculative_runs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AgentSlot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slot', models.IntegerField()),
+                ('slot_state', models.CharField(max_length=10)),
+                ('agent', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='slots', to='master_server.agent')),
+            ],
+            options={
+                'unique_together': {('agent', 'slot')},
+            },
+        ),
+    ]
@@ -1,20 +1,641 @@
-from django.db import models
+import os
+import json
+import time
+import logging
+import collections
+import urllib.parse
+from django.db import models, transaction, connection
+from master_server import compression
+
+
+class UrlTaskManager(models.Manager):
+
+    def queued(self, job_id=None):
+        '''
+        the queued tasks that are ready to run, in the order they're run:
+        highest priority first, then new tasks before retries (which are run
+        in the order their retry delays are up)
+        '''
+        queued_tasks = self.filter(task_state='QUEUED', not_before__lte=time.time())
+        if job_id is not None:
+            queued_tasks = queued_tasks.filter(job=job_id)
+
+        return queued_tasks.order_by('-priority', 'not_before', 'fail_num', 'id')
+
+    def claim(self, agent_id, num_tasks=1, slot=0):
+        '''
+        Atomically leases up to num_tasks queued tasks to a runner slot on the
+        agent and returns them as a list, which is empty if there are no
+        queued tasks or the slot already has tasks leased to it. The first
+        task is the one the slot starts on and gets a start_time, the others
+        keep a start_time of 0 until the slot gets to them. The tasks all come
+        from one job, the one next in line to be served (see JobManager).
+
+        On databases that support it (postgres) the task rows are locked with
+        SELECT ... FOR UPDATE SKIP LOCKED so concurrent claims never wait on
+        each other. Otherwise the tasks are claimed with a single conditional
+        UPDATE that takes them from the front of the queue and only matches
+        if the slot has no lease, so there's nothing to retry or undo.
+
+        This runs for every task started, so its queries are written in SQL:
+        building them with the ORM took several times longer than running
+        them (see benchmark.py claim).
+        '''
+        start_time = time.time()
+
+        # the next job to serve, skipping jobs with all their queued tasks on
+        # hosts that are at their limits
+        host_limits = HostBucket.objects.limits()
+        skipped_job_ids = []
+        while True:
+            job = Job.objects.next_to_serve(agent_id, skipped_job_ids)
+            if job is None:
+                return []
+
+            task_ids = None
+            if host_limits is None:
+                break
+
+            task_ids = HostBucket.objects.pick_tasks(job.pk, num_tasks, host_limits)
+            if len(task_ids) > 0:
+                break
+
+            skipped_job_ids.append(job.pk)
+
+        if connection.features.has_select_for_update_skip_locked:
+            with transaction.atomic():
+                # locking the agent row serialises claims for the same agent
+                Agent.objects.select_for_update().filter(pk=agent_id).first()
+
+                if self.leased(agent_id, slot).exists():
+                    return []
+
+                queue = self.queued(job.pk)
+                if task_ids is not None:
+                    queue = queue.filter(pk__in=task_ids)
+
+                task_ids = list(queue.select_for_update(skip_locked=True).values_list(
+                    'pk', flat=True)[:num_tasks])
+                if len(task_ids) == 0:
+                    return []
+
+                self.filter(pk__in=task_ids).update(task_state='ASSIGNED', assigned_agent=agent_id,
+                                                    assigned_slot=slot, start_time=start_time)
+        elif self.claim_queued(agent_id, slot, job.pk, num_tasks, task_ids, start_time) == 0:
+            return []
+
+        tasks = self.claimed(agent_id, slot)
+
+        TaskCounter.objects.move('QUEUED', 'ASSIGNED', len(tasks))
+        Job.objects.served(job, len(tasks))
+        if host_limits is not None:
+            HostBucket.objects.consume([t.host for t in tasks], host_limits)
+
+        with connection.cursor() as cursor:
+            cursor.execute('UPDATE {agent} SET assigned_task_id = %s, agent_state = %s '
+                           'WHERE id = %s'.format(agent=Agent._meta.db_table),
+                           [tasks[0].pk, 'ASSIGNED', agent_id])
+
+        return tasks
+
+    def claim_queued(self, agent_id, slot, job_id, num_tasks, task_ids, start_time):
+        '''
+        leases the first num_tasks tasks in the jobs queue (queued() in SQL),
+        out of task_ids if given, to the slot unless it already has a lease.
+        Returns the number of tasks leased.
+        '''
+        picked = ''
+        if task_ids is not None:
+            picked = 'AND id IN (' + ', '.join(['%s'] * len(task_ids)) + ') '
+
+        # the subquery runs in the same statement, so the tasks it picks are
+        # still queued. Checking task_state again outside it makes sqlite scan
+        # the whole queue.
+        sql = (
+            'UPDATE {table} SET task_state = %s, assigned_agent_id = %s, assigned_slot = %s, '
+                'start_time = %s '
+            'WHERE id IN ('
+                'SELECT id FROM {table} WHERE task_state = %s AND job_id = %s '
+                'AND not_before <= %s ' + picked +
+                'ORDER BY priority DESC, not_before, fail_num, id LIMIT %s) '
+            'AND NOT EXISTS ('
+                'SELECT 1 FROM {table} WHERE assigned_agent_id = %s AND task_state = %s '
+                'AND assigned_slot = %s)'
+        ).format(table=self.model._meta.db_table)
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, ['ASSIGNED', agent_id, slot, start_time, 'QUEUED',
+                                 job_id, start_time] + (task_ids or []) +
+                           [num_tasks, agent_id, 'ASSIGNED', slot])
+            return cursor.rowcount
+
+    def claimed(self, agent_id, slot):
+        '''
+        the tasks just leased to the slot, with their results (see
+        UrlTask.task_result), in the order they were queued. The first is the
+        one the slot starts on, the others have their start_time set back to 0.
+        '''
+        fields = self.model._meta.concrete_fields
+        sql = (
+            'SELECT ' + ', '.join('task.' + f.column for f in fields) + ', '
+                'result.result, result.compressed_result, result.codec '
+            'FROM {task} task LEFT JOIN {result} result ON result.task_id = task.id '
+            'WHERE task.assigned_agent_id = %s AND task.task_state = %s '
+                'AND task.assigned_slot = %s '
+            'ORDER BY task.priority DESC, task.not_before, task.fail_num, task.id'
+        ).format(task=self.model._meta.db_table, result=TaskResult._meta.db_table)
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [agent_id, 'ASSIGNED', slot])
+            rows = cursor.fetchall()
+
+            if len(rows) > 1:
+                cursor.execute('UPDATE {task} SET start_time = 0 WHERE id IN ({ids})'.format(
+                    task=self.model._meta.db_table, ids=', '.join(['%s'] * (len(rows) - 1))),
+                    [row[0] for row in rows[1:]])
+
+        tasks = []
+        for i, row in enumerate(rows):
+            task = self.model.from_db(self.db, [f.attname for f in fields], row[:len(fields)])
+            task._task_result = compression.decode_result(*row[len(fields):])
+            if i > 0:
+                task.start_time = 0
+            tasks.append(task)
+
+        return tasks
+
+    def leased(self, agent_id, slot=None):
+        leased_tasks = self.filter(assigned_agent=agent_id, task_state='ASSIGNED')
+        if slot is not None:
+            leased_tasks = leased_tasks.filter(assigned_slot=slot)
+
+        # the results are sent with the lease, see UrlTask.task_result
+        return leased_tasks.select_related('result').order_by('fail_num', 'id')
+
+    def state_counts(self, job_id=None):
+        '''
+        number of tasks in total, in each state and that have failed at least
+        once, counted in a single query. Only the tasks in the job if job_id
+        is given.
+        '''
+        counts = {'urls': models.Count('id'),
+                  'failed_min_once': models.Count('id', filter=models.Q(fail_num__gte=1))}
+        for state, _ in UrlTask.task_states:
+            counts[state] = models.Count('id', filter=models.Q(task_state=state))
+
+        url_tasks = self.all()
+        if job_id is not None:
+            url_tasks = url_tasks.filter(job=job_id)
+
+        return url_tasks.aggregate(**counts)
+
+
+class JobManager(models.Manager):
+
+    # the jobs an agent can run, with the agent joined on its id: only the
+    # job it's bound to if it is bound to one, otherwise the jobs for its
+    # runner and jobs without a runner
+    runnable_sql = (
+        'FROM {job} job LEFT JOIN {agent} agent ON agent.id = %s '
+        'WHERE (job.id = agent.job_id OR (agent.job_id IS NULL AND '
+            '(job.runner_id IS NULL OR job.runner_id = agent.runner_num))) '
+    )
+
+    def next_to_serve(self, agent_id, exclude_ids=()):
+        '''
+        The job with tasks ready to run to claim from next, out of the jobs
+        the agent can run (see runnable_sql), picked in one query. Jobs share
+        the agents in proportion to their weight, using start-time fair
+        queueing: each job has a virtual time that goes up by 1/weight for
+        every task claimed from it and the job with the lowest is served next.
+        '''
+        excluded = ''
+        if len(exclude_ids) > 0:
+            excluded = 'AND job.id NOT IN (' + ', '.join(['%s'] * len(exclude_ids)) + ') '
+
+        sql = (
+            'SELECT job.id, job.weight, job.virtual_time, '
+                '(SELECT MAX(virtual_start) FROM {job}) ' + self.runnable_sql + excluded +
+            'AND EXISTS (SELECT 1 FROM {task} WHERE task_state = %s AND job_id = job.id '
+                'AND not_before <= %s) '
+            'ORDER BY job.virtual_time, job.id LIMIT 1'
+        ).format(job=self.model._meta.db_table, agent=Agent._meta.db_table,
+                 task=UrlTask._meta.db_table)
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [agent_id] + list(exclude_ids) + ['QUEUED', time.time()])
+            row = cursor.fetchone()
+
+        if row is None:
+            return None
+
+        job = self.model.from_db(self.db, ['id', 'weight', 'virtual_time'], row[:3])
+        job.last_start = row[3]
+        return job
+
+    def runnable(self, agent_id):
+        '''
+        ids of the jobs the agent can run (see runnable_sql)
+        '''
+        sql = ('SELECT job.id ' + self.runnable_sql).format(job=self.model._meta.db_table,
+                                                            agent=Agent._meta.db_table)
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [agent_id])
+            return [row[0] for row in cursor.fetchall()]
+
+    def served(self, job, num_tasks):
+        '''
+        records num_tasks claimed from the job (from next_to_serve). A job that
+        had no queued tasks for a while (or is new) starts from the virtual
+        time of the last job served instead of its own, so it can't make up
+        for the time it was idle by taking all the agents.
+        '''
+        virtual_start = max(job.virtual_time, job.last_start)
+
+        with connection.cursor() as cursor:
+            cursor.execute('UPDATE {job} SET virtual_start = %s, virtual_time = %s '
+                           'WHERE id = %s'.format(job=self.model._meta.db_table),
+                           [virtual_start, virtual_start + num_tasks / job.weight, job.pk])
+
+
+class Job(models.Model):
+    '''
+    A group of tasks, run by its own runner (or any runner if it has none)
+    with its own settings. Tasks are claimed from the jobs with queued tasks
+    in turn, weighted by their weight, so a small job doesn't wait behind a
+    big one. Tasks added without a job go in the default job.
+    '''
+    name = models.CharField(max_length=200, unique=True)
+    weight = models.FloatField(default=1)
+    runner = models.ForeignKey('Runner', on_delete=models.SET_NULL, null=True)
+    # json object, overrides the masters settings for the job's tasks. Only
+    # max_task_retries so far
+    settings = models.TextField(null=True)
+    virtual_time = models.FloatField(default=0)
+    virtual_start = models.FloatField(default=0)
+
+    objects = JobManager()
+
+    def get_settings(self):
+        if self.settings is None:
+            return {}
+
+        return json.loads(self.settings)
+
+
+DEFAULT_JOB_ID = 1
+
+
+def url_host(url):
+    try:
+        return (urllib.parse.urlsplit(url).hostname or '')[:255]
+    except ValueError:
+        return ''
+
 
 class UrlTask(models.Model):
     task_states = (
         ('QUEUED', 'QUEUED'),
         ('ASSIGNED', 'ASSIGNED'),
-        ('COMPLETE', 'COMPLETE')
+        ('COMPLETE', 'COMPLETE'),
+        ('DEAD', 'DEAD') # failed max_task_retries times
     )
 
     url = models.TextField()
     json_metadata = models.TextField(null=True)
-    task_result = models.TextField(null=True)
+    # the result itself is in TaskResult, see task_result below
+    result_size = models.IntegerField(default=0)
     task_state = models.CharField(choices=task_states, max_length=10, default='QUEUED')
     assigned_agent = models.ForeignKey('Agent', on_delete=models.CASCADE, null=True)
+    assigned_slot = models.IntegerField(default=0)
+    job = models.ForeignKey('Job', on_delete=models.CASCADE, default=DEFAULT_JOB_ID)
+    # higher priority tasks in a job are run first
+    priority = models.IntegerField(default=0)
     fail_num = models.IntegerField(default=0)
+    # a failed task isn't retried until this time
+    not_before = models.FloatField(default=0)
+    # set from the url when the task is saved, for the per host limits
+    host = models.CharField(max_length=255, default='')
     start_time = models.FloatField(default=0)
     end_time = models.FloatField(default=0)
+    # hash of the normalised url, only set for urls added with dedup on
+    url_hash = models.CharField(max_length=64, null=True, unique=True)
+
+    objects = UrlTaskManager()
+
+    class Meta:
+        indexes = [
+            # the queue, UrlTaskManager.queued()
+            models.Index(fields=['task_state', 'job', '-priority', 'not_before', 'fail_num', 'id'],
+                         name='urltask_ready_queue_idx'),
+            # each hosts part of the queue, HostBucketManager.pick_tasks()
+            models.Index(fields=['task_state', 'job', 'host', '-priority', 'not_before',
+                                 'fail_num', 'id'],
+                         name='urltask_host_ready_queue_idx'),
+            # tasks leased to an agent, UrlTaskManager.leased()
+            models.Index(fields=['assigned_agent', 'task_state'], name='urltask_agent_state_idx'),
+        ]
+
+    @property
+    def task_result(self):
+        '''
+        the result is only read from the TaskResult table when it's asked for
+        (or with select_related('result'), in the same query as the task)
+        '''
+        if hasattr(self, '_task_result'):
+            return self._task_result
+
+        try:
+            return self.result.get_result()
+        except TaskResult.DoesNotExist:
+            return None
+
+    @task_result.setter
+    def task_result(self, task_result):
+        self._task_result = task_result
+        self._task_result_changed = True
+        self.result_size = result_size(task_result)
+
+    def save(self, *args, **kwargs):
+        self.host = url_host(self.url)
+        super().save(*args, **kwargs)
+
+        if getattr(self, '_task_result_changed', False):
+            TaskResult.objects.save_results({self.pk: self._task_result})
+            self._task_result_changed = False
+
+def result_size(task_result):
+    return 0 if task_result is None else len(task_result.encode('utf-8'))
+
+
+class TaskResultManager(models.Manager):
+
+    def save_results(self, results_by_task_id):
+        '''
+        sets the results of the tasks, replacing any they had. A result of
+        None removes it.
+        '''
+        codec = compression.get_result_codec()
+
+        task_results = []
+        for task_id, task_result in results_by_task_id.items():
+            if task_result is None:
+                continue
+
+            result, compressed_result, result_codec = compression.encode_result(task_result, codec)
+            task_results.append(TaskResult(task_id=task_id, result=result,
+                                           compressed_result=compressed_result,
+                                           codec=result_codec))
+
+        with transaction.atomic():
+            self.filter(task_id__in=list(results_by_task_id)).delete()
+            self.bulk_create(task_results, batch_size=500)
+
+
+class TaskResult(models.Model):
+    '''
+    Task results are kept out of the UrlTask table so that scanning the queue
+    and counting tasks doesn't have to read through them.
+    '''
+    task = models.OneToOneField('UrlTask', on_delete=models.CASCADE, primary_key=True,
+                                related_name='result')
+    result = models.TextField(null=True)
+    # set instead of result if the result was compressed, see compression.py
+    compressed_result = models.BinaryField(null=True)
+    codec = models.CharField(max_length=10, default='')
+
+    objects = TaskResultManager()
+
+    def get_result(self):
+        return compression.decode_result(self.result, self.compressed_result, self.codec)
+
+
+class SpeculativeRun(models.Model):
+    '''
+    A second copy of a slow running task, started on an idle runner slot
+    once the queue is empty so a few slow pages don't hold up the end of a
+    job (see task_queue.find_speculative_task). The first result saved wins.
+
+    agent and slot are where the copy runs. If the copy wins, they're
+    changed to the task's lease, as that's the copy still running. Either
+    way, the control loop kills the copy still running once the task is
+    complete. Tasks are only copied once, the row is kept so a result from
+    the losing copy is ignored.
+    '''
+    task = models.OneToOneField('UrlTask', on_delete=models.CASCADE,
+                                related_name='speculative_run')
+    agent = models.ForeignKey('Agent', on_delete=models.CASCADE)
+    slot = models.IntegerField(default=0)
+    start_time = models.FloatField(default=0)
+    # cleared when the slot finishes with the task or is killed
+    running = models.BooleanField(default=True)
+
+
+class HostBucketManager(models.Manager):
+
+    max_probed_hosts = 10
+
+    def limits(self):
+        '''
+        the per host limits, or None if there aren't any. PYMADA_HOST_RATE is
+        the number of tasks started per second on a host, with bursts of up to
+        PYMADA_HOST_BURST. PYMADA_HOST_MAX_CONCURRENT is the number of tasks
+        running on a host at once.
+        '''
+        try:
+            rate = float(os.getenv('PYMADA_HOST_RATE', 0))
+            burst = float(os.getenv('PYMADA_HOST_BURST', max(rate, 1)))
+            max_concurrent = int(os.getenv('PYMADA_HOST_MAX_CONCURRENT', 0))
+        except ValueError:
+            logging.warning('invalid per host limits, not limiting hosts')
+            return None
+
+        if rate <= 0 and max_concurrent <= 0:
+            return None
+
+        return {'rate': rate, 'burst': max(burst, 1), 'max_concurrent': max_concurrent}
+
+    def allowances(self, hosts, limits, now):
+        '''
+        the number of tasks that can be started on each of the hosts now
+        '''
+        buckets = {b.host: b for b in self.filter(host__in=hosts)}
+
+        running = {}
+        if limits['max_concurrent'] > 0:
+            running = dict(UrlTask.objects.filter(task_state='ASSIGNED', host__in=hosts).values(
+                'host').annotate(num=models.Count('id')).values_list('host', 'num'))
+
+        allowances = {}
+        for host in hosts:
+            allowance = float('inf')
+            if host == '':
+                allowances[host] = allowance
+                continue
+
+            if limits['rate'] > 0 and host in buckets:
+                allowance = int(buckets[host].refilled(limits, now))
+            elif limits['rate'] > 0:
+                allowance = int(limits['burst'])
+
+            if limits['max_concurrent'] > 0:
+                allowance = min(allowance, limits['max_concurrent'] - running.get(host, 0))
+
+            allowances[host] = allowance
+
+        return allowances
+
+    def pick_tasks(self, job_id, num_tasks, limits, window_size=200):
+        '''
+        Ids of up to num_tasks queued tasks in the job on hosts that aren't at
+        their limits. Tasks are taken from the front of the queue, skipping
+        ones for saturated hosts. If there aren't enough there, the queues of
+        a few of the hosts that haven't been looked at for longest are
+        checked, each an index lookup, so it never scans the whole queue.
+        '''
+        now = time.time()
+        window = list(UrlTask.objects.queued(job_id).values_list('pk', 'host')[
+            :max(window_size, num_tasks)])
+
+        allowances = self.allowances(set(host for _, host in window), limits, now)
+        task_ids = []
+        for task_id, host in window:
+            if allowances[host] >= 1:
+                task_ids.append(task_id)
+                allowances[host] -= 1
+
+                if len(task_ids) == num_tasks:
+                    return task_ids
+
+        probed_hosts = list(self.filter(ready_at__lte=now).exclude(host__in=list(allowances))
+                            .order_by('checked_at').values_list('host', flat=True)[
+                                :self.max_probed_hosts])
+
+        allowances = self.allowances(probed_hosts, limits, now)
+        for host in probed_hosts:
+            num_allowed = min(allowances[host], num_tasks - len(task_ids))
+            if num_allowed >= 1:
+                task_ids += list(UrlTask.objects.queued(job_id).filter(host=host).values_list(
+                    'pk', flat=True)[:int(num_allowed)])
+
+            if len(task_ids) == num_tasks:
+                break
+
+        # hosts with nothing to run go to the back of the line
+        self.filter(host__in=probed_hosts, checked_at__lt=now).update(checked_at=now)
+
+        return task_ids
+
+    def consume(self, hosts, limits):
+        '''
+        takes a token from the hosts bucket for each task started on it
+        '''
+        now = time.time()
+        for host, num_tasks in collections.Counter(hosts).items():
+            if host == '':
+                continue
+
+            bucket, _ = self.get_or_create(host=host, defaults={'tokens': limits['burst'],
+                                                                'updated': now})
+            tokens = bucket.refilled(limits, now) - num_tasks
+
+            ready_at = now
+            if limits['rate'] > 0 and tokens < 1:
+                ready_at = now + (1 - tokens) / limits['rate']
+
+            self.filter(pk=bucket.pk).update(tokens=tokens, updated=now, ready_at=ready_at,
+                                             checked_at=now)
+
+    def register(self, hosts):
+        '''
+        adds buckets for the hosts, so their tasks can be found even when
+        they're not near the front of the queue
+        '''
+        limits = self.limits()
+        if limits is None:
+            return
+
+        now = time.time()
+        self.bulk_create([HostBucket(host=host, tokens=limits['burst'], updated=now)
+                          for host in set(hosts) if host != ''], ignore_conflicts=True)
+
+
+class HostBucket(models.Model):
+    '''
+    Token bucket for the rate tasks are started on a host, used when per host
+    limits are set (see HostBucketManager.limits). ready_at is when the
+    bucket next has a token. The limits are checked before tasks are claimed,
+    so concurrent claims can go slightly over them.
+    '''
+    host = models.CharField(max_length=255, unique=True)
+    tokens = models.FloatField()
+    updated = models.FloatField()
+    ready_at = models.FloatField(default=0)
+    checked_at = models.FloatField(default=0, db_index=True)
+
+    objects = HostBucketManager()
+
+    def refilled(self, limits, now):
+        if limits['rate'] <= 0:
+            return limits['burst']
+
+        return min(limits['burst'], self.tokens + (now - self.updated) * limits['rate'])
+
+
+class TaskCounterManager(models.Manager):
+
+    def enabled(self):
+        return os.getenv('PYMADA_STATS_COUNTERS', '').lower() in ('1', 'true', 'yes')
+
+    def add(self, **deltas):
+        if not self.enabled():
+            return
+
+        for name, delta in deltas.items():
+            if delta != 0:
+                self.filter(name=name).update(value=models.F('value') + delta)
+
+    def move(self, from_state, to_state, num=1):
+        '''
+        records num tasks changing state from from_state to to_state
+        '''
+        if from_state != to_state and num > 0:
+            self.add(**{from_state: -num, to_state: num})
+
+    def counts(self):
+        '''
+        the counters in the same format as UrlTask.objects.state_counts(),
+        rebuilt from the UrlTask table if they haven't been set up yet (or a
+        task state was added since)
+        '''
+        counts = dict(self.values_list('name', 'value'))
+        if any(state not in counts for state, _ in UrlTask.task_states):
+            counts = self.rebuild()
+
+        return counts
+
+    def rebuild(self):
+        with transaction.atomic():
+            counts = UrlTask.objects.state_counts()
+            self.all().delete()
+            self.bulk_create([TaskCounter(name=name, value=value)
+                              for name, value in counts.items()])
+
+        return counts
+
+
+class TaskCounter(models.Model):
+    '''
+    Running totals of the task stats, updated on every task state change so
+    the stats don't have to count the UrlTask table. Only kept up to date if
+    PYMADA_STATS_COUNTERS is set, in which case they are rebuilt each time
+    the master starts.
+    '''
+    name = models.CharField(max_length=50, unique=True)
+    value = models.BigIntegerField(default=0)
+
+    objects = TaskCounterManager()
 
 class Agent(models.Model):
     agent_states = (
@@ -30,8 +651,49 @@ class Agent(models.Model):
     last_contact_attempt = models.IntegerField()
     agent_url = models.CharField(max_length=300)
     runner_num = models.IntegerField(null=True)
+    capacity = models.IntegerField(default=1) # number of runner slots
+    job = models.ForeignKey('Job', on_delete=models.SET_NULL, null=True) # only runs this job
     assigned_task = models.ForeignKey('UrlTask', on_delete=models.CASCADE, null=True)
 
+
+class AgentSlotManager(models.Manager):
+
+    def report(self, agent_id, slot_states):
+        '''
+        records the states reported for runner slots on the agent ({slot:
+        state}) and returns the state of the agent as a whole, worked out the
+        same way agents do: NO_RUNNER if any slot has no runner, otherwise
+        IDLE if any slot is free
+        '''
+        for slot, slot_state in slot_states.items():
+            self.update_or_create(agent_id=agent_id, slot=slot,
+                                  defaults={'slot_state': slot_state})
+
+        capacity = Agent.objects.values_list('capacity', flat=True).get(pk=agent_id)
+        states = set(self.filter(agent=agent_id, slot__lt=capacity).values_list(
+            'slot_state', flat=True))
+
+        for agent_state in ('NO_RUNNER', 'IDLE'):
+            if agent_state in states:
+                return agent_state
+
+        return 'RUNNING'
+
+
+class AgentSlot(models.Model):
+    '''
+    the last state reported for each runner slot on an agent, so a report
+    from one slot doesn't decide the state of the whole agent
+    '''
+    agent = models.ForeignKey('Agent', on_delete=models.CASCADE, related_name='slots')
+    slot = models.IntegerField()
+    slot_state = models.CharField(max_length=10)
+
+    objects = AgentSlotManager()
+
+    class Meta:
+        unique_together = ('agent', 'slot')
+
 class Runner(models.Model):
     contents = models.TextField()
     file_name = models.CharField(max_length=200)
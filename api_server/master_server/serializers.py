@@ -1,5 +1,6 @@
+import json
 from rest_framework import serializers
-from master_server.models import UrlTask, Agent, Runner, ErrorLog, Screenshot
+from master_server.models import UrlTask, Agent, Runner, ErrorLog, Screenshot, Job
 
 class UrlTaskSerializer(serializers.ModelSerializer):
     task_result = serializers.CharField(required=False, allow_blank=True, allow_null=True)
@@ -8,22 +9,52 @@ class UrlTaskSerializer(serializers.ModelSerializer):
     fail_num = serializers.IntegerField(required=False, allow_null=True)
     start_time = serializers.FloatField(required=False, allow_null=True)
     end_time = serializers.FloatField(required=False, allow_null=True)
+    result_size = serializers.IntegerField(read_only=True)
+    priority = serializers.IntegerField(required=False)
+    # the lease is only changed by the task queue, agents send it with a
+    # result to say which runner slot it came from
+    assigned_agent = serializers.PrimaryKeyRelatedField(read_only=True)
+    assigned_slot = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = UrlTask
-        fields = ('id', 'url', 'json_metadata', 'task_state', 'task_result',
-                  'assigned_agent', 'fail_num', 'start_time', 'end_time')
+        fields = ('id', 'url', 'json_metadata', 'task_state', 'task_result', 'result_size',
+                  'job', 'priority', 'assigned_agent', 'assigned_slot', 'fail_num',
+                  'start_time', 'end_time')
+
+class JobSerializer(serializers.ModelSerializer):
+    weight = serializers.FloatField(required=False, min_value=0.001)
+    settings = serializers.CharField(required=False, allow_null=True)
+
+    class Meta:
+        model = Job
+        fields = ('id', 'name', 'weight', 'runner', 'settings')
+
+    def validate_settings(self, settings):
+        if settings is None:
+            return settings
+
+        try:
+            parsed_settings = json.loads(settings)
+        except ValueError:
+            raise serializers.ValidationError('settings needs to be a json object')
+
+        if type(parsed_settings) is not dict:
+            raise serializers.ValidationError('settings needs to be a json object')
+
+        return settings
 
 class AgentSerializer(serializers.ModelSerializer):
 
     agent_state = serializers.CharField(required=False)
     last_contact_attempt = serializers.IntegerField(required=False)
     runner_num = serializers.IntegerField(required=False, allow_null=True)
+    capacity = serializers.IntegerField(required=False, min_value=1)
 
     class Meta:
         model = Agent
         fields = ('id', 'hostname', 'agent_state', 'last_contact_attempt', 'agent_url',
-                  'runner_num', 'assigned_task')
+                  'runner_num', 'capacity', 'job', 'assigned_task')
     
 
 class RunnerSerializer(serializers.ModelSerializer):
@@ -0,0 +1,356 @@
+import os
+import time
+import logging
+from django.db import transaction, IntegrityError
+from master_server.models import (UrlTask, Agent, Job, TaskCounter, TaskResult, HostBucket,
+                                  SpeculativeRun, result_size)
+from master_server.serializers import UrlTaskSerializer
+
+'''
+Task queue operations shared by the control loop (control.py) and the api
+views. All functions here are synchronous, control.py wraps them with
+sync_to_async.
+'''
+
+def get_max_task_retries():
+    try:
+        return int(os.getenv('PYMADA_MAX_TASK_RETRIES'))
+    except TypeError:
+        return 3
+
+
+def get_retry_delay(fail_num):
+    '''
+    seconds before a task that has failed fail_num times is retried, doubling
+    from PYMADA_RETRY_DELAY_SECONDS up to PYMADA_MAX_RETRY_DELAY_SECONDS
+    '''
+    try:
+        retry_delay = float(os.getenv('PYMADA_RETRY_DELAY_SECONDS'))
+    except TypeError:
+        retry_delay = 10
+
+    try:
+        max_retry_delay = float(os.getenv('PYMADA_MAX_RETRY_DELAY_SECONDS'))
+    except TypeError:
+        max_retry_delay = 3600
+
+    return min(retry_delay * 2 ** (fail_num - 1), max_retry_delay)
+
+
+def get_task_batch_size():
+    try:
+        return max(int(os.getenv('PYMADA_TASK_BATCH_SIZE')), 1)
+    except TypeError:
+        return 1
+
+
+def get_speculate_after():
+    '''
+    seconds a task has to have been running for before a copy of it is
+    started on an idle agent, 0 (the default) to never copy tasks
+    '''
+    try:
+        return float(os.getenv('PYMADA_SPECULATE_AFTER_SECONDS'))
+    except TypeError:
+        return 0
+
+
+def find_assign_task(agent_id, slot=0, batch_size=None):
+    '''
+    Leases a batch of queued tasks to a runner slot on the agent. Returns the
+    data for the agents /start_run request ({'slot': int, 'tasks': [...]})
+    or None if nothing was assigned. With nothing queued, the slot may be
+    given a copy of a slow task instead (see find_speculative_task).
+    '''
+    if batch_size is None:
+        batch_size = get_task_batch_size()
+
+    tasks = UrlTask.objects.claim(agent_id, num_tasks=batch_size, slot=slot)
+    if len(tasks) == 0:
+        # the slot is idle but still has a lease, so it never got the
+        # response that leased the tasks to it. They're sent again.
+        leased_tasks = list(UrlTask.objects.leased(agent_id, slot))
+        if len(leased_tasks) > 0:
+            return {'slot': slot, 'tasks': UrlTaskSerializer(leased_tasks, many=True).data}
+
+        return find_speculative_task(agent_id, slot)
+
+    logging.info('assigning ' + ', '.join([str(t.id) for t in tasks]) + ' to agent '
+        + str(agent_id) + ' slot ' + str(slot))
+
+    return {'slot': slot, 'tasks': UrlTaskSerializer(tasks, many=True).data}
+
+
+def find_speculative_task(agent_id, slot=0, speculate_after=None, max_candidates=10):
+    '''
+    Called for an idle runner slot when there was nothing to assign to it.
+    If no tasks the agent could run are queued, starts a copy of the longest
+    running task (over speculate_after seconds) on the slot, so the end of
+    a job isn't held up by a few slow tasks. Only tasks running on other
+    agents, on hosts that aren't at their limits, are copied, each only
+    once. Returns the data for the agents /start_run request, as
+    find_assign_task does, or None.
+    '''
+    if speculate_after is None:
+        speculate_after = get_speculate_after()
+
+    if speculate_after <= 0:
+        return
+
+    # a copy the slot never got, as for leases in find_assign_task
+    speculative_run = SpeculativeRun.objects.filter(
+        agent=agent_id, slot=slot, running=True, task__task_state='ASSIGNED').select_related(
+            'task').first()
+    if speculative_run is not None:
+        return speculative_task_data(speculative_run.task, agent_id, slot)
+
+    if Job.objects.next_to_serve(agent_id) is not None:
+        return
+
+    start_time = time.time()
+    stragglers = UrlTask.objects.filter(
+        task_state='ASSIGNED', start_time__gt=0, start_time__lte=start_time - speculate_after,
+        speculative_run__isnull=True,
+        job__in=Job.objects.runnable(agent_id)).exclude(
+            assigned_agent=agent_id).order_by('start_time')[:max_candidates]
+
+    host_limits = HostBucket.objects.limits()
+    for task in stragglers:
+        if host_limits is not None and HostBucket.objects.allowances(
+                [task.host], host_limits, start_time)[task.host] < 1:
+            continue
+
+        # another slot may have copied the task since it was read
+        try:
+            with transaction.atomic():
+                SpeculativeRun.objects.create(task=task, agent_id=agent_id, slot=slot,
+                                              start_time=start_time)
+        except IntegrityError:
+            continue
+
+        if host_limits is not None:
+            HostBucket.objects.consume([task.host], host_limits)
+
+        logging.info('copying task ' + str(task.id) + ' running on agent ' +
+            str(task.assigned_agent_id) + ' to agent ' + str(agent_id) + ' slot ' + str(slot))
+
+        return speculative_task_data(task, agent_id, slot)
+
+
+def speculative_task_data(task, agent_id, slot):
+    # the agent sends these back with the result, which says which copy won
+    task_data = UrlTaskSerializer(task).data
+    task_data['assigned_agent'] = agent_id
+    task_data['assigned_slot'] = slot
+
+    return {'slot': slot, 'tasks': [task_data]}
+
+
+def is_losing_copy(task):
+    '''
+    True if the task was copied and a result was already saved, the first
+    result saved wins
+    '''
+    return (task.task_state == 'COMPLETE' and
+            SpeculativeRun.objects.filter(task=task.id).exists())
+
+
+def settle_speculative_runs(finished_tasks):
+    '''
+    finished_tasks is a list of (task, agent_id, slot), a task as it was
+    before its result was saved and the runner slot that sent the result
+    (None if it isn't known). For copied tasks, the copy that's still
+    running is left for the control loop to kill: the task's lease if the
+    result came from the copy, otherwise the copy.
+    '''
+    runs = {run.task_id: run for run in SpeculativeRun.objects.filter(
+        task__in=[task.id for task, _, _ in finished_tasks], running=True)}
+
+    for task, agent_id, slot in finished_tasks:
+        run = runs.get(task.id)
+        if run is None or (agent_id, slot) != (run.agent_id, run.slot):
+            continue
+
+        if task.assigned_agent_id is None:
+            run.running = False
+        else:
+            run.agent_id = task.assigned_agent_id
+            run.slot = task.assigned_slot
+
+        run.save()
+
+
+def lost_speculative_runs():
+    '''
+    (agent id, slot, task id) of the copies of complete tasks that are still
+    running, they're marked as no longer running as they're returned
+    '''
+    runs = list(SpeculativeRun.objects.filter(running=True, task__task_state='COMPLETE').values_list(
+        'pk', 'agent', 'slot', 'task'))
+    SpeculativeRun.objects.filter(pk__in=[run[0] for run in runs]).update(running=False)
+
+    return [run[1:] for run in runs]
+
+
+def start_next_leased_task(agent_id, slot, finished_task_ids):
+    '''
+    Called when the agent saves results, starts the clock on the next task
+    in the slots lease. Slots run their lease in order, so any earlier task
+    in the lease that was started but is still unfinished had its runner
+    crash and is failed.
+    '''
+    for started_task_id in UrlTask.objects.leased(agent_id, slot).filter(
+            start_time__gt=0).exclude(pk__in=finished_task_ids).values_list('pk', flat=True):
+        fail_task(agent_id, started_task_id, get_max_task_retries())
+
+    next_task_id = UrlTask.objects.leased(agent_id, slot).filter(start_time=0).values_list(
+        'pk', flat=True).first()
+
+    if next_task_id is not None:
+        UrlTask.objects.filter(pk=next_task_id).update(start_time=time.time())
+
+    Agent.objects.filter(pk=agent_id, assigned_task__in=finished_task_ids).update(
+        assigned_task=next_task_id)
+    return next_task_id
+
+
+def release_leased_tasks(agent_id, slot=None, task_ids=None):
+    '''
+    Puts the tasks leased to the agent that it never started back in the queue.
+    '''
+    leased_tasks = UrlTask.objects.leased(agent_id, slot).filter(start_time=0)
+    if task_ids is not None:
+        leased_tasks = leased_tasks.filter(pk__in=task_ids)
+
+    num_released = leased_tasks.update(task_state='QUEUED', assigned_agent=None)
+    TaskCounter.objects.move('ASSIGNED', 'QUEUED', num_released)
+
+    return num_released
+
+
+def fail_task(agent_id, task_id, max_task_retries):
+    assigned_task = UrlTask.objects.select_related('job').get(pk=task_id)
+    previous_state = assigned_task.task_state
+    max_task_retries = assigned_task.job.get_settings().get('max_task_retries', max_task_retries)
+
+    assigned_task.fail_num += 1
+    assigned_task.start_time = 0
+    assigned_task.assigned_agent = None
+
+    speculative_run = SpeculativeRun.objects.filter(task=task_id, running=True).first()
+
+    if previous_state == 'ASSIGNED' and speculative_run is not None:
+        # the task carries on with its copy instead of being retried
+        assigned_task.assigned_agent_id = speculative_run.agent_id
+        assigned_task.assigned_slot = speculative_run.slot
+        assigned_task.start_time = speculative_run.start_time
+        speculative_run.running = False
+        speculative_run.save()
+    elif assigned_task.fail_num >= max_task_retries:
+        assigned_task.task_state = 'DEAD'
+    else:
+        assigned_task.task_state = 'QUEUED'
+        assigned_task.not_before = time.time() + get_retry_delay(assigned_task.fail_num)
+
+    assigned_task.save()
+
+    TaskCounter.objects.move(previous_state, assigned_task.task_state)
+    if assigned_task.fail_num == 1:
+        TaskCounter.objects.add(failed_min_once=1)
+
+    Agent.objects.filter(pk=agent_id, assigned_task=task_id).update(assigned_task=None)
+
+
+def complete_tasks(task_results):
+    '''
+    Saves the results of many tasks at once, task_results is a list of
+    {'id': int, 'task_result': str} dicts. The tasks are marked complete in one
+    transaction and the next task in each slots lease is started, as when a
+    single result is saved. The results can say which runner slot they're
+    from with 'assigned_agent' and 'assigned_slot', for copied tasks (see
+    find_speculative_task). Returns the number saved, the ids that don't
+    exist and the ids of tasks that already had a result from another copy.
+    '''
+    results_by_id = {int(r['id']): r.get('task_result') for r in task_results}
+    senders = {int(r['id']): (r.get('assigned_agent'), r.get('assigned_slot', 0))
+               for r in task_results}
+    end_time = time.time()
+
+    with transaction.atomic():
+        tasks = list(UrlTask.objects.filter(pk__in=list(results_by_id)).only(
+            'id', 'task_state', 'assigned_agent', 'assigned_slot'))
+
+        copied_ids = set(SpeculativeRun.objects.filter(task__in=[t.id for t in tasks]).values_list(
+            'task', flat=True))
+        duplicate_ids = [t.id for t in tasks if t.task_state == 'COMPLETE' and t.id in copied_ids]
+        tasks = [t for t in tasks if t.id not in duplicate_ids]
+
+        settle_speculative_runs([(t, senders[t.id][0], senders[t.id][1]) for t in tasks
+                                 if t.id in copied_ids])
+
+        previous_states = {}
+        finished_slots = {}
+        for task in tasks:
+            previous_states[task.task_state] = previous_states.get(task.task_state, 0) + 1
+            if task.assigned_agent_id is not None:
+                finished_slots.setdefault((task.assigned_agent_id, task.assigned_slot),
+                                          []).append(task.id)
+
+            task.result_size = result_size(results_by_id[task.id])
+            task.task_state = 'COMPLETE'
+            task.end_time = end_time
+            task.assigned_agent = None
+
+        UrlTask.objects.bulk_update(tasks, ['result_size', 'task_state', 'end_time',
+                                            'assigned_agent'], batch_size=500)
+        TaskResult.objects.save_results({task.id: results_by_id[task.id] for task in tasks})
+
+        for previous_state, num_tasks in previous_states.items():
+            TaskCounter.objects.move(previous_state, 'COMPLETE', num_tasks)
+
+    for (agent_id, slot), finished_task_ids in finished_slots.items():
+        start_next_leased_task(agent_id, slot, finished_task_ids)
+
+    found_ids = set(t.id for t in tasks).union(duplicate_ids)
+    return {'saved': len(tasks),
+            'not_found': [task_id for task_id in results_by_id if task_id not in found_ids],
+            'duplicates': duplicate_ids}
+
+
+def fail_unreturned_task(agent_id, max_task_retries, slot=None, task_ids=None):
+    '''
+    Called when a runner slot (or with slot=None, every slot) on the agent is
+    idle. Fails the tasks leased to it that were started but had no result
+    saved, and releases the ones it never got to. If task_ids is given, only
+    those tasks are touched, so a late report about an old lease can't fail
+    a newer one. Returns the ids of the failed tasks.
+    '''
+    leased_tasks = UrlTask.objects.leased(agent_id, slot)
+    speculative_runs = SpeculativeRun.objects.filter(agent=agent_id, running=True)
+    if slot is not None:
+        speculative_runs = speculative_runs.filter(slot=slot)
+    if task_ids is not None:
+        leased_tasks = leased_tasks.filter(pk__in=task_ids)
+        speculative_runs = speculative_runs.filter(task__in=task_ids)
+
+    # copies of tasks that finished without a result just stop, the task's
+    # lease is still running
+    speculative_runs.update(running=False)
+
+    failed_task_ids = []
+    for leased_task_id, start_time in leased_tasks.values_list('pk', 'start_time'):
+        if start_time == 0:
+            continue
+
+        logging.info('task {} was assigned to agent {} but no results were returned'.format(
+            leased_task_id, agent_id))
+
+        fail_task(agent_id, leased_task_id, max_task_retries)
+        failed_task_ids.append(leased_task_id)
+
+    release_leased_tasks(agent_id, slot, task_ids)
+
+    if not UrlTask.objects.leased(agent_id).exists():
+        Agent.objects.filter(pk=agent_id).update(assigned_task=None)
+
+    return failed_task_ids
@@ -1,10 +1,18 @@
 import time
 import json
-from unittest.mock import patch
-from django.test import TestCase
+import os
+import gzip
+import asyncio
+import importlib.util
+from unittest.mock import patch, Mock
+from django.test import TestCase, TransactionTestCase
+from django.core.asgi import get_asgi_application
 from django.contrib.auth.models import User
 from rest_framework.test import APIRequestFactory, APIClient
-from master_server.models import UrlTask, Agent, Runner, ErrorLog
+from asgiref.sync import async_to_sync
+from master_server.models import (UrlTask, Agent, Runner, ErrorLog, TaskCounter, TaskResult, Job,
+                                  HostBucket, SpeculativeRun)
+from master_server import ingest
 import control
 
 class MasterServerTestCase(TestCase):
@@ -63,7 +71,68 @@ class MasterServerTestCase(TestCase):
         json_response = res.json()
         assert 'id' in json_response
         assert json_response['runner_num'] == 1
+        assert json_response['capacity'] == 1
+
+    def test_register_agent_capacity(self):
+        c = APIClient()
+        agent_details = {
+            'hostname': 'test-slots',
+            'agent_url': 'http://testslots',
+            'runner_num': 1,
+            'capacity': 4
+        }
+        res = c.post('/register_agent/', agent_details, format='json')
+        assert res.json()['capacity'] == 4
+
+        # pod restarted with a different number of slots
+        agent_details['capacity'] = 2
+        res = c.post('/register_agent/', agent_details, format='json')
+        assert res.status_code == 200
+        assert res.json()['capacity'] == 2
     
+    def test_jobs(self):
+        c = APIClient()
+        runner = Runner.objects.create(contents="print('job')", file_name='job_runner.py')
+        res = c.post('/jobs/', {'name': 'crawl', 'runner': runner.id,
+                                'settings': '{"max_task_retries": 1}'}, format='json')
+        assert res.status_code == 201
+        job_id = res.json()['id']
+
+        assert c.post('/jobs/', {'name': 'bad', 'settings': '[1]'},
+                      format='json').status_code == 400
+
+        c.post('/urls/', [{'url': 'http://crawl/1', 'job': job_id},
+                          {'url': 'http://crawl/2', 'job': job_id}], format='json')
+
+        # an agent bound to the job gets the job's runner and only its tasks
+        res = c.post('/register_agent/', {'hostname': 'crawl', 'agent_url': 'http://crawl-agent',
+                                          'runner_num': 1, 'job': job_id}, format='json')
+        agent_id = res.json()['id']
+        assert res.json()['runner_num'] == runner.id
+
+        res = c.post('/agents/' + str(agent_id) + '/state/', {'agent_state': 'IDLE'},
+                     format='json')
+        task_id = res.json()['tasks'][0]['id']
+        assert UrlTask.objects.get(pk=task_id).job_id == job_id
+
+        # the other agents don't have the job's runner
+        res = c.post('/agents/1/state/', {'agent_state': 'IDLE'}, format='json')
+        assert UrlTask.objects.get(pk=res.json()['tasks'][0]['id']).job_id == 1
+
+        # the job allows a single try
+        c.post('/agents/' + str(agent_id) + '/state/', {'agent_state': 'IDLE',
+               'task_ids': [task_id]}, format='json')
+        assert UrlTask.objects.get(pk=task_id).task_state == 'DEAD'
+
+        stats = c.get('/jobs/' + str(job_id) + '/stats/').json()
+        assert stats['urls'] == 2
+        assert stats['urls_dead'] == 1
+        assert stats['urls_assigned'] == 1
+        assert stats['agents'] == 1
+
+        res = c.get('/urls/', {'job': job_id})
+        assert [t['url'] for t in res.json()] == ['http://crawl/1', 'http://crawl/2']
+
     def test_reconnect_agent(self):
         c = APIClient()
         agent_details = {
@@ -102,6 +171,123 @@ class MasterServerTestCase(TestCase):
         assert res.status_code == 201
         assert len(res.json()) == 3
 
+    def test_add_urls_bulk(self):
+        c = APIClient()
+        body = '\n'.join([
+            '{"url": "http://bulk1"}',
+            '{"url": "http://bulk2", "json_metadata": {"some": "data"}}',
+            'not json',
+            '',
+            '{"json_metadata": "no url"}',
+        ])
+        res = c.post('/urls/bulk/', body, content_type='application/x-ndjson')
+
+        assert res.status_code == 201
+        assert res.json() == {'created': 2, 'errors': 2, 'error_lines': [3, 5]}
+        assert UrlTask.objects.get(url='http://bulk2').json_metadata == '{"some": "data"}'
+        assert UrlTask.objects.get(url='http://bulk1').task_state == 'QUEUED'
+
+    def test_gzip_request(self):
+        c = APIClient()
+        body = gzip.compress(json.dumps([{'url': 'http://gzip1'}, {'url': 'http://gzip2'}]).encode())
+        res = c.post('/urls/', body, content_type='application/json', HTTP_CONTENT_ENCODING='gzip')
+
+        assert res.status_code == 201
+        assert UrlTask.objects.filter(url__startswith='http://gzip').count() == 2
+
+        body = gzip.compress(b'{"url": "http://gzip3"}\n{"url": "http://gzip4"}\n')
+        res = c.post('/urls/bulk/', body, content_type='application/x-ndjson',
+                     HTTP_CONTENT_ENCODING='gzip')
+        assert res.json()['created'] == 2
+
+        res = c.post('/urls/', b'not gzip', content_type='application/json',
+                     HTTP_CONTENT_ENCODING='gzip')
+        assert res.status_code == 400
+
+    def test_add_urls_bulk_csv(self):
+        c = APIClient()
+        body = 'url,json_metadata\nhttp://csv1,\n"http://csv2","{""a"": 1}"\n'
+        res = c.post('/urls/bulk/', body, content_type='text/csv')
+
+        assert res.json()['created'] == 2
+        assert UrlTask.objects.get(url='http://csv1').json_metadata is None
+        assert UrlTask.objects.get(url='http://csv2').json_metadata == '{"a": 1}'
+
+        # a row that isn't utf-8 is skipped, the rows after it are still added
+        body = b'url\nhttp://csv3\nhttp://csv\xff\nhttp://csv4\n'
+        res = c.post('/urls/bulk/', body, content_type='text/csv')
+        assert res.status_code == 201
+        assert res.json() == {'created': 2, 'errors': 1, 'error_lines': [3]}
+
+    def test_add_urls_dedup(self):
+        c = APIClient()
+        res = c.post('/urls/?dedup=1', [
+            {'url': 'http://Example.com:80/page?b=2&a=1#top'},
+            {'url': 'http://example.com/page?a=1&b=2'},
+            {'url': 'http://example.com/other'}
+        ], format='json')
+
+        assert res.status_code == 201
+        assert len(res.json()) == 2
+
+        res = c.post('/urls/?dedup=1', [{'url': 'http://example.com/other'},
+                                        {'url': 'http://example.com/new'}], format='json')
+        assert [t['url'] for t in res.json()] == ['http://example.com/new']
+
+        # without dedup the url is added again
+        res = c.post('/urls/', [{'url': 'http://example.com/other'}], format='json')
+        assert len(res.json()) == 1
+        assert UrlTask.objects.filter(url='http://example.com/other').count() == 2
+
+    @patch.dict(os.environ, {'PYMADA_STATS_COUNTERS': '1'})
+    def test_add_urls_dedup_race(self):
+        TaskCounter.objects.rebuild()
+        c = APIClient()
+
+        # another request adds one of the urls after the duplicate check
+        filter_urls = UrlTask.objects.filter
+        checked = []
+        def check_then_add(*args, **kwargs):
+            if len(checked) > 0:
+                return filter_urls(*args, **kwargs)
+
+            checked.append(True)
+            existing_hashes = list(filter_urls(*args, **kwargs).values_list('url_hash', flat=True))
+            c.post('/urls/?dedup=1', [{'url': 'http://example.com/a'}], format='json')
+            return Mock(values_list=Mock(return_value=existing_hashes))
+
+        with patch.object(UrlTask.objects, 'filter', side_effect=check_then_add):
+            res = c.post('/urls/?dedup=1', [{'url': 'http://example.com/a'},
+                                            {'url': 'http://example.com/b'}], format='json')
+
+        # only the task this request created is returned and counted
+        assert [t['url'] for t in res.json()] == ['http://example.com/b']
+        assert UrlTask.objects.filter(url='http://example.com/a').count() == 1
+        assert TaskCounter.objects.counts() == UrlTask.objects.state_counts()
+
+    def test_normalize_url_matches_agent(self):
+        # agents filter out urls they've seen with their own copy of
+        # normalize_url, as they don't have the master's code
+        agent_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..',
+                                  'agent', 'agent_server.py')
+        if not os.path.exists(agent_path):
+            self.skipTest('agent_server.py not found')
+
+        spec = importlib.util.spec_from_file_location('agent_server', agent_path)
+        agent_server = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(agent_server)
+
+        urls = {
+            'http://Example.com:80/page?b=2&a=1#top': 'http://example.com/page?a=1&b=2',
+            ' HTTPS://example.com:443 ': 'https://example.com/',
+            'https://example.com:8443/a?x=&x=1': 'https://example.com:8443/a?x=&x=1',
+            'http://example.com/a%20b?q=a+b': 'http://example.com/a%20b?q=a+b',
+            'example.com/page': 'example.com/page',
+        }
+        for url, normalized_url in urls.items():
+            assert ingest.normalize_url(url) == normalized_url
+            assert agent_server.normalize_url(url) == normalized_url
+
     def test_get_results(self):
         c = APIClient()
         res = c.get('/urls/')
@@ -110,6 +296,33 @@ class MasterServerTestCase(TestCase):
         assert type(res.json()) == list
         assert 'url' in res.json()[0]
 
+    def test_get_results_page(self):
+        c = APIClient()
+        res = c.get('/urls/', {'after_id': 0, 'limit': 4})
+        assert [t['id'] for t in res.json()] == [1, 2, 3, 4]
+
+        res = c.get('/urls/', {'after_id': 8, 'limit': 4})
+        assert [t['id'] for t in res.json()] == [9, 10]
+
+        res = c.get('/urls/', {'after_id': 'a'})
+        assert res.status_code == 400
+
+    def test_get_results_ndjson(self):
+        c = APIClient()
+        res = c.get('/urls/', {'output': 'ndjson'})
+
+        assert res.status_code == 200
+        assert res['Content-Type'] == 'application/x-ndjson'
+
+        tasks = [json.loads(line) for line in res.content.decode().splitlines()]
+        assert len(tasks) == 10
+        assert tasks[0] == c.get('/urls/').json()[0]
+
+        # one page at most, the rest are read with after_id
+        with patch('master_server.views.UrlList.max_page_size', 4):
+            res = c.get('/urls/', {'output': 'ndjson'})
+            assert [json.loads(line)['id'] for line in res.content.splitlines()] == [1, 2, 3, 4]
+
     def test_save_results(self):
         c = APIClient()
         result_data = {
@@ -121,6 +334,161 @@ class MasterServerTestCase(TestCase):
         assert res.status_code == 200
         assert UrlTask.objects.get(pk=1).task_result == '{"some":"data"}'
 
+        # the result is kept in its own table
+        assert TaskResult.objects.get(task=1).result == '{"some":"data"}'
+        assert UrlTask.objects.get(pk=1).result_size == 15
+        assert UrlTask.objects.get(pk=2).task_result is None
+
+        res = c.get('/urls/', {'min_id': 1, 'max_id': 1})
+        assert res.json()[0]['task_result'] == '{"some":"data"}'
+
+    @patch.dict(os.environ, {'PYMADA_TASK_BATCH_SIZE': '3'})
+    def test_save_results_batch(self):
+        c = APIClient()
+        res = c.post('/agents/1/state/', {'agent_state': 'IDLE'}, format='json')
+        task_ids = [t['id'] for t in res.json()['tasks']]
+
+        res = c.post('/urls/results/', {'results': [
+            {'id': task_ids[0], 'task_result': 'result 0'},
+            {'id': task_ids[1], 'task_result': 'result 1'},
+            {'id': 999, 'task_result': 'missing'}]}, format='json')
+
+        assert res.status_code == 200
+        assert res.json() == {'saved': 2, 'not_found': [999], 'duplicates': []}
+        assert UrlTask.objects.get(pk=task_ids[1]).task_result == 'result 1'
+        assert UrlTask.objects.get(pk=task_ids[1]).task_state == 'COMPLETE'
+
+        # the last task in the lease is started
+        assert Agent.objects.get(pk=1).assigned_task_id == task_ids[2]
+        assert UrlTask.objects.get(pk=task_ids[2]).start_time > 0
+
+        res = c.post('/urls/results/', {'results': [{'task_result': 'no id'}]}, format='json')
+        assert res.status_code == 400
+
+    @patch.dict(os.environ, {'PYMADA_RESULT_COMPRESSION': 'gzip'})
+    def test_save_results_compressed(self):
+        c = APIClient()
+        page = '<html>' + '<p>some text</p>' * 1000 + '</html>'
+
+        res = c.put('/urls/1/', {'url': 'http://0', 'task_result': page}, format='json')
+        assert res.status_code == 200
+        res = c.put('/urls/2/', {'url': 'http://1', 'task_result': 'small'}, format='json')
+        assert res.status_code == 200
+
+        stored = TaskResult.objects.get(task=1)
+        assert stored.codec == 'gzip'
+        assert len(stored.compressed_result) < len(page) / 10
+        assert TaskResult.objects.get(task=2).codec == ''
+
+        assert UrlTask.objects.get(pk=1).task_result == page
+        assert UrlTask.objects.get(pk=1).result_size == len(page)
+
+        res = c.get('/urls/', {'min_id': 1, 'max_id': 2, 'output': 'ndjson'})
+        exported = [json.loads(l) for l in res.content.splitlines()]
+        assert [t['task_result'] for t in exported] == [page, 'small']
+
+    def test_report_agent_state_assigns_task(self):
+        c = APIClient()
+        res = c.post('/agents/1/state/', {'agent_state': 'IDLE', 'exit_code': 0},
+                     format='json')
+
+        assert res.status_code == 200
+        task = res.json()['tasks'][0]
+        assert Agent.objects.get(pk=1).assigned_task_id == task['id']
+        assert UrlTask.objects.get(pk=task['id']).task_state == 'ASSIGNED'
+
+        # the runner exited without saving a result
+        res = c.post('/agents/1/state/', {'agent_state': 'IDLE', 'exit_code': 1,
+                     'task_ids': [task['id']]}, format='json')
+
+        assert res.status_code == 200
+        assert UrlTask.objects.get(pk=task['id']).fail_num == 1
+        assert res.json()['tasks'][0]['id'] != task['id']
+
+    def test_report_agent_state_stale_task(self):
+        c = APIClient()
+        res = c.post('/agents/1/state/', {'agent_state': 'IDLE'}, format='json')
+        task_id = res.json()['tasks'][0]['id']
+
+        # report for a task the agent is no longer assigned doesnt fail or
+        # replace the current task. The agent can't have got the response
+        # that leased the task (eg it timed out and the report was sent
+        # again), so the task is sent again
+        res = c.post('/agents/1/state/', {'agent_state': 'IDLE', 'task_ids': [999]},
+                     format='json')
+
+        assert [t['id'] for t in res.json()['tasks']] == [task_id]
+        assert Agent.objects.get(pk=1).assigned_task_id == task_id
+        assert UrlTask.objects.get(pk=task_id).fail_num == 0
+
+    def test_report_agent_state_per_slot(self):
+        Agent.objects.filter(pk=1).update(capacity=2)
+        UrlTask.objects.exclude(pk=1).update(task_state='COMPLETE')
+
+        c = APIClient()
+        res = c.post('/agents/1/state/', {'agent_state': 'IDLE', 'slot': 0}, format='json')
+        assert len(res.json()['tasks']) == 1
+        assert res.json()['agent_state'] == 'RUNNING'
+
+        # the other slot is free, so the agent still is, whatever slot 0 reports
+        res = c.post('/agents/1/state/', {'agent_state': 'IDLE', 'slot': 1}, format='json')
+        assert res.json()['tasks'] == []
+        assert res.json()['agent_state'] == 'IDLE'
+
+        res = c.post('/agents/1/state/', {'agent_state': 'RUNNING', 'slot': 0}, format='json')
+        assert res.json()['agent_state'] == 'IDLE'
+        assert Agent.objects.get(pk=1).agent_state == 'IDLE'
+
+    def test_report_agent_state_invalid(self):
+        c = APIClient()
+        res = c.post('/agents/1/state/', {'agent_state': 'LOST'}, format='json')
+        assert res.status_code == 400
+
+        for data in [{'slot': '1'}, {'slot': -1}, {'task_ids': 'abc'}, {'task_ids': ['1']}]:
+            res = c.post('/agents/1/state/', {'agent_state': 'IDLE', **data}, format='json')
+            assert res.status_code == 400
+
+    def test_stats(self):
+        UrlTask.objects.filter(pk__in=[1, 2]).update(task_state='COMPLETE', fail_num=1)
+
+        c = APIClient()
+        res = c.get('/stats/').json()
+
+        assert res['urls'] == 10
+        assert res['urls_queued'] == 8
+        assert res['urls_complete'] == 2
+        assert res['urls_failed_min_once'] == 2
+        assert res['registered_agents'] == 3
+
+        res = c.get('/url_tasks_length/', {'state': 'queued'})
+        assert res.json()['url_tasks'] == 8
+        assert res.json()['max_id'] == 10
+
+    @patch.dict(os.environ, {'PYMADA_STATS_COUNTERS': '1'})
+    def test_stats_counters(self):
+        TaskCounter.objects.rebuild()
+
+        c = APIClient()
+        c.post('/urls/', [{'url': 'http://test1'}, {'url': 'http://test2'}], format='json')
+        res = c.post('/agents/1/state/', {'agent_state': 'IDLE'}, format='json')
+        task_id = res.json()['tasks'][0]['id']
+
+        # runner exits without a result, then the next task is saved
+        res = c.post('/agents/1/state/', {'agent_state': 'IDLE', 'task_ids': [task_id]},
+                     format='json')
+        next_task = res.json()['tasks'][0]
+        c.put('/urls/' + str(next_task['id']) + '/', next_task, format='json')
+
+        counts = TaskCounter.objects.counts()
+        assert counts == UrlTask.objects.state_counts()
+        assert counts['urls'] == 12
+        assert counts['COMPLETE'] == 1
+        assert counts['failed_min_once'] == 1
+
+        # counters are used for the stats, not the UrlTask table
+        TaskCounter.objects.filter(name='QUEUED').update(value=100)
+        assert c.get('/stats/').json()['urls_queued'] == 100
+
     def test_add_error_log(self):
         c = APIClient()
         err_info = {
@@ -143,6 +511,48 @@ class MasterServerTestCase(TestCase):
 
 
 
+class AsgiTestCase(TransactionTestCase):
+    '''
+    requests through the ASGI handler uvicorn runs the master with, which
+    iterates streaming responses in the event loop
+    '''
+
+    def setUp(self):
+        User.objects.create_user('pymadauser', None, None)
+
+        for i in range(5):
+            UrlTask.objects.create(url='http://' + str(i))
+
+    async def asgi_get(self, path, query_string):
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        await get_asgi_application()({
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+            'method': 'GET', 'scheme': 'http', 'path': path,
+            'query_string': query_string.encode(), 'headers': [],
+            'server': ('testserver', 80), 'client': ('127.0.0.1', 5000)
+        }, receive, send)
+
+        return messages
+
+    def test_get_results_ndjson(self):
+        messages = async_to_sync(self.asgi_get)('/urls/', 'output=ndjson')
+
+        assert messages[0]['status'] == 200
+        body = b''.join(m.get('body', b'') for m in messages[1:])
+        assert [json.loads(line)['id'] for line in body.splitlines()] == [1, 2, 3, 4, 5]
+
+        messages = async_to_sync(self.asgi_get)('/urls/', 'output=ndjson&after_id=1&limit=2')
+        body = b''.join(m.get('body', b'') for m in messages[1:])
+        assert [json.loads(line)['id'] for line in body.splitlines()] == [2, 3]
+
+
 class ControlTestCast(TestCase):
     def setUp(self):
         User.objects.create_user('pymadauser', None, None)
@@ -166,6 +576,260 @@ class ControlTestCast(TestCase):
             task = UrlTask.objects.create(url='http://' + str(i))
             task.save()
 
+    def test_claim_task(self):
+        task1 = UrlTask.objects.claim(1)[0]
+        task2 = UrlTask.objects.claim(2)[0]
+
+        assert task1.id != task2.id
+        assert UrlTask.objects.get(pk=task1.id).task_state == 'ASSIGNED'
+        assert UrlTask.objects.get(pk=task1.id).assigned_agent_id == 1
+        assert Agent.objects.get(pk=2).assigned_task_id == task2.id
+        assert Agent.objects.get(pk=2).agent_state == 'ASSIGNED'
+
+        # agent 1 slot 0 already has a task
+        assert UrlTask.objects.claim(1) == []
+        assert len(UrlTask.objects.filter(task_state='ASSIGNED')) == 2
+
+        # job pick, claim, read back the tasks, then the job and the agent.
+        # claim runs for every task, benchmark.py claim before adding to this
+        with self.assertNumQueries(5):
+            UrlTask.objects.claim(3)
+
+    def test_claim_task_empty_queue(self):
+        UrlTask.objects.update(task_state='COMPLETE')
+        assert UrlTask.objects.claim(1) == []
+        assert Agent.objects.get(pk=1).assigned_task is None
+
+    def test_claim_jobs_weighted(self):
+        # the default job has been running a while before a small, heavier
+        # weighted job is added
+        for _ in range(3):
+            UrlTask.objects.filter(pk=UrlTask.objects.claim(1)[0].pk).update(task_state='COMPLETE')
+
+        urgent_job = Job.objects.create(name='urgent', weight=2)
+        for i in range(4):
+            UrlTask.objects.create(url='http://urgent/' + str(i), job=urgent_job, priority=i)
+
+        claimed_jobs = []
+        for _ in range(6):
+            task = UrlTask.objects.claim(1)[0]
+            claimed_jobs.append(task.job_id)
+            UrlTask.objects.filter(pk=task.pk).update(task_state='COMPLETE')
+
+        # two urgent tasks for each default one, highest priority first
+        assert claimed_jobs == [urgent_job.pk, urgent_job.pk, 1, urgent_job.pk, urgent_job.pk, 1]
+        assert list(UrlTask.objects.filter(job=urgent_job).order_by('end_time', '-priority')
+                    .values_list('priority', flat=True)) == [3, 2, 1, 0]
+
+    @patch.dict(os.environ, {'PYMADA_HOST_MAX_CONCURRENT': '1', 'PYMADA_HOST_RATE': '0.001',
+                             'PYMADA_HOST_BURST': '2'})
+    def test_claim_host_limits(self):
+        for i in range(5):
+            UrlTask.objects.create(url='http://busy.com/' + str(i), priority=1)
+
+        tasks = UrlTask.objects.claim(1, num_tasks=3)
+        assert [t.host for t in tasks] == ['busy.com', '0', '1']
+
+        # busy.com is running a task, its others are skipped
+        tasks = UrlTask.objects.claim(2, num_tasks=3)
+        assert [t.host for t in tasks] == ['2', '3', '4']
+
+        # its second token is used once the first task finishes, then it has
+        # to wait for the bucket to refill
+        UrlTask.objects.filter(host='busy.com', task_state='ASSIGNED').update(task_state='COMPLETE')
+        assert UrlTask.objects.claim(3)[0].host == 'busy.com'
+        UrlTask.objects.filter(host='busy.com', task_state='ASSIGNED').update(task_state='COMPLETE')
+        UrlTask.objects.filter(assigned_agent=3).update(task_state='COMPLETE')
+        assert UrlTask.objects.claim(3)[0].host == '5'
+
+        # tasks behind the front of the queue are found through the host buckets
+        HostBucket.objects.register(['9'])
+        limits = HostBucket.objects.limits()
+        assert UrlTask.objects.filter(pk__in=HostBucket.objects.pick_tasks(
+            1, 1, limits, window_size=1)).get().host == '9'
+
+    @patch.dict(os.environ, {'PYMADA_STATS_COUNTERS': '1'})
+    def test_fail_task_retry_delay(self):
+        UrlTask.objects.exclude(pk=1).update(task_state='COMPLETE')
+        TaskCounter.objects.rebuild()
+
+        task = UrlTask.objects.claim(1)[0]
+        control.task_queue.fail_task(1, task.id, 2)
+
+        # the task waits out its retry delay before it can be claimed again
+        failed_task = UrlTask.objects.get(pk=task.id)
+        assert failed_task.task_state == 'QUEUED'
+        assert failed_task.not_before > time.time() + 5
+        assert UrlTask.objects.claim(1) == []
+
+        UrlTask.objects.filter(pk=task.id).update(not_before=time.time())
+        assert UrlTask.objects.claim(1)[0].id == task.id
+
+        # out of retries
+        control.task_queue.fail_task(1, task.id, 2)
+        assert UrlTask.objects.get(pk=task.id).task_state == 'DEAD'
+        assert TaskCounter.objects.counts()['DEAD'] == 1
+        assert TaskCounter.objects.counts() == UrlTask.objects.state_counts()
+
+    @patch.dict(os.environ, {'PYMADA_SPECULATE_AFTER_SECONDS': '30'})
+    def test_speculative_copies(self):
+        UrlTask.objects.exclude(pk__in=[1, 2, 3]).update(task_state='COMPLETE')
+        tasks = [UrlTask.objects.claim(agent_id)[0] for agent_id in (1, 2)]
+        UrlTask.objects.filter(pk=tasks[0].id).update(start_time=time.time() - 60)
+
+        # the queue isn't empty yet
+        assert control.task_queue.find_speculative_task(3) is None
+        UrlTask.objects.filter(pk=3).update(task_state='COMPLETE')
+
+        # an idle slot gets a copy of the slow task, which is only copied once
+        task_data = control.task_queue.find_assign_task(3)
+        assert [t['id'] for t in task_data['tasks']] == [tasks[0].id]
+        assert task_data['tasks'][0]['assigned_agent'] == 3
+        assert control.task_queue.find_assign_task(3, slot=1) is None
+        assert len(async_to_sync(control.get_agent_task_start_times)(3)) == 1
+
+        # the copy wins, so the original is killed and its result ignored
+        c = APIClient()
+        res = c.post('/urls/results/', {'results': [{'id': tasks[0].id, 'task_result': 'copy',
+                                                     'assigned_agent': 3, 'assigned_slot': 0}]},
+                     format='json')
+        assert res.json()['saved'] == 1
+        assert control.task_queue.lost_speculative_runs() == [(1, 0, tasks[0].id)]
+        assert control.task_queue.lost_speculative_runs() == []
+
+        res = c.put('/urls/' + str(tasks[0].id) + '/', {'url': tasks[0].url,
+                    'task_result': 'original', 'assigned_agent': 1}, format='json')
+        assert res.status_code == 200
+        assert UrlTask.objects.get(pk=tasks[0].id).task_result == 'copy'
+        assert len(UrlTask.objects.leased(1)) == 0
+
+        # the lease of the other task fails while its copy runs, the copy
+        # carries on in its place
+        UrlTask.objects.filter(pk=tasks[1].id).update(start_time=time.time() - 60)
+        assert control.task_queue.find_assign_task(3, slot=1)['tasks'][0]['id'] == tasks[1].id
+        control.task_queue.fail_unreturned_task(2, 3)
+
+        task = UrlTask.objects.get(pk=tasks[1].id)
+        assert task.task_state == 'ASSIGNED' and task.fail_num == 1
+        assert (task.assigned_agent_id, task.assigned_slot) == (3, 1)
+        assert not SpeculativeRun.objects.get(task=task).running
+
+        res = c.put('/urls/' + str(task.id) + '/', {'url': task.url, 'task_result': 'done',
+                    'assigned_agent': 3, 'assigned_slot': 1}, format='json')
+        assert UrlTask.objects.get(pk=task.id).task_state == 'COMPLETE'
+        assert control.task_queue.lost_speculative_runs() == []
+
+    @patch.dict(os.environ, {'PYMADA_SPECULATE_AFTER_SECONDS': '30'})
+    def test_speculative_copy_wins_by_put(self):
+        UrlTask.objects.exclude(pk__in=[1, 2]).update(task_state='COMPLETE')
+        slow_task = UrlTask.objects.claim(1, slot=0)[0]
+        other_task = UrlTask.objects.claim(1, slot=1)[0]
+        UrlTask.objects.filter(pk=slow_task.id).update(start_time=time.time() - 60)
+
+        task_data = control.task_queue.find_assign_task(2, slot=1)['tasks'][0]
+        assert (task_data['id'], task_data['assigned_slot']) == (slow_task.id, 1)
+
+        # the copy's result comes back with the copy's slot, the original
+        # agent's slot 1 is left alone
+        c = APIClient()
+        res = c.put('/urls/' + str(slow_task.id) + '/', dict(task_data, task_result='copy'),
+                    format='json')
+        assert res.status_code == 200
+        other_task = UrlTask.objects.get(pk=other_task.id)
+        assert (other_task.task_state, other_task.fail_num) == ('ASSIGNED', 0)
+        assert (other_task.assigned_agent_id, other_task.assigned_slot) == (1, 1)
+        assert control.task_queue.lost_speculative_runs() == [(1, 0, slow_task.id)]
+
+    def test_claim_batch(self):
+        # a claim plus clearing the start_time of the rest of the batch. The
+        # results are read with the tasks, not in a query per task.
+        with self.assertNumQueries(6):
+            task_data = control.task_queue.find_assign_task(2, batch_size=4)
+        assert len(task_data['tasks']) == 4
+
+        tasks = UrlTask.objects.claim(1, num_tasks=4)
+
+        assert len(tasks) == 4
+        assert Agent.objects.get(pk=1).assigned_task_id == tasks[0].id
+        assert tasks[0].start_time > 0
+        assert [t.start_time for t in tasks[1:]] == [0, 0, 0]
+        assert len(UrlTask.objects.leased(1)) == 4
+
+        # each result moves the agent on to the next task in the lease
+        c = APIClient()
+        res = c.put('/urls/' + str(tasks[0].id) + '/', {'url': tasks[0].url,
+                    'task_result': 'done'}, format='json')
+        assert res.status_code == 200
+        agent = Agent.objects.get(pk=1)
+        assert agent.assigned_task_id == tasks[1].id
+        assert agent.assigned_task.start_time > 0
+
+        # agent goes idle after the second task without saving a result,
+        # second task fails and the rest go back in the queue
+        control.task_queue.fail_unreturned_task(1, 3)
+        assert UrlTask.objects.get(pk=tasks[1].id).fail_num == 1
+        assert UrlTask.objects.get(pk=tasks[2].id).task_state == 'QUEUED'
+        assert UrlTask.objects.get(pk=tasks[2].id).fail_num == 0
+        assert len(UrlTask.objects.leased(1)) == 0
+        assert Agent.objects.get(pk=1).assigned_task is None
+
+    def test_schedule_check_keeps_soonest(self):
+        controller = control.Control()
+        controller.schedule_check(1, 10)
+        controller.schedule_check(1, 0)
+        controller.schedule_check(1, 20)
+        controller.schedule_check(2, 30)
+
+        assert controller.pop_due_checks(now=time.time() + 1) == [1]
+        assert controller.pop_due_checks(now=time.time() + 60) == [2]
+        assert len(controller.next_check) == 0
+
+    def test_check_deleted_agent(self):
+        controller = control.Control()
+        controller.agents_being_checked.add(1)
+        controller.schedule_check(1)
+        controller.checks_in_progress.update(controller.pop_due_checks())
+        Agent.objects.filter(pk=1).delete()
+
+        async def check_agent():
+            controller.check_semaphore = asyncio.Semaphore()
+            await controller.check_agent(1)
+
+        # the agent is dropped instead of being checked again
+        async_to_sync(check_agent)()
+        assert controller.agents_being_checked == set()
+        assert controller.checks_in_progress == set()
+        assert len(controller.next_check) == 0
+
+    def test_check_interval(self):
+        controller = control.Control(idle_check_interval=2, running_check_interval=15)
+
+        assert controller.next_check_interval('IDLE') == 2
+        assert controller.next_check_interval('RUNNING') == 15
+        assert controller.next_check_interval('RUNNING', task_time_left=4) == 4
+        assert controller.next_check_interval('LOST') == 15
+
+    def test_agent_task_start_times(self):
+        assert async_to_sync(control.get_agent_task_start_times)(1) == []
+
+        tasks = UrlTask.objects.claim(1, num_tasks=2, slot=2)
+
+        assert async_to_sync(control.get_agent_task_start_times)(1) == [
+            (2, tasks[0].start_time)]
+
+    def test_claim_per_slot(self):
+        slot0 = UrlTask.objects.claim(1, slot=0)
+        slot1 = UrlTask.objects.claim(1, slot=1)
+
+        assert len(slot0) == 1 and len(slot1) == 1
+        assert UrlTask.objects.claim(1, slot=1) == []
+        assert UrlTask.objects.get(pk=slot1[0].id).assigned_slot == 1
+
+        # idle report for slot 1 only touches slot 1
+        control.task_queue.fail_unreturned_task(1, 3, slot=1)
+        assert UrlTask.objects.get(pk=slot1[0].id).task_state == 'QUEUED'
+        assert UrlTask.objects.get(pk=slot0[0].id).task_state == 'ASSIGNED'
+
 
     '''
     @patch('control.requests.post')
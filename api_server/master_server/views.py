@@ -1,5 +1,8 @@
 import time
 import os
+import json
+import logging
+from django.db.models import F
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status, authentication
@@ -9,9 +12,11 @@ from rest_framework.permissions import IsAuthenticated
 from django.contrib.auth.models import User
 from django.http import Http404, JsonResponse, HttpResponse
 from PIL import Image
-from master_server.models import UrlTask, Agent, Runner, ErrorLog, Screenshot
+from master_server.models import (UrlTask, Agent, AgentSlot, Runner, ErrorLog, Screenshot,
+            TaskCounter, Job, HostBucket)
 from master_server.serializers import (UrlTaskSerializer, AgentSerializer,
-            RunnerSerializer, ErrorLogSerializer, ScreenshotSerializer)
+            RunnerSerializer, ErrorLogSerializer, ScreenshotSerializer, JobSerializer)
+from master_server import task_queue, ingest, compression
 
 
 ''' 
@@ -41,26 +46,159 @@ class EnvTokenAPIView(APIView):
     authentication_classes = [EnvTokenAuth]
     permission_classes = [IsAuthenticated]
 
+
+def get_task_counts():
+    if TaskCounter.objects.enabled():
+        return TaskCounter.objects.counts()
+
+    return UrlTask.objects.state_counts()
+
+
+def ndjson_page(url_tasks):
+    '''
+    the tasks, one json object per line. The results are read in the same
+    query as the tasks.
+    '''
+    fields = [f for f in UrlTaskSerializer.Meta.fields if f != 'task_result']
+    url_tasks = url_tasks.values(*fields, result_text=F('result__result'),
+                                 compressed_result=F('result__compressed_result'),
+                                 codec=F('result__codec'))
+
+    lines = []
+    for url_task in url_tasks:
+        url_task['task_result'] = compression.decode_result(url_task.pop('result_text'),
+                                                            url_task.pop('compressed_result'),
+                                                            url_task.pop('codec'))
+        lines.append(json.dumps(url_task) + '\n')
+
+    return ''.join(lines)
+
+
 class UrlList(EnvTokenAPIView):
 
+    max_page_size = 10000
+
     def get(self, request, format=None):
+        '''
+        Query parameters:
+            min_id, max_id: tasks with ids in the range (inclusive)
+            after_id, limit: keyset pagination, up to limit tasks (default
+                and max 10000) with ids greater than after_id in id order.
+                The next page starts after the last id in the page.
+            output=ndjson: the tasks as newline delimited json instead of a
+                json list. At most max_page_size tasks are returned, larger
+                exports page through them with after_id.
+            job: only the tasks in the job
+        '''
+        urls = UrlTask.objects.order_by('pk')
+
+        if 'job' in request.query_params:
+            urls = urls.filter(job=request.query_params['job'])
+
         if 'min_id' in request.query_params and 'max_id' in request.query_params:
             min_id = request.query_params['min_id']
             max_id = request.query_params['max_id']
-            urls = UrlTask.objects.filter(pk__gte=min_id, pk__lte=max_id)
+            urls = urls.filter(pk__gte=min_id, pk__lte=max_id)
+
+        if 'after_id' in request.query_params or 'limit' in request.query_params:
+            try:
+                after_id = int(request.query_params.get('after_id', 0))
+                limit = int(request.query_params.get('limit', self.max_page_size))
+            except ValueError:
+                return Response({'error': 'after_id and limit need to be integers'},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+            limit = max(min(limit, self.max_page_size), 0)
+            urls = urls.filter(pk__gt=after_id)
         else:
-            urls = UrlTask.objects.all()
-        serializer = UrlTaskSerializer(urls, many=True)
+            limit = None
+
+        # the body is built here rather than streamed: under ASGI a streaming
+        # response is iterated on the event loop, so its queries would hold up
+        # every other request
+        if request.query_params.get('output') == 'ndjson':
+            if limit is None:
+                limit = self.max_page_size
+
+            return HttpResponse(ndjson_page(urls[:limit]), content_type='application/x-ndjson')
+
+        if limit is not None:
+            urls = urls[:limit]
+
+        serializer = UrlTaskSerializer(urls.select_related('result'), many=True)
         return Response(serializer.data)
 
     def post(self, request, format=None):
         serializer = UrlTaskSerializer(data=request.data, many=True)
         if serializer.is_valid():
-            serializer.save()
+            # with ?dedup=1 urls that were already added (with dedup) are
+            # skipped, only the tasks created are returned
+            if request.query_params.get('dedup') in ('1', 'true'):
+                created_tasks = ingest.create_deduplicated(serializer.validated_data)
+                serializer = UrlTaskSerializer(created_tasks, many=True)
+            else:
+                created_tasks = serializer.save()
+
+            created_counts = {'urls': len(created_tasks)}
+            for task in created_tasks:
+                created_counts[task.task_state] = created_counts.get(task.task_state, 0) + 1
+            TaskCounter.objects.add(**created_counts)
+            HostBucket.objects.register(task.host for task in created_tasks)
+
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class UrlBulk(EnvTokenAPIView):
+
+    def post(self, request, format=None):
+        '''
+        Adds urls from a newline delimited json body (one {"url": ...,
+        "json_metadata": ..., "job": ..., "priority": ...} object per line,
+        only url is required) or, with a text/csv content type, a csv body
+        with a header row. Returns the number of tasks
+        created and the rows that were skipped:
+            {'created': int, 'errors': int, 'error_lines': [int]}
+        '''
+        # the body is read a line at a time straight from the request, it's
+        # never parsed by DRF or held in memory as a whole
+        body_lines = iter(request._request)
+
+        if request.content_type.startswith('text/csv'):
+            rows = ingest.parse_csv(body_lines)
+        else:
+            rows = ingest.parse_ndjson(body_lines)
+
+        # rows that can't be used, including lines that aren't utf-8, are
+        # counted in errors. Nothing fails part way through after some of the
+        # tasks were created.
+        return Response(ingest.ingest(rows), status=status.HTTP_201_CREATED)
+
+
+class UrlResults(EnvTokenAPIView):
+
+    max_results = 1000
+
+    def post(self, request, format=None):
+        '''
+        Saves the results of many tasks in one request, for agents running
+        lots of short tasks. The body is {'results': [{'id': int,
+        'task_result': str}, ...]} and the response just has the number saved
+        and any ids that don't exist or already had a result from another copy
+        of the task:
+            {'saved': int, 'not_found': [int], 'duplicates': [int]}
+        '''
+        task_results = request.data.get('results') if type(request.data) is dict else None
+
+        if (type(task_results) is not list or len(task_results) > self.max_results or
+                any(type(r) is not dict or type(r.get('id')) is not int for r in task_results)):
+            return Response({'error': 'results needs to be a list of up to ' +
+                             str(self.max_results) + ' {"id": int, "task_result": str} objects'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(task_queue.complete_tasks(task_results))
+
+
 class UrlSingle(EnvTokenAPIView):
 
     def get_task(self, pk):
@@ -72,14 +210,26 @@ class UrlSingle(EnvTokenAPIView):
     def put(self, request, pk, format=None):
         task = self.get_task(pk)
 
+        # the task was copied to another agent and its result is already in
+        if task_queue.is_losing_copy(task):
+            return Response(UrlTaskSerializer(task).data, status=status.HTTP_200_OK)
+
         agent = task.assigned_agent
+        slot = task.assigned_slot
+        previous_state = task.task_state
+        previously_failed = task.fail_num >= 1
 
         serializer = UrlTaskSerializer(task, data=request.data)
         if serializer.is_valid():
-            if agent is not None:
-                agent.assigned_task = None
-                agent.save()
+            task_queue.settle_speculative_runs([(task, request.data.get('assigned_agent'),
+                                                 request.data.get('assigned_slot', 0))])
             serializer.save(task_state='COMPLETE', end_time=time.time(), assigned_agent=None)
+            TaskCounter.objects.move(previous_state, 'COMPLETE')
+            if previously_failed != (task.fail_num is not None and task.fail_num >= 1):
+                TaskCounter.objects.add(failed_min_once=-1 if previously_failed else 1)
+
+            if agent is not None:
+                task_queue.start_next_leased_task(agent.id, slot, [task.id])
             return Response(serializer.data, status=status.HTTP_200_OK)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -94,12 +244,16 @@ class UrlListLength(EnvTokenAPIView):
             req_state = request.query_params['state'].lower()
 
             if req_state in avail_states:
-                url_tasks_len = len(UrlTask.objects.filter(task_state=req_state.upper()))
+                url_tasks_len = get_task_counts()[req_state.upper()]
         else:
-            url_tasks_len = len(UrlTask.objects.all())
+            url_tasks_len = get_task_counts()['urls']
+
+        # highest task id, for clients paging through the tasks by id range
+        max_id = UrlTask.objects.order_by('-pk').values_list('pk', flat=True).first()
 
         return JsonResponse({
-            'url_tasks': url_tasks_len
+            'url_tasks': url_tasks_len,
+            'max_id': max_id
         })
 
 
@@ -109,6 +263,12 @@ class RegisterAgent(EnvTokenAPIView):
         if serializer.is_valid():
             agent_search = Agent.objects.filter(hostname=serializer.validated_data['hostname'],
                 agent_url=serializer.validated_data['agent_url'])
+
+            # an agent bound to a job runs the job's runner, the agent gets
+            # the runner to use from the response
+            job = serializer.validated_data.get('job')
+            if job is not None and job.runner_id is not None:
+                serializer.validated_data['runner_num'] = job.runner_id
             
             if len(agent_search) == 0:
                 print('new agent', request.data)
@@ -117,6 +277,11 @@ class RegisterAgent(EnvTokenAPIView):
             
             recorded_agent = agent_search[0]
             print('reconnect agent ' + str(recorded_agent.id))
+
+            for field in ('capacity', 'job', 'runner_num'):
+                if field in serializer.validated_data:
+                    setattr(recorded_agent, field, serializer.validated_data[field])
+            recorded_agent.save()
             recorded_s = AgentSerializer(recorded_agent)
             
             return Response(recorded_s.data, status=status.HTTP_200_OK)
@@ -133,6 +298,63 @@ class ListAgents(EnvTokenAPIView):
         serializer = AgentSerializer(agents, many=True)
         return Response(serializer.data)
 
+'''
+Agents push their runner state here as soon as it changes (eg the runner
+process exiting) instead of waiting for the control loop to poll
+/check_runner. When an agent reports IDLE, the next batch of tasks is
+assigned and returned in the response so the agent can start it straight
+away.
+'''
+class AgentStateReport(EnvTokenAPIView):
+    accepted_states = ('IDLE', 'RUNNING', 'NO_RUNNER')
+
+    def post(self, request, pk, format=None):
+        if not Agent.objects.filter(pk=pk).exists():
+            raise Http404
+
+        new_state = request.data.get('agent_state')
+        if new_state not in self.accepted_states:
+            return Response({'error': 'agent_state needs to be one of: ' +
+                             ', '.join(self.accepted_states)},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        slot = request.data.get('slot', 0)
+        finished_task_ids = request.data.get('task_ids')
+        exit_code = request.data.get('exit_code')
+
+        if type(slot) is not int or slot < 0:
+            return Response({'error': 'slot needs to be an int of at least 0'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        if finished_task_ids is not None and (type(finished_task_ids) is not list or
+                any(type(task_id) is not int for task_id in finished_task_ids)):
+            return Response({'error': 'task_ids needs to be a list of ints'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        if exit_code is not None and exit_code != 0:
+            logging.warning('agent ' + str(pk) + ' slot ' + str(slot) +
+                            ' runner exited with code ' + str(exit_code))
+
+        tasks = []
+        if new_state == 'IDLE':
+            if finished_task_ids is not None:
+                task_queue.fail_unreturned_task(pk, task_queue.get_max_task_retries(),
+                                                slot=slot, task_ids=finished_task_ids)
+
+            task_data = task_queue.find_assign_task(pk, slot=slot)
+            if task_data is not None:
+                tasks = task_data['tasks']
+
+        agent_state = AgentSlot.objects.report(pk, {slot: 'RUNNING' if len(tasks) > 0 else new_state})
+        Agent.objects.filter(pk=pk).update(agent_state=agent_state,
+                                           last_contact_attempt=time.time())
+
+        return Response({
+            'agent_state': agent_state,
+            'slot': slot,
+            'tasks': tasks
+        })
+
 class RegisterRunner(EnvTokenAPIView):
     def get(self, request, format=None):
         runners = Runner.objects.all()
@@ -167,6 +389,59 @@ class RunnerSingle(EnvTokenAPIView):
         return Response(serializer.data)
 
 
+class Jobs(EnvTokenAPIView):
+    def get(self, request, format=None):
+        jobs = Job.objects.order_by('pk')
+        if 'name' in request.query_params:
+            jobs = jobs.filter(name=request.query_params['name'])
+
+        serializer = JobSerializer(jobs, many=True)
+        return Response(serializer.data)
+
+    def post(self, request, format=None):
+        serializer = JobSerializer(data=request.data)
+        if serializer.is_valid():
+            serializer.save()
+            return Response(serializer.data, status=status.HTTP_201_CREATED)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+class JobSingle(EnvTokenAPIView):
+
+    def get_job(self, pk):
+        try:
+            return Job.objects.get(pk=pk)
+        except Job.DoesNotExist:
+            raise Http404
+
+    def get(self, request, pk, format=None):
+        serializer = JobSerializer(self.get_job(pk))
+        return Response(serializer.data)
+
+    def put(self, request, pk, format=None):
+        serializer = JobSerializer(self.get_job(pk), data=request.data, partial=True)
+        if serializer.is_valid():
+            serializer.save()
+            return Response(serializer.data)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class JobStats(EnvTokenAPIView):
+    def get(self, request, pk, format=None):
+        if not Job.objects.filter(pk=pk).exists():
+            raise Http404
+
+        task_counts = UrlTask.objects.state_counts(job_id=pk)
+        return JsonResponse({
+            'urls': task_counts['urls'],
+            'urls_queued': task_counts['QUEUED'],
+            'urls_assigned': task_counts['ASSIGNED'],
+            'urls_complete': task_counts['COMPLETE'],
+            'urls_dead': task_counts['DEAD'],
+            'urls_failed_min_once': task_counts['failed_min_once'],
+            'agents': Agent.objects.filter(job=pk).count(),
+        })
+
+
 class ErrorLogs(EnvTokenAPIView):
     def get(self, request, format=None):
         errs = ErrorLog.objects.all()
@@ -227,19 +502,22 @@ class ScreenshotSingle(EnvTokenAPIView):
 
 class GetStats(EnvTokenAPIView):
     def get(self, request, format=None):
-        urls = len(UrlTask.objects.all())
-        urls_queued = len(UrlTask.objects.filter(task_state='QUEUED'))
-        urls_assigned = len(UrlTask.objects.filter(task_state='ASSIGNED'))
-        urls_complete = len(UrlTask.objects.filter(task_state='COMPLETE'))
-        urls_failed_once = len(UrlTask.objects.filter(fail_num__gte=1))
-        registered_agents = len(Agent.objects.all())
-
-        errs = len(ErrorLog.objects.all())
+        task_counts = get_task_counts()
+        urls = task_counts['urls']
+        urls_queued = task_counts['QUEUED']
+        urls_assigned = task_counts['ASSIGNED']
+        urls_complete = task_counts['COMPLETE']
+        urls_dead = task_counts['DEAD']
+        urls_failed_once = task_counts['failed_min_once']
+        registered_agents = Agent.objects.count()
+
+        errs = ErrorLog.objects.count()
         return JsonResponse({
             'urls': urls,
             'urls_queued': urls_queued,
             'urls_assigned': urls_assigned,
             'urls_complete': urls_complete,
+            'urls_dead': urls_dead,
             'urls_failed_min_once': urls_failed_once,
             'errors_logged': errs,
             'registered_agents': registered_agents,
@@ -8,10 +8,12 @@ import yaml
 from tabulate import tabulate
 
 from .provision import (launch_all, terminate_all, AVAILABLE_PROVIDERS)
-from .kube import (get_deployment_status,
-                   delete_all_deployments, get_pod_list, get_pod_logs, get_node_list)
+from .kube import (get_deployment_status, delete_deployment, agent_deployment_name,
+                   scale_agent_deployment, delete_all_deployments, get_pod_list,
+                   get_pod_logs, get_node_list)
 from .master_client import (read_provision_settings, request_master, add_runner, 
-                            add_url, get_results, list_screenshots,
+                            add_url, upload_urls, read_urls, print_upload_result,
+                            export_results, get_job, list_screenshots,
                             list_screenshots_by_task, download_screenshot,
                             get_url_tasks, list_agents)
 from .run import load_pymada_settings, run_agent
@@ -100,9 +102,12 @@ requires:
 @click.option('--pymada-settings-path', default=None)
 @click.option('--kube-config-path', default=None)
 @click.option('--provision-data-path', default=None)
+@click.option('--job', default=None, help='run the runner as this job, the agents only run its tasks')
+@click.option('--job-weight', default=None, type=float,
+              help='share of the agents the job gets relative to other jobs (default 1)')
 def run(agent_type, runner, replicas=1, dependency_file=None, master_url=None,
         no_kube_deploy=False, no_token_auth=False, pymada_settings_path=None,
-        kube_config_path=None, provision_data_path=None):
+        kube_config_path=None, provision_data_path=None, job=None, job_weight=None):
 
     agent_types = {
         'puppeteer': 'node_puppeteer',
@@ -119,7 +124,22 @@ def run(agent_type, runner, replicas=1, dependency_file=None, master_url=None,
               replicas=replicas, requirementsfile=dependency_file,
               master_url=master_url, no_kube_deploy=no_kube_deploy,
               no_token_auth=no_token_auth, pymada_settings_path=pymada_settings_path,
-              kube_config_path=kube_config_path, provision_settings_path=provision_data_path)
+              kube_config_path=kube_config_path, provision_settings_path=provision_data_path,
+              job_name=job, job_weight=job_weight)
+
+
+def get_job_id(job_name, master_url=None):
+    '''
+    id of the job with the name, exits with an error if there isn't one
+    '''
+    if job_name is None:
+        return None
+
+    job = get_job(job_name, master_url=master_url)
+    if job is None:
+        raise click.ClickException('no job named ' + job_name)
+
+    return job['id']
 
 '''
 requires:
@@ -141,18 +161,58 @@ requires:
     - provision_data.json
 '''
 @cli.command()
+@click.argument('urls_file', type=click.File('r'))
 @click.option('--master-url', default=None)
-def stats(master_url=None):
+@click.option('--workers', default=4, type=int, help='number of chunks uploaded at once')
+@click.option('--chunk-size', default=5000, type=int, help='initial number of urls per chunk')
+@click.option('--job', default=None, help='name of the job to add the urls to')
+def add_urls(urls_file, master_url=None, workers=4, chunk_size=5000, job=None):
+    '''
+    adds the urls in URLS_FILE ("-" for stdin), one url or one
+    {"url": ..., "json_metadata": ...} json object per line
+    '''
+    urls = read_urls(urls_file)
+
+    job_id = get_job_id(job, master_url=master_url)
+    if job_id is not None:
+        urls = (dict(url_data, job=job_id) for url_data in urls)
+
+    upload_result = upload_urls(urls, master_url=master_url,
+                                max_in_flight=workers, chunk_size=chunk_size)
+    print_upload_result(upload_result)
+
+
+'''
+requires:
+    - provision_data.json
+'''
+@cli.command()
+@click.option('--master-url', default=None)
+@click.option('--job', default=None, help='show the stats of this job')
+def stats(master_url=None, job=None):
     try:
-        stats = request_master('/stats/', 'GET', None, master_url=master_url)
+        if job is not None:
+            stats = request_master('/jobs/' + str(get_job_id(job, master_url)) + '/stats/',
+                                   'GET', None, master_url=master_url)
+        else:
+            stats = request_master('/stats/', 'GET', None, master_url=master_url)
     except (requests.ConnectionError, requests.Timeout):
         print('error connecting to master server')
         return
     
     stats = stats.json()
+    if job is not None:
+        print('URL Tasks: ' + str(stats['urls']) + ' (queued: ' + str(stats['urls_queued'])
+                + ', assigned: ' + str(stats['urls_assigned']) + ', complete: '
+                + str(stats['urls_complete']) + ', dead: ' + str(stats['urls_dead'])
+                + ', failed at least once: ' + str(stats['urls_failed_min_once']) + ')')
+        print('Agents: ' + str(stats['agents']))
+        return
+
     print('URL Tasks: ' + str(stats['urls']) + ' (queued: ' + str(stats['urls_queued'])
             + ', assigned: ' + str(stats['urls_assigned']) + ', complete: '
-            + str(stats['urls_complete']) + ', failed at least once: '
+            + str(stats['urls_complete']) + ', dead: ' + str(stats.get('urls_dead', 0))
+            + ', failed at least once: '
             + str(stats['urls_failed_min_once']) + ')')
     print('Agents: ' + str(stats['registered_agents']))
     print('Errors Logged: ' + str(stats['errors_logged']))
@@ -164,11 +224,26 @@ requires:
 '''
 @cli.command()
 @click.argument('output_path', type=click.Path())
-def get_output(output_path):
-    results = get_results()
-    if results is not None:
-        with open(output_path, 'w') as outputfile:
-            outputfile.write(results)
+@click.option('--output-format', default='ndjson', type=click.Choice(['ndjson', 'csv']))
+@click.option('--page-size', default=5000, type=int, help='number of task ids per request')
+@click.option('--workers', default=4, type=int, help='number of concurrent requests')
+@click.option('--job', default=None, help='only write the tasks in this job')
+@click.option('--master-url', default=None)
+def get_output(output_path, output_format, page_size, workers, job=None, master_url=None):
+    '''
+    writes all url tasks to OUTPUT_PATH. If the export is interrupted,
+    running the same command again resumes it.
+    '''
+    try:
+        num_written = export_results(output_path, output_format=output_format,
+                                     page_size=page_size, max_workers=workers,
+                                     master_url=master_url,
+                                     job_id=get_job_id(job, master_url=master_url))
+    except (requests.RequestException, RuntimeError) as e:
+        click.echo('error: export stopped (' + str(e) + '), run the command again to resume')
+        return
+
+    click.echo('written ' + str(num_written) + ' tasks to ' + output_path)
 
 @cli.group()
 @click.option('--kube-config', default=None, type=click.File(),
@@ -259,9 +334,12 @@ requires:
 '''
 @kube.command()
 @click.pass_context
-def delete_deployments(ctx):
+@click.option('--job', default=None, help='only delete the agents running this job')
+@click.option('--master-url', default=None)
+def delete_deployments(ctx, job=None, master_url=None):
     '''
-    Delete the master and all agent deployments
+    Delete the master and all agent deployments, or with --job only the
+    job's agents
     '''
     kube_config = ctx.obj['kube_config']
     if not os.path.exists(kube_config):
@@ -270,6 +348,18 @@ def delete_deployments(ctx):
         'current working directory or you can specify a kube config file path with ' +
         '--kube-config')
 
+    if job is not None:
+        job_id = get_job_id(job, master_url=master_url)
+        delete_deployment(agent_deployment_name(job_id), config_path=kube_config)
+
+        print('waiting for deployment to terminate')
+        while len(get_deployment_status('pymada-job=' + str(job_id),
+                                        config_path=kube_config)['items']) > 0:
+            time.sleep(2)
+
+        print('deleted')
+        return
+
     delete_all_deployments(config_path=kube_config)
 
     print('waiting for deployments to terminate')
@@ -292,6 +382,29 @@ def delete_deployments(ctx):
 
     print('deleted')
 
+'''
+requires:
+    - k3s_config.yaml
+'''
+@kube.command()
+@click.pass_context
+@click.argument('replicas', type=int)
+@click.option('--job', default=None, help='scale the agents running this job')
+@click.option('--master-url', default=None)
+def scale_agents(ctx, replicas, job=None, master_url=None):
+    '''
+    Change the number of agents to REPLICAS
+    '''
+    kube_config = ctx.obj['kube_config']
+    if not os.path.exists(kube_config):
+        raise click.FileError(kube_config,
+        'File doesn\'t exist. "k3s_config.yaml" either needs to be in your ' +
+        'current working directory or you can specify a kube config file path with ' +
+        '--kube-config')
+
+    scale_agent_deployment(replicas, job_id=get_job_id(job, master_url=master_url),
+                           config_path=kube_config)
+
 '''
 requires:
     - k3s_config.yaml
@@ -55,10 +55,33 @@ def run_deployment(pod_spec, replicas, deploy_name,
         config_path = os.path.join(base_dir, 'k3s_config.yaml')
     kube_config.load_kube_config(config_file=config_path)
     appsv1_client = client.AppsV1Api()
-    appsv1_client.create_namespaced_deployment(body=deployment, namespace="default")
+    try:
+        appsv1_client.create_namespaced_deployment(body=deployment, namespace="default")
+    except client.rest.ApiException as e:
+        if e.status != 409:
+            raise
+
+        # already deployed, eg running a job again with a new runner
+        appsv1_client.replace_namespaced_deployment(deploy_name, 'default', deployment)
+
+
+def agent_deployment_name(job_id=None):
+    '''
+    each job's agents are a separate deployment, agents not bound to a job
+    are in pymada-agents-deployment
+    '''
+    if job_id is None:
+        return 'pymada-agents-deployment'
+
+    return 'pymada-agents-job-' + str(job_id)
+
+
+def agent_labels(job_id=None):
+    return {'app': 'pymada-agent', 'pymada-job': 'none' if job_id is None else str(job_id)}
 
 def create_general_pod_spec(pod_image_url, container_name, agent_container_ports, env_vars,
-                              node_selector=None, pod_limits=None):
+                              node_selector=None, pod_limits=None, volumes=None,
+                              volume_mounts=None):
 
     pod_resource_requirements = None
     if pod_limits is not None and type(pod_limits) == dict:
@@ -69,16 +92,19 @@ def create_general_pod_spec(pod_image_url, container_name, agent_container_ports
         image=pod_image_url,
         ports=agent_container_ports,
         env=env_vars,
+        volume_mounts=volume_mounts,
         resources=pod_resource_requirements
     )
 
     pod_spec = client.V1PodSpec(containers=[agent_container],
-                                node_selector=node_selector)
+                                node_selector=node_selector,
+                                volumes=volumes)
 
     return pod_spec
 
 def create_selenium_pod_spec(selenium_type, container_name, agent_container_ports, env_vars,
-                             node_selector=None, pod_limits=None):
+                             node_selector=None, pod_limits=None, volumes=None,
+                             volume_mounts=None):
     if selenium_type == 'firefox':
         agent_image_name = 'pymada/selenium-firefox',
     elif selenium_type == 'chrome':
@@ -94,24 +120,42 @@ def create_selenium_pod_spec(selenium_type, container_name, agent_container_port
         image=agent_image_name,
         ports=selenium_ports,
         env=env_vars,
-        volume_mounts=[client.V1VolumeMount(mount_path='/dev/shm', name='dshm')],
+        volume_mounts=[client.V1VolumeMount(mount_path='/dev/shm', name='dshm')] +
+            (volume_mounts or []),
         resources=pod_resource_requirements
     )
 
     pod_spec = client.V1PodSpec(containers=[selenium_container],
                                 node_selector=node_selector,
                                 volumes=[client.V1Volume(name='dshm',
-                                    empty_dir=client.V1EmptyDirVolumeSource(medium='Memory'))])
+                                    empty_dir=client.V1EmptyDirVolumeSource(medium='Memory'))] +
+                                    (volumes or []))
 
     return pod_spec
 
-def run_agent_deployment(agent_type, replicas, deploy_name='pymada-agents-deployment',
-                             template_label={'app': 'pymada-agent'},
+def spool_volume(spool_path):
+    '''
+    an emptyDir volume for the directory of the agents result spool. Files
+    written in the container itself are lost when the container restarts,
+    an emptyDir is kept until the pod is deleted.
+    '''
+    volume = client.V1Volume(name='pymada-spool', empty_dir=client.V1EmptyDirVolumeSource())
+    volume_mount = client.V1VolumeMount(mount_path=os.path.dirname(spool_path),
+                                        name='pymada-spool')
+
+    return volume, volume_mount
+
+def run_agent_deployment(agent_type, replicas, job_id=None,
                              agent_port=5001, container_name='pymada-single-agent',
                              auth_token=None, no_agents_on_master_node=True,
-                             pod_limits=None, config_path=None):
+                             pod_limits=None, agent_env=None, config_path=None,
+                             spool_path='/var/lib/pymada/spool.sqlite3'):
+
+    if agent_env is not None and 'PYMADA_SPOOL_PATH' in agent_env:
+        spool_path = agent_env['PYMADA_SPOOL_PATH']
 
-    env_vars = [client.V1EnvVar("MASTER_URL", "http://pymadamaster:8000"),
+    env_vars = [client.V1EnvVar("PYMADA_SPOOL_PATH", spool_path),
+        client.V1EnvVar("MASTER_URL", "http://pymadamaster:8000"),
         client.V1EnvVar("AGENT_PORT", str(agent_port)),
         client.V1EnvVar("AGENT_ADDR", value_from=client.V1EnvVarSource(
         field_ref=client.V1ObjectFieldSelector(field_path="status.podIP")))]
@@ -119,6 +163,13 @@ def run_agent_deployment(agent_type, replicas, deploy_name='pymada-agents-deploy
     if auth_token is not None:
         env_vars.append(client.V1EnvVar("PYMADA_TOKEN_AUTH", auth_token))
 
+    if agent_env is not None:
+        for env_name, env_value in agent_env.items():
+            if env_name != 'PYMADA_SPOOL_PATH':
+                env_vars.append(client.V1EnvVar(env_name, env_value))
+
+    volume, volume_mount = spool_volume(spool_path)
+
     agent_container_ports = [client.V1ContainerPort(container_port=agent_port)]
 
     pod_node_selector = None
@@ -130,33 +181,42 @@ def run_agent_deployment(agent_type, replicas, deploy_name='pymada-agents-deploy
         pod_spec = create_general_pod_spec(agent_image_name, container_name,
                                              agent_container_ports,
                                              env_vars, pod_node_selector,
-                                             pod_limits)
+                                             pod_limits, [volume], [volume_mount])
 
     elif agent_type == 'python_selenium_firefox':
         pod_spec = create_selenium_pod_spec('firefox', container_name,
                         agent_container_ports, env_vars, pod_node_selector,
-                        pod_limits)
+                        pod_limits, [volume], [volume_mount])
 
     elif agent_type == 'python_selenium_chrome':
         pod_spec = create_selenium_pod_spec('chrome', container_name,
                         agent_container_ports, env_vars, pod_node_selector,
-                        pod_limits)
+                        pod_limits, [volume], [volume_mount])
 
     elif agent_type == 'python_agent':
         agent_image_name = 'pymada/python-agent'
         pod_spec = create_general_pod_spec(agent_image_name, container_name,
                                              agent_container_ports,
                                              env_vars, pod_node_selector,
-                                             pod_limits)
+                                             pod_limits, [volume], [volume_mount])
 
-    run_deployment(pod_spec, replicas, deploy_name, template_label,
+    run_deployment(pod_spec, replicas, agent_deployment_name(job_id), agent_labels(job_id),
                    config_path=config_path)
 
+def scale_agent_deployment(replicas, job_id=None, config_path=None):
+    if config_path is None:
+        base_dir = os.getcwd()
+        config_path = os.path.join(base_dir, 'k3s_config.yaml')
+    kube_config.load_kube_config(config_file=config_path)
+    appsv1_client = client.AppsV1Api()
+    appsv1_client.patch_namespaced_deployment_scale(agent_deployment_name(job_id), 'default',
+                                                    {'spec': {'replicas': replicas}})
+
 def run_master_deployment(deploy_name='pymada-master-deployment',
                           template_label={'app': 'pymada-master'},
                           container_port=8000, container_name='pymada-master-container',
                           config_path=None, auth_token=None, max_task_duration=None,
-                          max_task_retries=None):
+                          max_task_retries=None, task_batch_size=None, master_env=None):
 
     env_vars = []
 
@@ -169,6 +229,13 @@ def run_master_deployment(deploy_name='pymada-master-deployment',
     if  max_task_retries is not None:
         env_vars.append(client.V1EnvVar("PYMADA_MAX_TASK_RETRIES", str(max_task_retries)))
 
+    if task_batch_size is not None:
+        env_vars.append(client.V1EnvVar("PYMADA_TASK_BATCH_SIZE", str(task_batch_size)))
+
+    if master_env is not None:
+        for env_name, env_value in master_env.items():
+            env_vars.append(client.V1EnvVar(env_name, env_value))
+
     container_ports = [client.V1ContainerPort(container_port=container_port)]
 
     container = client.V1Container(
@@ -226,7 +293,9 @@ def delete_deployment(deployment_name, config_path=None):
         pass
 
 def delete_all_deployments(config_path=None):
-    deployment_names = ['pymada-agents-deployment', 'pymada-master-deployment']
+    agent_deployments = get_deployment_status('app=pymada-agent', config_path=config_path)
+    deployment_names = [d['metadata']['name'] for d in agent_deployments['items']]
+    deployment_names.append('pymada-master-deployment')
 
     for deployment_name in deployment_names:
         delete_deployment(deployment_name, config_path=config_path)
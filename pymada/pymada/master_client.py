@@ -1,8 +1,16 @@
 import os
+import csv
 import json
 import time
+import random
+import threading
+import collections
+import urllib.parse
+import concurrent.futures
 import requests
-import math
+
+# provision_data.json contents by path, with the file modification time
+provision_settings_cache = {}
 
 def read_provision_settings(settings_path=None):
     if settings_path is None:
@@ -12,10 +20,37 @@ def read_provision_settings(settings_path=None):
     if not os.path.exists(settings_path):
         return None
 
+    modified_time = os.path.getmtime(settings_path)
+    cached = provision_settings_cache.get(settings_path)
+    if cached is not None and cached[0] == modified_time:
+        return cached[1]
+
     with open(settings_path) as provision_json:
-        return json.load(provision_json)
+        provision_settings = json.load(provision_json)
+
+    provision_settings_cache[settings_path] = (modified_time, provision_settings)
+    return provision_settings
+
+
+thread_local = threading.local()
 
-def request_master(url, method, req_data=None, auth_token=None, master_url=None, _num_tries=0):
+def get_session():
+    '''
+    a requests session per thread, so connections to the master are kept
+    alive and reused between requests
+    '''
+    if not hasattr(thread_local, 'session'):
+        thread_local.session = requests.Session()
+
+    return thread_local.session
+
+def request_master(url, method, req_data=None, auth_token=None, master_url=None, stream=False,
+                   req_body=None, content_type=None, max_tries=10, deadline_seconds=120):
+    '''
+    req_data is sent as json, req_body (with content_type) is sent as is.
+    Requests that can't connect are retried with exponential backoff and
+    jitter, up to max_tries times or until deadline_seconds have passed.
+    '''
     provision_settings = read_provision_settings()
 
     if master_url is None:
@@ -28,25 +63,29 @@ def request_master(url, method, req_data=None, auth_token=None, master_url=None,
         master_url = 'http://' + provision_settings['master_node_ip'] + ':30200'
     
 
-    if 'pymada_auth_token' in  provision_settings and auth_token is None:
+    if (provision_settings is not None and 'pymada_auth_token' in provision_settings
+            and auth_token is None):
         auth_token = provision_settings['pymada_auth_token']
     
     headers = {}
 
     if auth_token is not None:
         headers['pymada_token_auth'] = auth_token
+
+    if content_type is not None:
+        headers['Content-Type'] = content_type
     
-    try:
-        response = requests.request(method, master_url + url, json=req_data, headers=headers)
-    except (requests.ConnectionError, requests.Timeout) as e:
-        if _num_tries < 10:
-            time.sleep(3)
-            return request_master(url, method, req_data, auth_token=auth_token,
-                                    master_url=master_url, _num_tries=_num_tries+1)
-        else:
-            raise e
-    
-    return response
+    deadline = time.monotonic() + deadline_seconds
+    for attempt in range(1, max_tries + 1):
+        try:
+            return get_session().request(method, master_url + url, json=req_data,
+                                         data=req_body, headers=headers, stream=stream)
+        except (requests.ConnectionError, requests.Timeout):
+            delay = random.uniform(0, min(30, 0.5 * 2 ** attempt))
+            if attempt == max_tries or time.monotonic() + delay > deadline:
+                raise
+
+            time.sleep(delay)
 
 def add_runner(runner_path, file_type, dependency_file_path=None, master_url=None):
     if not os.path.exists(runner_path):
@@ -67,9 +106,47 @@ def add_runner(runner_path, file_type, dependency_file_path=None, master_url=Non
     
     if response.ok:
         print('runner added')
+        return response.json()['id']
     else:
         print(response.text)
 
+def get_job(name, master_url=None):
+    '''
+    returns the job with the name, or None if there isn't one
+    '''
+    response = request_master('/jobs/?name=' + urllib.parse.quote(name), 'GET',
+                              master_url=master_url)
+    response.raise_for_status()
+
+    jobs = response.json()
+    if len(jobs) == 0:
+        return None
+
+    return jobs[0]
+
+def save_job(name, runner_id=None, weight=None, settings=None, master_url=None):
+    '''
+    creates the job, or updates it if there's already a job with the name.
+    settings is a dict of settings for the job's tasks.
+    '''
+    job_data = {'name': name}
+    if runner_id is not None:
+        job_data['runner'] = runner_id
+    if weight is not None:
+        job_data['weight'] = weight
+    if settings is not None:
+        job_data['settings'] = json.dumps(settings)
+
+    job = get_job(name, master_url=master_url)
+    if job is None:
+        response = request_master('/jobs/', 'POST', job_data, master_url=master_url)
+    else:
+        response = request_master('/jobs/' + str(job['id']) + '/', 'PUT', job_data,
+                                  master_url=master_url)
+
+    response.raise_for_status()
+    return response.json()
+
 def add_url(url, json_metadata=None, master_url=None):
 
     if type(json_metadata) is dict:
@@ -88,25 +165,163 @@ def add_url(url, json_metadata=None, master_url=None):
         print(response.text)
 
 '''
-url_list needs to be a list with format [{url: String, json_metadata: String}]
+url_list can be any iterable (a list or a generator) of {url: String, json_metadata: String}
 '''
-def add_multiple_urls(url_list, master_url=None):
-    num_urls = len(url_list)
-    print('adding', num_urls, 'urls')
-    for i in range(math.ceil(num_urls/100)):
-        to_upload = url_list[i*100:i*100+100]
-        print('adding urls from',i*100,i*100 + len(to_upload))
+def add_multiple_urls(url_list, master_url=None, **upload_options):
+    upload_result = upload_urls(url_list, master_url=master_url, **upload_options)
+    print_upload_result(upload_result)
+
+
+def read_urls(lines):
+    '''
+    yields {url, json_metadata} dicts from the lines of a file of urls, either
+    one url per line or one json object per line (ndjson). Lines that aren't
+    valid json objects are skipped and printed.
+    '''
+    for line_num, line in enumerate(lines, 1):
+        line = line.strip()
+        if len(line) == 0:
+            continue
+
+        if line.startswith('{'):
+            try:
+                url_data = json.loads(line)
+            except ValueError:
+                url_data = None
+
+            if type(url_data) is not dict:
+                print('skipping line', line_num, 'not a valid json object:', line[:200])
+                continue
+
+            yield url_data
+        else:
+            yield {'url': line, 'json_metadata': None}
 
-        response = request_master('/urls/', 'POST', to_upload, master_url=master_url)
 
-    if response.ok:
-        print('urls added')
-    else:
-        print(response.text)
+def upload_chunk(chunk_body, master_url=None, max_tries=10):
+    '''
+    sends a chunk of ndjson urls to the bulk endpoint. Returns the bulk
+    endpoint response, raises RuntimeError if it failed. Only requests that
+    couldn't connect are retried (by request_master, up to max_tries times),
+    as the master may have added some of the urls before an error response.
+    '''
+    try:
+        response = request_master('/urls/bulk/', 'POST', req_body=chunk_body,
+                                  content_type='application/x-ndjson', master_url=master_url,
+                                  max_tries=max_tries)
+    except requests.RequestException as e:
+        raise RuntimeError(str(e))
+
+    if not response.ok:
+        raise RuntimeError('status ' + str(response.status_code) + ': ' + response.text[:200])
+
+    return response.json()
 
 
-def get_results(master_url=None):
-    response = request_master('/urls/', 'GET', master_url=master_url)
+def upload_urls(urls, master_url=None, max_in_flight=4, chunk_size=5000,
+                min_chunk_size=500, max_chunk_size=50000, target_chunk_seconds=2.0,
+                max_tries=10):
+    '''
+    Adds urls (any iterable of {url, json_metadata} dicts, it's only read as
+    far as the chunks in flight) to the master through the bulk endpoint.
+    Up to max_in_flight chunks are uploaded at once. The chunk size is
+    adjusted after each upload so a chunk takes about target_chunk_seconds.
+
+    Returns {'sent', 'created', 'errors', 'failed_chunks'}, failed_chunks is
+    a list of {'start', 'end', 'error'} with the positions in urls of the
+    chunks that failed. urls are counted as they're read, so urls can be a
+    generator.
+    '''
+    upload_result = {'sent': 0, 'created': 0, 'errors': 0, 'failed_chunks': []}
+    urls = iter(urls)
+    position = 0
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        in_flight = {}
+
+        while True:
+            while len(in_flight) < max_in_flight:
+                chunk = [json.dumps(url_data) + '\n' for _, url_data in
+                         zip(range(chunk_size), urls)]
+                if len(chunk) == 0:
+                    break
+
+                chunk_body = ''.join(chunk).encode('utf-8')
+                upload_future = executor.submit(upload_chunk, chunk_body, master_url, max_tries)
+                in_flight[upload_future] = (position, position + len(chunk), time.time())
+                position += len(chunk)
+
+            if len(in_flight) == 0:
+                break
+
+            done, _ = concurrent.futures.wait(in_flight,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for upload_future in done:
+                start, end, sent_time = in_flight.pop(upload_future)
+                upload_result['sent'] += end - start
+
+                try:
+                    chunk_result = upload_future.result()
+                except RuntimeError as e:
+                    print('failed to add urls', start, 'to', end, '(' + str(e) + ')')
+                    upload_result['failed_chunks'].append({'start': start, 'end': end,
+                                                           'error': str(e)})
+                    continue
+
+                upload_result['created'] += chunk_result['created']
+                upload_result['errors'] += chunk_result['errors']
+
+                # scale the chunk size towards the target time per chunk, at
+                # most doubling or halving it at once
+                chunk_seconds = max(time.time() - sent_time, 0.001)
+                scale = min(max(target_chunk_seconds / chunk_seconds, 0.5), 2.0)
+                chunk_size = int(min(max(chunk_size * scale, min_chunk_size), max_chunk_size))
+
+    return upload_result
+
+
+def print_upload_result(upload_result):
+    print('added', upload_result['created'], 'of', upload_result['sent'], 'urls')
+
+    if upload_result['errors'] > 0:
+        print('skipped', upload_result['errors'], 'invalid urls')
+
+    if len(upload_result['failed_chunks']) > 0:
+        print('failed to add', sum([c['end'] - c['start'] for c in upload_result['failed_chunks']]),
+              'urls in', len(upload_result['failed_chunks']), 'chunks')
+
+
+def get_results(master_url=None, page_size=5000):
+    '''
+    returns an iterator over all the url tasks. They're read from the master
+    a page of newline delimited json at a time, so they never all have to be
+    held in memory.
+    '''
+    after_id = 0
+    while True:
+        response = request_master('/urls/?output=ndjson&after_id=' + str(after_id) + '&limit=' +
+                                  str(page_size), 'GET', master_url=master_url)
+
+        if not response.ok:
+            print(response.text)
+            return
+
+        page = [json.loads(line) for line in response.iter_lines() if line]
+        yield from page
+
+        if len(page) < page_size:
+            return
+
+        after_id = page[-1]['id']
+
+
+def get_url_tasks_page(after_id=0, limit=1000, master_url=None):
+    '''
+    returns up to limit url tasks with an id greater than after_id, in id order
+    '''
+    req_url = '/urls/?after_id=' + str(after_id) + '&limit=' + str(limit)
+    response = request_master(req_url, 'GET', master_url=master_url)
 
     if response.ok:
         return response.json()
@@ -145,11 +360,14 @@ def download_screenshot(screenshot_id, master_url=None):
     else:
         print(response.text)
 
-def get_url_tasks(min_id=None, max_id=None, master_url=None):
+def get_url_tasks(min_id=None, max_id=None, master_url=None, job_id=None):
     req_url = '/urls/'
     if min_id != None and max_id != None:
         req_url += '?min_id=' + str(min_id) + '&max_id=' + str(max_id)
 
+    if job_id is not None:
+        req_url += ('&' if '?' in req_url else '?') + 'job=' + str(job_id)
+
     response = request_master(req_url, 'GET', master_url=master_url)
 
     if response.ok:
@@ -170,7 +388,7 @@ def list_agents(min_id=None, max_id=None, master_url=None):
         print(response.text)
 
 '''
-returns format: {'url_tasks': int}
+returns format: {'url_tasks': int, 'max_id': int}
 '''
 def get_url_tasks_length(task_state=None, master_url=None):
     req_url = '/url_tasks_length/'
@@ -183,4 +401,111 @@ def get_url_tasks_length(task_state=None, master_url=None):
     if response.ok:
         return response.json()
     else:
-        print(response.text)
\ No newline at end of file
+        print(response.text)
+
+url_task_fields = ['id', 'url', 'json_metadata', 'task_state', 'task_result', 'job', 'priority',
+                   'assigned_agent', 'assigned_slot', 'fail_num', 'start_time', 'end_time']
+
+def get_url_tasks_range(min_id, max_id, master_url=None, num_tries=3, job_id=None):
+    for attempt in range(num_tries):
+        try:
+            url_tasks = get_url_tasks(min_id, max_id, master_url=master_url, job_id=job_id)
+        except requests.RequestException:
+            if attempt == num_tries - 1:
+                raise
+            url_tasks = None
+
+        if url_tasks is not None:
+            return url_tasks
+
+        time.sleep(2 ** attempt)
+
+    raise RuntimeError('unable to get url tasks ' + str(min_id) + ' to ' + str(max_id))
+
+
+def export_results(output_path, output_format='ndjson', page_size=5000, max_workers=4,
+                   checkpoint_path=None, master_url=None, job_id=None):
+    '''
+    Writes all the url tasks (or with job_id, the job's tasks) to
+    output_path as ndjson or csv. The tasks are
+    fetched in pages by id range, up to max_workers pages at a time, and
+    written in id order. After each page a checkpoint file records how far
+    the export got, running the export again after a failure carries on from
+    there. Returns the number of tasks written.
+    '''
+    if checkpoint_path is None:
+        checkpoint_path = output_path + '.checkpoint'
+
+    checkpoint = {'last_id': 0, 'file_size': 0, 'num_written': 0, 'format': output_format,
+                  'job': job_id}
+    if os.path.exists(checkpoint_path) and os.path.exists(output_path):
+        with open(checkpoint_path) as checkpoint_file:
+            saved_checkpoint = json.load(checkpoint_file)
+
+        if (saved_checkpoint['format'] == output_format and
+                saved_checkpoint.get('job') == job_id):
+            checkpoint = saved_checkpoint
+            print('resuming export after task ' + str(checkpoint['last_id']))
+
+    max_id = get_url_tasks_length(master_url=master_url)['max_id'] or 0
+
+    if checkpoint['file_size'] > 0:
+        outputfile = open(output_path, 'r+', newline='')
+        # anything after the checkpoint is from a page that was cut off
+        outputfile.truncate(checkpoint['file_size'])
+        outputfile.seek(checkpoint['file_size'])
+    else:
+        outputfile = open(output_path, 'w', newline='')
+
+    with outputfile:
+        csv_writer = None
+        if output_format == 'csv':
+            csv_writer = csv.DictWriter(outputfile, fieldnames=url_task_fields,
+                                        extrasaction='ignore')
+            if checkpoint['file_size'] == 0:
+                csv_writer.writeheader()
+
+        page_starts = iter(range(checkpoint['last_id'] + 1, max_id + 1, page_size))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending_pages = collections.deque()
+
+            def fetch_next_page():
+                page_start = next(page_starts, None)
+                if page_start is not None:
+                    page_end = page_start + page_size - 1
+                    pending_pages.append((page_end, executor.submit(
+                        get_url_tasks_range, page_start, page_end, master_url, job_id=job_id)))
+
+            for _ in range(max_workers * 2):
+                fetch_next_page()
+
+            while len(pending_pages) > 0:
+                page_end, page_future = pending_pages.popleft()
+                url_tasks = page_future.result()
+                fetch_next_page()
+
+                for url_task in url_tasks:
+                    if csv_writer is not None:
+                        csv_writer.writerow(url_task)
+                    else:
+                        outputfile.write(json.dumps(url_task) + '\n')
+
+                outputfile.flush()
+                checkpoint['last_id'] = page_end
+                checkpoint['file_size'] = outputfile.tell()
+                checkpoint['num_written'] += len(url_tasks)
+                save_checkpoint(checkpoint_path, checkpoint)
+
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    return checkpoint['num_written']
+
+
+def save_checkpoint(checkpoint_path, checkpoint):
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+
+    os.replace(tmp_path, checkpoint_path)
@@ -27,6 +27,12 @@ def run_master_kube(kube_config_path, pymada_settings_path, pymada_auth_token=No
     if 'max_task_duration_seconds' in pymada_settings['pymada']:
         max_task_duration = pymada_settings['pymada']['max_task_duration_seconds']
 
+    task_batch_size = None
+    if 'task_batch_size' in pymada_settings['pymada']:
+        task_batch_size = pymada_settings['pymada']['task_batch_size']
+
+    master_env = get_settings_env(pymada_settings, master_env_settings)
+
     # check if master deployment already exists
     master_dep_status = kube.get_deployment_status('app=pymada-master')
     if len(master_dep_status['items']) != 0:
@@ -39,12 +45,16 @@ def run_master_kube(kube_config_path, pymada_settings_path, pymada_auth_token=No
     if pymada_auth_token is None:
         kube.run_master_deployment(config_path=kube_config_path,
                                     max_task_duration=max_task_duration,
-                                    max_task_retries=max_task_retries)
+                                    max_task_retries=max_task_retries,
+                                    task_batch_size=task_batch_size,
+                                    master_env=master_env)
     else:
         kube.run_master_deployment(config_path=kube_config_path,
                                     auth_token=pymada_auth_token,
                                     max_task_duration=max_task_duration,
-                                    max_task_retries=max_task_retries)
+                                    max_task_retries=max_task_retries,
+                                    task_batch_size=task_batch_size,
+                                    master_env=master_env)
 
     # wait for master api server deployment on kubernetes
     while True:
@@ -56,12 +66,54 @@ def run_master_kube(kube_config_path, pymada_settings_path, pymada_auth_token=No
         time.sleep(2)
 
 
+'''
+maps settings in the "pymada" section of pymada_settings.yaml to the
+environment variables read by the master (api_server) and agent_server.py
+'''
+master_env_settings = {
+    'stats_counters': 'PYMADA_STATS_COUNTERS',
+    'result_compression': 'PYMADA_RESULT_COMPRESSION',
+    'host_rate_per_second': 'PYMADA_HOST_RATE',
+    'host_burst': 'PYMADA_HOST_BURST',
+    'host_max_concurrent': 'PYMADA_HOST_MAX_CONCURRENT',
+    'retry_delay_seconds': 'PYMADA_RETRY_DELAY_SECONDS',
+    'max_retry_delay_seconds': 'PYMADA_MAX_RETRY_DELAY_SECONDS',
+    'speculate_after_seconds': 'PYMADA_SPECULATE_AFTER_SECONDS',
+}
+
+agent_env_settings = {
+    'persistent_runner': 'PYMADA_PERSISTENT_RUNNER',
+    'runner_max_tasks': 'PYMADA_RUNNER_MAX_TASKS',
+    'runner_max_memory_mb': 'PYMADA_RUNNER_MAX_MEMORY_MB',
+    'runner_slots': 'PYMADA_RUNNER_SLOTS',
+    'dedup_urls': 'PYMADA_DEDUP_URLS',
+    'dedup_capacity': 'PYMADA_DEDUP_CAPACITY',
+    'add_url_batch_size': 'PYMADA_ADD_URL_BATCH_SIZE',
+    'add_url_flush_seconds': 'PYMADA_ADD_URL_FLUSH_SECONDS',
+    'http_pool_size': 'PYMADA_HTTP_POOL_SIZE',
+    'compress_requests': 'PYMADA_COMPRESS_REQUESTS',
+    'spool_path': 'PYMADA_SPOOL_PATH',
+}
+
+def get_settings_env(pymada_settings, env_settings):
+    env = {}
+    for setting_name, env_name in env_settings.items():
+        if pymada_settings['pymada'].get(setting_name) is not None:
+            env[env_name] = str(pymada_settings['pymada'][setting_name])
+
+    return env
+
+
 def run_agent(agent_type, runner, replicas=1, requirementsfile=None, master_url=None,
               no_kube_deploy=False, no_token_auth=False, pymada_settings_path=None,
-              kube_config_path=None, provision_settings_path=None):
+              kube_config_path=None, provision_settings_path=None, job_name=None,
+              job_weight=None):
 
     '''
     current agent types: "node_puppeteer", "python_selenium_firefox", "python_selenium_chrome", "python_agent"
+
+    With job_name, the runner is used for that job (created if it doesn't
+    exist) and the agents only run the job's tasks.
     '''
     if kube_config_path is None:
         kube_config_path = os.path.join(os.getcwd(), 'k3s_config.yaml')
@@ -77,7 +129,14 @@ def run_agent(agent_type, runner, replicas=1, requirementsfile=None, master_url=
             auth_token = provision_settings['pymada_auth_token']
             run_master_kube(kube_config_path, pymada_settings_path, pymada_auth_token=auth_token)
 
-    master_client.add_runner(runner, agent_type, requirementsfile, master_url=master_url)
+    runner_id = master_client.add_runner(runner, agent_type, requirementsfile,
+                                         master_url=master_url)
+
+    job = None
+    if job_name is not None and runner_id is not None:
+        job = master_client.save_job(job_name, runner_id=runner_id, weight=job_weight,
+                                     master_url=master_url)
+        print('running job ' + job_name + ' (id ' + str(job['id']) + ')')
 
     if not no_kube_deploy:
         print('deploying agents on kubernetes')
@@ -90,15 +149,23 @@ def run_agent(agent_type, runner, replicas=1, requirementsfile=None, master_url=
         if 'agent_pod_limits' in pymada_settings['pymada']:
             pod_limits = pymada_settings['pymada']['agent_pod_limits']
 
+        agent_env = get_settings_env(pymada_settings, agent_env_settings)
+        job_id = None
+        if job is not None:
+            job_id = job['id']
+            agent_env['PYMADA_JOB'] = str(job_id)
+
         if no_token_auth:
-            kube.run_agent_deployment(agent_type, replicas, 
+            kube.run_agent_deployment(agent_type, replicas, job_id=job_id,
                 no_agents_on_master_node=no_agents_on_master_node,
                 pod_limits=pod_limits,
+                agent_env=agent_env,
                 config_path=kube_config_path)
         else:
             provision_settings = master_client.read_provision_settings(provision_settings_path)
-            kube.run_agent_deployment(agent_type, replicas,
+            kube.run_agent_deployment(agent_type, replicas, job_id=job_id,
                 auth_token=provision_settings['pymada_auth_token'],
                 no_agents_on_master_node=no_agents_on_master_node,
                 pod_limits=pod_limits,
+                agent_env=agent_env,
                 config_path=kube_config_path)
\ No newline at end of file